@@ -0,0 +1,13 @@
+# Stubs for defusedxml.ElementTree (Python 3.6)
+
+from typing import Any, Iterator, Optional, Sequence, Tuple
+from xml.etree.ElementTree import Element, ParseError as ParseError
+
+def iterparse(
+    source: Any,
+    events: Optional[Sequence[str]] = ...,
+    parser: Any = ...,
+    forbid_dtd: bool = ...,
+    forbid_entities: bool = ...,
+    forbid_external: bool = ...
+) -> Iterator[Tuple[str, Element]]: ...
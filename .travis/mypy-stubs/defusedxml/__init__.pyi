@@ -0,0 +1,3 @@
+# Stubs for defusedxml (Python 3.6)
+
+class DefusedXmlException(ValueError): ...
@@ -0,0 +1,153 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Measure throughput and ratio of the backup archive compressions.
+
+Usage: python3 benchmarks/compression.py [--source DIR] [--size MiB]
+    [--threads N [N ...]] [--zstd PATH]
+
+A tar stream of the source directory, which defaults to the Python
+standard library, is compressed in memory. Single-threaded gzip is
+measured as baseline for ParallelGzipWriter with an increasing number of
+threads, by default powers of two up to the number of CPUs. zstd is
+measured with the same thread counts when its binary is installed. Every
+output is decompressed and compared with the input.
+"""
+import argparse
+import gzip
+import io
+import os
+import os.path
+import subprocess  # nosec: B404
+import tarfile
+import time
+import typing
+
+import ioc_cli.shared.compression
+from ioc_cli.shared.compression import (
+    GzipCompression,
+    ZstdCompression,
+    default_thread_count
+)
+
+
+def create_tar_stream(source: str, size: int) -> bytes:
+    """Return a tar stream of the files in source up to a size in bytes."""
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        for directory, _, files in os.walk(source):
+            for filename in sorted(files):
+                path = os.path.join(directory, filename)
+                if os.path.isfile(path) is False:
+                    continue
+                tar.add(path, recursive=False)
+                if output.tell() >= size:
+                    return output.getvalue()
+    return output.getvalue()
+
+
+def measure(
+    compress: typing.Callable[[typing.BinaryIO], None],
+    decompress: typing.Callable[[bytes], bytes],
+    data: bytes
+) -> typing.Tuple[float, float]:
+    """Return throughput in MiB/s and compression ratio of a compressor."""
+    output = io.BytesIO()
+    start = time.perf_counter()
+    compress(output)
+    duration = time.perf_counter() - start
+    compressed = output.getvalue()
+    if decompress(compressed) != data:
+        raise ValueError("The decompressed data differs from the input")
+    return (len(data) / duration / 1024 / 1024, len(data) / len(compressed),)
+
+
+def get_thread_counts() -> typing.List[int]:
+    """Return powers of two up to the number of CPUs."""
+    counts = [1]
+    while (counts[-1] * 2) <= default_thread_count():
+        counts.append(counts[-1] * 2)
+    return counts
+
+
+def main() -> None:
+    """Run the benchmark and print a result table."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--source", default=os.path.dirname(os.__file__))
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--threads", type=int, nargs="+")
+    parser.add_argument(
+        "--zstd",
+        default=ioc_cli.shared.compression.ZSTD_BINARY
+    )
+    args = parser.parse_args()
+    thread_counts = args.threads or get_thread_counts()
+    ioc_cli.shared.compression.ZSTD_BINARY = args.zstd
+
+    data = create_tar_stream(args.source, args.size * 1024 * 1024)
+    results = []
+
+    def _gzip(output: typing.BinaryIO) -> None:
+        with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=6) as f:
+            f.write(data)
+
+    results.append(("gzip", 1, measure(_gzip, gzip.decompress, data),))
+
+    for threads in thread_counts:
+        def _parallel_gzip(output: typing.BinaryIO) -> None:
+            writer = GzipCompression().writer(output, threads=threads)
+            writer.write(data)
+            writer.close()
+        results.append((
+            "ParallelGzipWriter",
+            threads,
+            measure(_parallel_gzip, gzip.decompress, data),
+        ))
+
+    if os.path.isfile(args.zstd) is True:
+        def _unzstd(compressed: bytes) -> bytes:
+            return bytes(subprocess.run(  # nosec: trusted command
+                [args.zstd, "-q", "-d", "-c"],
+                input=compressed,
+                stdout=subprocess.PIPE,
+                check=True
+            ).stdout)
+
+        for threads in thread_counts:
+            def _zstd(output: typing.BinaryIO) -> None:
+                writer = ZstdCompression().writer(output, threads=threads)
+                writer.write(data)
+                writer.close()
+            results.append(("zstd", threads, measure(_zstd, _unzstd, data),))
+
+    size = len(data) / 1024 / 1024
+    print(f"{size:.1f} MiB tar stream of {args.source}")
+    print(f"{'compression':<20}{'threads':>8}{'MiB/s':>10}{'ratio':>8}")
+    for name, threads, (throughput, ratio) in results:
+        print(f"{name:<20}{threads:>8}{throughput:>10.1f}{ratio:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
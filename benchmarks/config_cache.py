@@ -0,0 +1,129 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Compare parsing jail configs as JSON with reading the parsed config cache.
+
+Usage: python3 benchmarks/config_cache.py [--properties N] [--rounds N]
+
+A jail config with the given number of properties is generated, written
+as JSON and as a marshal cache file like ioc writes it, and each file is
+opened and read repeatedly. UCL is measured as well when the ucl module
+is installed.
+"""
+import argparse
+import json
+import marshal
+import os.path
+import tempfile
+import time
+import typing
+
+
+def generate_config(properties: int) -> typing.Dict[str, typing.Any]:
+    """Return a jail config resembling the ones written by libioc."""
+    config: typing.Dict[str, typing.Any] = dict(
+        id="benchmark",
+        release="12.0-RELEASE",
+        basejail=True,
+        boot=False,
+        priority=5,
+        ip4_addr="vnet0|10.0.0.23/24",
+        defaultrouter="10.0.0.1",
+        vnet=True,
+        interfaces="vnet0:bridge0",
+        provision={"method": "puppet", "source": "http://example.com/p"}
+    )
+    for index in range(len(config), properties):
+        config[f"user.property{index}"] = f"value {index}"
+    return config
+
+
+def measure(
+    read: typing.Callable[[typing.BinaryIO], typing.Any],
+    path: str,
+    rounds: int
+) -> float:
+    """Return the average time in microseconds to read a file."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with open(path, "rb") as f:
+            read(f)
+    return (time.perf_counter() - start) / rounds * 1000000
+
+
+def main() -> None:
+    """Run the benchmark and print the average read times."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--properties", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    config = generate_config(args.properties)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        json_file = os.path.join(directory, "config.json")
+        with open(json_file, "w") as f:
+            json.dump(config, f, sort_keys=True, indent=4)
+        results.append(
+            ("json.load", measure(json.load, json_file, args.rounds),)
+        )
+
+        # the files read here were written by this benchmark
+        marshal_file = os.path.join(directory, ".config.json.cache")
+        with open(marshal_file, "wb") as f:
+            marshal.dump(config, f)
+        results.append((
+            "marshal.loads",
+            measure(
+                lambda f: marshal.loads(f.read()),  # nosec: B302
+                marshal_file,
+                args.rounds
+            )
+        ))
+
+        try:
+            import ucl
+        except ImportError:
+            ucl = None
+        if ucl is not None:
+            ucl_file = os.path.join(directory, "config")
+            with open(ucl_file, "w") as f:
+                f.write(ucl.dump(config, ucl.UCL_EMIT_CONFIG))
+            results.append((
+                "ucl.load",
+                measure(
+                    lambda f: ucl.load(f.read().decode("UTF-8")),
+                    ucl_file,
+                    args.rounds
+                )
+            ))
+
+    print(f"{args.properties} properties, {args.rounds} rounds")
+    for name, microseconds in results:
+        print(f"{name:<16}{microseconds:>8.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+Compare config lookups through libioc with the resolved config cache.
+
+Usage: python3 benchmarks/resolved_config.py [--jails N] [--rounds N]
+
+An inventory of jails with a few configured properties each is created in
+memory, next to host defaults that override some properties. The lookups
+of `ioc list` (a few columns per jail) and of `ioc get --all` (every
+property of a jail) are measured through libioc and through the resolved
+config cache. No ZFS pool is needed.
+"""
+import argparse
+import time
+import types
+import typing
+
+import libioc.Config.Jail.Defaults
+import libioc.Config.Jail.JailConfig
+import libioc.Config.Data
+import libioc.helpers
+import libioc.Host
+
+from ioc_cli.shared.config import ResolvedConfigCache
+
+LIST_COLUMNS = [
+    "id", "release", "boot", "basejail", "ip4_addr", "vnet", "priority",
+    "exec_start"
+]
+
+
+def create_host() -> libioc.Host.HostGenerator:
+    """Return a host with in-memory defaults."""
+    defaults = libioc.Config.Jail.Defaults.JailConfigDefaults()
+    defaults.clone(dict(
+        vnet=True,
+        interfaces="vnet0:bridge0",
+        exec_timeout="300",
+        securelevel="3"
+    ))
+    host = libioc.Host.HostGenerator.__new__(libioc.Host.HostGenerator)
+    # the defaults resource would otherwise be read from a ZFS dataset
+    host._defaults = types.SimpleNamespace(config=defaults)
+    host._defaults_initialized = True
+    return host
+
+
+def create_jail_configs(
+    host: libioc.Host.HostGenerator,
+    count: int
+) -> typing.List[libioc.Config.Jail.JailConfig.JailConfig]:
+    """Return jail configs resembling an inventory of many jails."""
+    configs = []
+    for index in range(count):
+        config = libioc.Config.Jail.JailConfig.JailConfig(host=host)
+        config.data = libioc.Config.Data.Data()
+        config.clone(dict(
+            id=f"jail{index}",
+            release="12.0-RELEASE",
+            boot=(index % 2 == 0),
+            basejail=True,
+            priority=index % 10,
+            host_hostname=f"jail{index}.example.com"
+        ))
+        configs.append(config)
+    return configs
+
+
+def measure(
+    lookup: typing.Callable[[], int],
+    rounds: int
+) -> float:
+    """Return the lookups per second of the best of some rounds."""
+    best = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        lookups = lookup()
+        best = max(best, lookups / (time.perf_counter() - start))
+    return best
+
+
+def main() -> None:
+    """Run the benchmark and print lookups per second."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jails", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    configs = create_jail_configs(create_host(), args.jails)
+
+    def _list_libioc() -> int:
+        for config in configs:
+            for column in LIST_COLUMNS:
+                libioc.helpers.to_string(config[column], none="-")
+        return len(configs) * len(LIST_COLUMNS)
+
+    def _list_resolved() -> int:
+        cache = ResolvedConfigCache()
+        for config in configs:
+            resolved = cache.resolve(config)
+            for column in LIST_COLUMNS:
+                libioc.helpers.to_string(resolved[column], none="-")
+        return len(configs) * len(LIST_COLUMNS)
+
+    def _get_all_libioc() -> int:
+        lookups = 0
+        for config in configs:
+            for key in config.all_properties:
+                config.get_string(key)
+                lookups += 1
+        return lookups
+
+    def _get_all_resolved() -> int:
+        cache = ResolvedConfigCache()
+        lookups = 0
+        for config in configs:
+            resolved = cache.resolve(config)
+            for key in resolved.keys():
+                config.stringify(resolved[key])
+                lookups += 1
+        return lookups
+
+    print(f"{args.jails} jails, best of {args.rounds} rounds")
+    print(f"{'workload':<12}{'libioc':>14}{'resolved':>14}{'speedup':>9}")
+    for name, before, after in (
+        ("list", _list_libioc, _list_resolved,),
+        ("get --all", _get_all_libioc, _get_all_resolved,),
+    ):
+        before_rate = measure(before, args.rounds)
+        after_rate = measure(after, args.rounds)
+        print(
+            f"{name:<12}{before_rate:>12.0f}/s{after_rate:>12.0f}/s"
+            f"{after_rate / before_rate:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,8 @@ from libioc.ZFS import get_zfs
 from libioc.Datasets import Datasets
 from libioc.Host import HostGenerator
 
+from .shared.config import install_parsed_config_cache
+
 logger = Logger()
 
 click.core._verify_python3_env = lambda: None  # type: ignore
@@ -205,6 +207,8 @@ def cli(ctx, log_level: str, source: set) -> None:
     if ctx.invoked_subcommand in ["activate", "deactivate"]:
         return
 
+    install_parsed_config_cache()
+
     try:
         datasets = Datasets(
             sources=ctx.user_sources,
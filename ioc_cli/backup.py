@@ -0,0 +1,262 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Inspect backup archives and manage deduplicating repositories."""
+import sys
+import typing
+import click
+
+import libioc.errors
+
+from .shared.chunks import ChunkStore
+from .shared.click import IocClickContext
+from .shared.output import print_table, to_humanreadable_size
+from .shared.seekable import SeekableArchive
+
+__rootcmd__ = True
+
+
+def _get_store(ctx: IocClickContext, repository: str) -> ChunkStore:
+    try:
+        return ChunkStore(repository, logger=ctx.parent.logger)
+    except libioc.errors.IocException:
+        exit(1)
+
+
+@click.command(
+    name="list",
+    help="List the backups in a repository"
+)
+@click.pass_context
+@click.argument("repository", nargs=1, required=True)
+def cli_list(ctx: IocClickContext, repository: str) -> None:
+    """List the backups stored in a repository."""
+    store = _get_store(ctx, repository)
+    data = []
+    try:
+        for name in store.list_backups():
+            manifest = store.read_manifest(name)
+            data.append([
+                name,
+                manifest["created"],
+                to_humanreadable_size(manifest["size"]),
+                str(len(manifest["chunks"]))
+            ])
+    except libioc.errors.IocException:
+        exit(1)
+    print_table(data, ["name", "created", "size", "chunks"], sort_key="name")
+
+
+@click.command(
+    name="stats",
+    help="Show the space usage and dedupe ratio of a repository"
+)
+@click.pass_context
+@click.argument("repository", nargs=1, required=True)
+def cli_stats(ctx: IocClickContext, repository: str) -> None:
+    """Show the space usage of a repository."""
+    store = _get_store(ctx, repository)
+    try:
+        stats = store.stats()
+    except libioc.errors.IocException:
+        exit(1)
+    print_table(
+        [[
+            str(stats.backups),
+            str(stats.chunks),
+            to_humanreadable_size(stats.logical_size),
+            to_humanreadable_size(stats.unique_size),
+            to_humanreadable_size(stats.stored_size),
+            f"{round(stats.dedupe_ratio, 2)}x",
+            f"{round(stats.compression_ratio, 2)}x"
+        ]],
+        [
+            "backups",
+            "chunks",
+            "size",
+            "unique",
+            "stored",
+            "dedupe",
+            "compression"
+        ]
+    )
+
+
+@click.command(
+    name="rm",
+    help="Remove backups from a repository"
+)
+@click.pass_context
+@click.argument("repository", nargs=1, required=True)
+@click.argument("names", nargs=-1, required=True)
+def cli_rm(
+    ctx: IocClickContext,
+    repository: str,
+    names: typing.Tuple[str, ...]
+) -> None:
+    """
+    Remove backups from a repository.
+
+    Only the manifests are deleted. The space of chunks that are no longer
+    referenced is reclaimed by `ioc backup gc`.
+    """
+    store = _get_store(ctx, repository)
+    try:
+        for name in names:
+            store.delete(name)
+            ctx.parent.logger.log(f"Backup {name} removed")
+    except libioc.errors.IocException:
+        exit(1)
+
+
+@click.command(
+    name="gc",
+    help="Delete chunks that are not referenced by any backup"
+)
+@click.pass_context
+@click.argument("repository", nargs=1, required=True)
+@click.option(
+    "--dry-run", "-n",
+    is_flag=True,
+    default=False,
+    help="Only show how much space would be freed"
+)
+def cli_gc(ctx: IocClickContext, repository: str, dry_run: bool) -> None:
+    """Collect the garbage of a repository."""
+    store = _get_store(ctx, repository)
+    try:
+        stats = store.collect_garbage(dry_run=dry_run)
+    except libioc.errors.IocException:
+        exit(1)
+    verb = "would be" if (dry_run is True) else "were"
+    ctx.parent.logger.log(
+        f"{stats.removed_chunks} unreferenced chunks {verb} deleted "
+        f"({to_humanreadable_size(stats.freed_size)})"
+    )
+
+
+def _get_archive(ctx: IocClickContext, archive: str) -> SeekableArchive:
+    try:
+        return SeekableArchive(archive, logger=ctx.parent.logger)
+    except FileNotFoundError:
+        ctx.parent.logger.error(f"The archive {archive} does not exist")
+        exit(1)
+    except libioc.errors.IocException:
+        exit(1)
+
+
+@click.command(
+    name="files",
+    help="List the files in a seekable backup archive"
+)
+@click.pass_context
+@click.argument("archive", nargs=1, required=True)
+def cli_files(ctx: IocClickContext, archive: str) -> None:
+    """List the files indexed in a seekable archive."""
+    for name in sorted(_get_archive(ctx, archive).files.keys()):
+        print(name)
+
+
+@click.command(
+    name="cat",
+    help="Print files from a seekable backup archive"
+)
+@click.pass_context
+@click.argument("archive", nargs=1, required=True)
+@click.argument("paths", nargs=-1, required=True)
+def cli_cat(
+    ctx: IocClickContext,
+    archive: str,
+    paths: typing.Tuple[str, ...]
+) -> None:
+    """
+    Print files from a seekable archive to stdout.
+
+    Paths are relative to the backup, for example `root/etc/rc.conf`. Only
+    the frames that contain the requested files are decompressed.
+    """
+    seekable_archive = _get_archive(ctx, archive)
+    try:
+        for path in paths:
+            sys.stdout.buffer.write(seekable_archive.read_file(path))
+    except libioc.errors.IocException:
+        exit(1)
+    sys.stdout.buffer.flush()
+
+
+class BackupCli(click.MultiCommand):
+    """Python Click backup subcommand boilerplate."""
+
+    def list_commands(self, ctx: click.core.Context) -> list:
+        """Mock subcommands for Python Click."""
+        return [
+            "list",
+            "stats",
+            "rm",
+            "gc",
+            "files",
+            "cat"
+        ]
+
+    def get_command(
+        self,
+        ctx: click.core.Context,
+        cmd_name: str
+    ) -> click.core.Command:
+        """Wrap subcommand for Python Click."""
+        command: typing.Optional[click.core.Command] = None
+
+        if cmd_name == "list":
+            command = cli_list
+        elif cmd_name == "stats":
+            command = cli_stats
+        elif cmd_name == "rm":
+            command = cli_rm
+        elif cmd_name == "gc":
+            command = cli_gc
+        elif cmd_name == "files":
+            command = cli_files
+        elif cmd_name == "cat":
+            command = cli_cat
+
+        if command is None:
+            raise NotImplementedError("action does not exist")
+
+        return command
+
+
+@click.group(
+    name="backup",
+    cls=BackupCli,
+    context_settings=dict(
+        ignore_unknown_options=True,
+    )
+)
+@click.pass_context
+def cli(
+    ctx: IocClickContext
+) -> None:
+    """Inspect backup archives and repositories."""
+    ctx.logger = ctx.parent.logger
+    ctx.host = ctx.parent.host
@@ -22,11 +22,22 @@
 # STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
-"""Destroy a jail from the CLI."""
+"""
+Destroy a jail from the CLI.
+
+With --defer jails are renamed to the trash dataset of their source, so
+that they are gone from the list of jails immediately. The trash datasets
+are destroyed by a background process afterwards, and the space that is
+still pending or being freed by the pool is shown with --reclaim-status.
+"""
+import time
 import click
 import typing
 
+import libzfs
+
 import libioc.errors
+import libioc.events
 import libioc.Filter
 import libioc.Jail
 import libioc.Jails
@@ -35,9 +46,30 @@ import libioc.Releases
 import libioc.Resource
 
 from .shared.click import IocClickContext
+from .shared.jail import reload_jail
+from .shared.jobs import JobPool
+from .shared.output import (
+    print_job_summary,
+    print_table,
+    to_humanreadable_size
+)
+from .shared.zfs import (
+    destroy_in_background,
+    get_freeing_sizes,
+    list_child_datasets
+)
 
 __rootcmd__ = True
 
+# child of a source that holds jails waiting to be destroyed
+TRASH_DATASET = "trash"
+
+
+class JailDeferredDestroy(libioc.events.JailEvent):
+    """Move a jail to the trash to destroy it in the background."""
+
+    pass
+
 
 @click.command(name="destroy", help="Destroy specified resource")
 @click.pass_context
@@ -57,12 +89,40 @@ __rootcmd__ = True
 )
 @click.option("--recursive", "-R", default=False, is_flag=True,
               help="Bypass the children prompt, best used with --force (-f).")
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=1,
+    help="Number of jails that are destroyed concurrently."
+)
+@click.option(
+    "--defer", "-d",
+    default=False,
+    is_flag=True,
+    help="Move jails to the trash and destroy them in the background."
+)
+@click.option(
+    "--reclaim-status",
+    default=False,
+    is_flag=True,
+    help="Show the space that is not yet reclaimed from destroyed jails."
+)
+@click.option(
+    "--reclaim",
+    default=False,
+    is_flag=True,
+    help="Destroy the jails left in the trash in the foreground."
+)
 @click.argument("filters", nargs=-1)
 def cli(
     ctx: IocClickContext,
     force: bool,
     dataset_type: typing.Optional[str],
     recursive: bool,
+    jobs: int,
+    defer: bool,
+    reclaim_status: bool,
+    reclaim: bool,
     filters: typing.Tuple[str, ...]
 ) -> None:
     """
@@ -73,6 +133,15 @@ def cli(
     """
     logger = ctx.parent.logger
 
+    if reclaim_status is True:
+        _print_reclaim_status(ctx.parent.host, logger=logger)
+        return
+
+    if reclaim is True:
+        if _reclaim(ctx.parent.host, zfs=ctx.parent.zfs, logger=logger) > 0:
+            exit(1)
+        return
+
     if filters is None or len(filters) == 0:
         logger.error("No filter specified - cannot select a target to delete")
         exit(1)
@@ -84,6 +153,9 @@ def cli(
         filters += ("template=yes",)
 
     release = (dataset_type == "release") is True
+    if (release is True) and ((defer is True) or (jobs > 1)):
+        logger.error("Releases cannot be destroyed deferred or concurrently")
+        exit(1)
 
     resources_class: typing.Union[
         typing.Type[libioc.Releases.ReleasesGenerator],
@@ -112,21 +184,168 @@ def cli(
         ) + "\nAre you sure?"
         click.confirm(message, default=False, abort=True)
 
-    failed_items = []
+    # names of the trash datasets that are destroyed in the background
+    trash_datasets: typing.List[str] = []
+    failed_items: typing.List[str] = []
+
+    if jobs > 1:
+        pool = JobPool(jobs=jobs)
+        for item in resources:
+            pool.add(item.full_name, _destroy_job(
+                item,
+                force=force,
+                defer=defer,
+                trash_datasets=trash_datasets,
+                logger=logger
+            ))
+        try:
+            ctx.parent.print_events(pool.run())
+        finally:
+            destroy_in_background(trash_datasets, logger=logger)
+        print_job_summary(pool.results)
+        for result in pool.failed:
+            if not isinstance(result.error, libioc.errors.IocException):
+                raise result.error
+        failed_items = [result.name for result in pool.failed]
+    else:
+        for item in resources:
 
-    for item in resources:
+            old_mountpoint = item.dataset.mountpoint
 
-        old_mountpoint = item.dataset.mountpoint
+            if (not release and force and item.running) is True:
+                ctx.parent.print_events(item.stop(force=True))
+                item.state.query()
 
-        if (not release and force and item.running) is True:
-            ctx.parent.print_events(item.stop(force=True))
-            item.state.query()
+            try:
+                if defer is True:
+                    ctx.parent.print_events(_defer_destroy(
+                        item,
+                        trash_datasets=trash_datasets,
+                        logger=logger
+                    ))
+                    logger.screen(f"{old_mountpoint} moved to the trash")
+                else:
+                    ctx.parent.print_events(item.destroy())
+                    logger.screen(f"{old_mountpoint} destroyed")
+            except libioc.errors.IocException:
+                failed_items.append(item.full_name)
+        destroy_in_background(trash_datasets, logger=logger)
 
-        try:
-            ctx.parent.print_events(item.destroy())
-            logger.screen(f"{old_mountpoint} destroyed")
-        except libioc.errors.IocException:
-            failed_items.append(item)
+    if len(trash_datasets) > 0:
+        logger.log(
+            f"{len(trash_datasets)} jails are destroyed in the background"
+        )
 
     if len(failed_items) > 0:
         exit(1)
+
+
+def _destroy_job(
+    jail: 'libioc.Jail.JailGenerator',
+    force: bool,
+    defer: bool,
+    trash_datasets: typing.List[str],
+    logger: 'libioc.Logger.Logger'
+) -> typing.Callable[[], typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]]:
+
+    def _destroy() -> typing.Generator[
+        typing.Union['libioc.events.IocEvent', bool],
+        None,
+        None
+    ]:
+        worker_jail = reload_jail(jail, logger=logger)
+        if (force is True) and (worker_jail.running is True):
+            yield from worker_jail.stop(force=True)
+            worker_jail.state.query()
+        if defer is True:
+            yield from _defer_destroy(
+                worker_jail,
+                trash_datasets=trash_datasets,
+                logger=logger
+            )
+        else:
+            yield from worker_jail.destroy()
+        yield True
+
+    return _destroy
+
+
+def _defer_destroy(
+    jail: 'libioc.Jail.JailGenerator',
+    trash_datasets: typing.List[str],
+    logger: 'libioc.Logger.Logger'
+) -> typing.Generator['libioc.events.IocEvent', None, None]:
+    """Rename a stopped jail to the trash dataset of its source."""
+    event = JailDeferredDestroy(jail=jail)
+    yield event.begin()
+
+    try:
+        jail.require_jail_stopped()
+        root_datasets = jail.host.datasets.find_root_datasets(
+            jail.dataset.name
+        )
+        trash_name = f"{root_datasets.root.name}/{TRASH_DATASET}"
+        jail.zfs.get_or_create_dataset(trash_name)
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        trash_dataset_name = f"{trash_name}/{jail.name}.{timestamp}"
+        jail.dataset.rename(trash_dataset_name, forceunmount=True)
+    except libzfs.ZFSException:
+        error = libioc.errors.ZFSException(
+            message=f"Moving {jail.humanreadable_name} to the trash failed",
+            logger=logger
+        )
+        yield event.fail(error)
+        raise error
+    except libioc.errors.IocException as e:
+        yield event.fail(e)
+        raise e
+
+    trash_datasets.append(trash_dataset_name)
+    yield event.end()
+
+
+def _get_trash_dataset_names(
+    host: 'libioc.Host.HostGenerator'
+) -> typing.List[str]:
+    return [
+        f"{root_datasets.root.name}/{TRASH_DATASET}"
+        for root_datasets in host.datasets.values()
+    ]
+
+
+def _print_reclaim_status(
+    host: 'libioc.Host.HostGenerator',
+    logger: 'libioc.Logger.Logger'
+) -> None:
+    """Print jails pending in the trash and the space pools are freeing."""
+    data = []
+    pool_names = set()
+    for trash_name in _get_trash_dataset_names(host):
+        pool_names.add(trash_name.split("/", maxsplit=1)[0])
+        for name, used in list_child_datasets(trash_name, logger=logger):
+            data.append([name, "pending", to_humanreadable_size(used)])
+    for pool_name, size in get_freeing_sizes(pool_names, logger).items():
+        data.append([pool_name, "freeing", to_humanreadable_size(size)])
+    print_table(data, ["name", "state", "size"])
+
+
+def _reclaim(
+    host: 'libioc.Host.HostGenerator',
+    zfs: 'libioc.ZFS.ZFS',
+    logger: 'libioc.Logger.Logger'
+) -> int:
+    """Destroy all jails in the trash and return the number of failures."""
+    failed = 0
+    for trash_name in _get_trash_dataset_names(host):
+        for name, _ in list_child_datasets(trash_name, logger=logger):
+            try:
+                zfs.delete_dataset_recursive(zfs.get_dataset(name))
+                logger.screen(f"{name} destroyed")
+            except libzfs.ZFSException:
+                logger.error(f"Failed to destroy {name}")
+                failed += 1
+    return failed
@@ -24,7 +24,9 @@
 # POSSIBILITY OF SUCH DAMAGE.
 """Export a jail from the CLI."""
 import click
-import os.path
+import os
+import sys
+import typing
 
 import libioc.errors
 import libioc.Filter
@@ -34,7 +36,11 @@ import libioc.Logger
 import libioc.Releases
 import libioc.Resource
 
+from .shared.backup import BACKUP_FORMATS, STDIO_PATH, JailBackup
+from .shared.chunks import ChunkStore
 from .shared.click import IocClickContext
+from .shared.compression import EXPORT_COMPRESSIONS
+from .shared.output import detach_stdout
 
 __rootcmd__ = True
 
@@ -49,6 +55,52 @@ __rootcmd__ = True
     is_flag=True,
     help="Exports the jails root dataset independently"
 )
+@click.option(
+    "-f", "--format", "backup_format",
+    type=click.Choice(BACKUP_FORMATS),
+    default="archive",
+    help="Export a tar archive or a ZFS replication stream"
+)
+@click.option(
+    "-i", "--incremental-from",
+    default=None,
+    help="Send a zfs-stream incrementally from a previous backup snapshot"
+)
+@click.option(
+    "--compressed-send",
+    default=False,
+    is_flag=True,
+    help="Send compressed blocks as they are stored on disk (zfs-stream)"
+)
+@click.option(
+    "--raw-send",
+    default=False,
+    is_flag=True,
+    help="Send encrypted datasets without decrypting them (zfs-stream)"
+)
+@click.option(
+    "-c", "--compression",
+    type=click.Choice(EXPORT_COMPRESSIONS),
+    default="gzip",
+    help="Compression format of the backup archive"
+)
+@click.option(
+    "-T", "--threads",
+    type=int,
+    default=None,
+    help="Number of compression threads (defaults to the number of CPUs)"
+)
+@click.option(
+    "-R", "--repository",
+    default=None,
+    help="Store the backup as destination name in a deduplicating repository"
+)
+@click.option(
+    "--seekable",
+    default=False,
+    is_flag=True,
+    help="Write a gzip archive with a file index for single-file restores"
+)
 # @click.option(
 #     "-r", "--recursive",
 #     default=False,
@@ -59,13 +111,37 @@ def cli(
     ctx: IocClickContext,
     jail: str,
     destination: str,
-    standalone: bool
+    standalone: bool,
+    backup_format: str,
+    incremental_from: typing.Optional[str],
+    compressed_send: bool,
+    raw_send: bool,
+    compression: str,
+    threads: typing.Optional[int],
+    repository: typing.Optional[str],
+    seekable: bool
 ) -> None:
     """
     Backup a jail.
 
-    The selected jail will be exported to a gzip compressed tar archive stored
-    as the destination path.
+    The selected jail will be exported to a compressed tar archive stored as
+    the destination path. By default the archive is gzip compressed on all
+    available CPUs.
+
+    With --format=zfs-stream the jail datasets are exported as ZFS
+    replication stream. The backup snapshot is kept, so that it can be used
+    with --incremental-from to only export the changes in later backups.
+
+    When the destination is '-' the backup is streamed to stdout and the
+    progress is printed to stderr.
+
+    With --repository the destination is the name of the backup in a local
+    chunk repository, in which content shared with other backups is only
+    stored once. Use `ioc backup` to inspect and clean up repositories.
+
+    Archives exported with --seekable are compressed in independent gzip
+    frames and contain an index of all files, so that `ioc backup cat` can
+    read single files without decompressing the whole archive.
     """
     logger = ctx.parent.logger
     zfs: libioc.ZFS.ZFS = ctx.parent.zfs
@@ -82,12 +158,54 @@ def cli(
         host=host
     )
 
-    if os.path.isfile(destination) is True:
+    stream = None
+    if repository is not None:
+        if destination == STDIO_PATH:
+            logger.error("Backups in a repository cannot be streamed")
+            exit(1)
+        try:
+            store = ChunkStore(repository, create=True, logger=logger)
+        except libioc.errors.IocException:
+            exit(1)
+        if store.exists(destination) is True:
+            logger.error(
+                f"The backup {destination} already exists in {store.path}"
+            )
+            exit(1)
+    elif destination == STDIO_PATH:
+        if os.isatty(sys.stdout.fileno()) is True:
+            logger.error("Refusing to write a backup to a terminal")
+            exit(1)
+        stream = detach_stdout()
+    elif os.path.isfile(destination) is True:
         logger.error(f"The destination {destination} already exists")
         exit(1)
 
+    if (backup_format != "zfs-stream") and (incremental_from is not None):
+        logger.error("Incremental exports require --format=zfs-stream")
+        exit(1)
+
+    seekable_supported = (repository is None) and (
+        (backup_format, compression,) == ("archive", "gzip",)
+    )
+    if (seekable is True) and (seekable_supported is False):
+        logger.error("Seekable exports are gzip compressed archive files")
+        exit(1)
+
     try:
-        print_events(ioc_jail.backup.export(
+        backup = JailBackup(
+            resource=ioc_jail,
+            compression=compression,
+            threads=threads,
+            backup_format=backup_format,
+            incremental_from=incremental_from,
+            send_compressed=compressed_send,
+            send_raw=raw_send,
+            stream=stream,
+            repository=repository,
+            seekable=seekable
+        )
+        print_events(backup.export(
             destination,
             standalone=standalone,
             recursive=recursive
@@ -24,17 +24,32 @@
 # POSSIBILITY OF SUCH DAMAGE.
 """Fetch releases and updates with the CLI."""
 import click
+import functools
+import os.path
 import typing
 
+import libioc.events
+import libioc.helpers
 import libioc.Host
 import libioc.Prompts
 import libioc.Release
+import libioc.ZFS
 import libioc.errors
 
 from .shared.click import IocClickContext
+from .shared.jobs import JobPool
+from .shared.sync import TreeSync
 
 __rootcmd__ = True
 
+BASEJAIL_MANIFEST_FILE = "basejail.manifest.json"
+
+
+class ReleaseBasejailUpdate(libioc.events.ReleaseEvent):
+    """CLI event that occurs when a release basejail is updated."""
+
+    pass
+
 
 @click.command(
     # context_settings=dict(max_content_width=400),
@@ -53,7 +68,14 @@ __rootcmd__ = True
 )
 @click.option(
     "--release", "-r",
-    help="The FreeBSD release to fetch."
+    multiple=True,
+    help="The FreeBSD release to fetch. Can be specified multiple times."
+)
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=None,
+    help="Number of releases that are fetched concurrently."
 )
 @click.option(
     "--update/--no-update", "-U/-NU",
@@ -93,57 +115,131 @@ def cli(  # noqa: T484
     """Fetch and update releases."""
     logger = ctx.parent.logger
     host = ctx.parent.host
-    zfs = ctx.parent.zfs
     prompts = libioc.Prompts.Prompts(host=host, logger=logger)
 
-    release_input = kwargs["release"]
-    if release_input is None:
+    release_names = kwargs["release"]
+    if len(release_names) == 0:
         try:
-            release = prompts.release()
+            releases = [prompts.release()]
         except libioc.errors.DefaultReleaseNotFound:
             exit(1)
     else:
+        releases = []
         try:
-            release = libioc.Release.ReleaseGenerator(
-                name=release_input,
-                host=host,
-                zfs=zfs,
-                logger=logger
-            )
+            for release_name in release_names:
+                # every release is fetched by its own worker thread
+                releases.append(libioc.Release.ReleaseGenerator(
+                    name=release_name,
+                    host=host,
+                    zfs=libioc.ZFS.get_zfs(logger=logger),
+                    logger=logger
+                ))
         except libioc.errors.IocException:
             exit(1)
 
     if kwargs["copy_basejail_only"] is True:
         try:
-            release.update_base_release()
+            for release in releases:
+                ctx.parent.print_events(_update_base_release(
+                    release,
+                    jobs=kwargs["jobs"],
+                    logger=logger
+                ))
             exit(0)
         except libioc.errors.IocException:
             exit(1)
 
     url_or_files_selected = False
 
-    if _is_option_enabled(kwargs, "url"):
-        release.mirror_url = kwargs["url"]
-        url_or_files_selected = True
+    for release in releases:
+        if _is_option_enabled(kwargs, "url"):
+            release.mirror_url = kwargs["url"]
+            url_or_files_selected = True
 
-    if _is_option_enabled(kwargs, "files"):
-        release.assets = list(kwargs["files"])
-        url_or_files_selected = True
+        if _is_option_enabled(kwargs, "files"):
+            release.assets = list(kwargs["files"])
+            url_or_files_selected = True
 
-    if (url_or_files_selected is False) and (release.available is False):
-        logger.error(f"The release '{release.name}' is not available")
-        exit(1)
+        if (url_or_files_selected is False) and (release.available is False):
+            logger.error(f"The release '{release.name}' is not available")
+            exit(1)
 
+    update = bool(kwargs["update"])
     fetch_updates = bool(kwargs["fetch_updates"])
-    try:
-        ctx.parent.print_events(release.fetch(
-            update=kwargs["update"],
+    pool = JobPool(jobs=kwargs["jobs"])
+    for release in releases:
+        pool.add(release.name, functools.partial(
+            release.fetch,
+            update=update,
             fetch_updates=fetch_updates
         ))
+
+    try:
+        ctx.parent.print_events(pool.run())
     except libioc.errors.IocException:
         exit(1)
 
-    exit(0)
+    for result in pool.failed:
+        if not isinstance(result.error, libioc.errors.IocException):
+            raise result.error
+        logger.error(f"Fetching release {result.name} failed")
+
+    exit(1 if (len(pool.failed) > 0) else 0)
+
+
+def _update_base_release(
+    release: libioc.Release.ReleaseGenerator,
+    jobs: typing.Optional[int],
+    logger: 'libioc.Logger.Logger'
+) -> typing.Generator['libioc.events.IocEvent', None, None]:
+    """
+    Incrementally copy a releases root dataset to its basejail datasets.
+
+    The first run copies the basejail with libioc and records a manifest of
+    the release, so that subsequent runs only copy the changed files.
+    """
+    event = ReleaseBasejailUpdate(release=release)
+    yield event.begin()
+
+    try:
+        base_dataset_name = release.base_dataset_name
+        release.zfs.get_or_create_dataset(base_dataset_name)
+        basedirs = libioc.helpers.get_basedir_list(
+            distribution_name=release.host.distribution.name
+        )
+        for folder in basedirs:
+            release.zfs.get_or_create_dataset(f"{base_dataset_name}/{folder}")
+
+        tree_sync = TreeSync(
+            source=release.root_dataset.mountpoint,
+            destination=release.base_dataset.mountpoint,
+            manifest_file=os.path.join(
+                release.dataset.mountpoint,
+                BASEJAIL_MANIFEST_FILE
+            ),
+            jobs=jobs,
+            logger=logger
+        )
+
+        if tree_sync.has_manifest is False:
+            yield event.step("Copying the full basejail")
+            release.update_base_release()
+            stats = tree_sync.build_manifest()
+            message = f"{stats.hashed} files recorded in the manifest"
+        else:
+            stats = tree_sync.sync()
+            message = str(stats)
+    except libioc.errors.IocException as e:
+        yield event.fail(e)
+        raise e
+    except OSError as e:
+        yield event.fail(e)
+        raise libioc.errors.IocException(
+            message=f"Updating the basejail failed: {e}",
+            logger=logger
+        )
+
+    yield event.end(message)
 
 
 def _is_option_enabled(args: typing.Dict[str, typing.Any], name: str) -> bool:
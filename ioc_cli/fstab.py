@@ -37,6 +37,11 @@ import libioc.Config.Jail.File.Fstab
 
 from .shared.jail import get_jail
 from .shared.click import IocClickContext
+from .shared.fstab import (
+    FstabReconciliation,
+    get_current_mounts,
+    get_desired_mounts
+)
 
 __rootcmd__ = True
 FstabLine = libioc.Config.Jail.File.Fstab.FstabLine
@@ -64,6 +69,50 @@ def _get_abspath(path: str, jail: libioc.Jail.JailGenerator) -> str:
     )
 
 
+def _save_fstab(fstab: 'libioc.Config.Jail.File.Fstab.Fstab') -> None:
+    """Replace the fstab file at once, so that it is never half written."""
+    temporary_path = f"{fstab.path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "w") as f:
+            f.write(str(fstab))
+        os.rename(temporary_path, fstab.path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    fstab.logger.verbose(f"{fstab.path} written")
+
+
+def _apply_fstab(
+    ioc_jail: libioc.Jail.JailGenerator,
+    dry_run: bool=False,
+    force: bool=False
+) -> None:
+    """Mount and unmount the changes of the fstab in a running jail."""
+    logger = ioc_jail.logger
+    if ioc_jail.running is False:
+        logger.log(f"{ioc_jail.humanreadable_name} is not running")
+        return
+
+    fstab = ioc_jail.fstab
+    fstab.read_file()
+    reconciliation = FstabReconciliation(
+        desired=get_desired_mounts(fstab),
+        current=get_current_mounts(ioc_jail.root_path, logger=logger),
+        logger=logger
+    )
+    if reconciliation.changed is False:
+        logger.log("fstab mounts are up to date")
+        return
+
+    for entry in reconciliation.unmount:
+        logger.log(f"fstab mount removed: {entry}")
+    for entry in reconciliation.mount:
+        logger.log(f"fstab mount added: {entry}")
+    if dry_run is False:
+        reconciliation.apply(force=force)
+
+
 @click.command(
     name="add"
 )
@@ -110,6 +159,19 @@ def _get_abspath(path: str, jail: libioc.Jail.JailGenerator) -> str:
     required=False,
     help="Add a comment to the fstab line."
 )
+@click.option(
+    "--mount", "-m",
+    "mounts",
+    multiple=True,
+    help="Add another SOURCE[:DESTINATION] line with the same options."
+)
+@click.option(
+    "--apply", "-a",
+    "apply",
+    is_flag=True,
+    default=False,
+    help="Mount the added lines when the jail is running."
+)
 def cli_add(
     ctx: IocClickContext,
     source: str,
@@ -119,7 +181,9 @@ def cli_add(
     vfstype: str,
     freq: int,
     passno: int,
-    comment: typing.Optional[str]
+    comment: typing.Optional[str],
+    mounts: typing.Tuple[str, ...],
+    apply: bool
 ) -> None:
     """Add lines to a jails fstab file."""
     ioc_jail = get_jail(jail, ctx.parent)
@@ -129,57 +193,71 @@ def cli_add(
     else:
         desination_path = destination[0]
 
-    try:
-        source = libioc.Types.AbsolutePath(source)
-        if os.path.exists(source) is False:
-            ctx.parent.logger.error(
-                f"The mount source {source} is does not exist"
-            )
-            exit(1)
-
-        if os.path.isdir(source) is False:
-            ctx.parent.logger.error(
-                f"The mount source {source} is not a directory"
-            )
-            exit(1)
-        ctx.parent.logger.spam("mount source is an absolute path that exists")
-    except:
-        ctx.parent.logger.spam("mount source is not an absolute path")
-
+    lines = [(source, desination_path,)]
+    for mount in mounts:
+        mount_source, _, mount_destination = mount.partition(":")
+        lines.append((mount_source, mount_destination or mount_source,))
 
     try:
-        desination_path = _get_abspath(desination_path, ioc_jail)
-
         fstab = ioc_jail.fstab
         fstab.read_file()
-        fstab.new_line(
-            source=source,
-            destination=desination_path,
-            type=vfstype,
-            options=mntops,
-            freq=int(freq),
-            passno=int(passno),
-            comment=comment
-        )
-
-        # ensure destination directory exists
-        try:
-            os.makedirs(desination_path)
-        except OSError as exc:  # Python >2.5
-            if exc.errno == errno.EEXIST and os.path.isdir(desination_path):
-                pass
-            else:
-                raise
+        added_lines = []
+        for line_source, line_destination in lines:
+            line_source = _check_mount_source(line_source, ctx.parent.logger)
+            line_destination = _get_abspath(line_destination, ioc_jail)
+            fstab.new_line(
+                source=line_source,
+                destination=line_destination,
+                type=vfstype,
+                options=mntops,
+                freq=int(freq),
+                passno=int(passno),
+                comment=comment
+            )
 
-        fstab.save()
-        ctx.parent.logger.log(
-            f"fstab mount added: {source} -> {desination_path} ({mntops})"
-        )
+            # ensure destination directory exists
+            try:
+                os.makedirs(line_destination)
+            except OSError as exc:  # Python >2.5
+                exists = os.path.isdir(line_destination)
+                if exc.errno == errno.EEXIST and exists:
+                    pass
+                else:
+                    raise
+            added_lines.append((line_source, line_destination,))
+
+        _save_fstab(fstab)
+        for line_source, line_destination in added_lines:
+            ctx.parent.logger.log(
+                f"fstab mount added: {line_source} -> {line_destination} "
+                f"({mntops})"
+            )
+        if apply is True:
+            _apply_fstab(ioc_jail)
         exit(0)
     except libioc.errors.IocException:
         exit(1)
 
 
+def _check_mount_source(
+    source: str,
+    logger: libioc.Logger.Logger
+) -> str:
+    try:
+        source = libioc.Types.AbsolutePath(source)
+        if os.path.exists(source) is False:
+            logger.error(f"The mount source {source} is does not exist")
+            exit(1)
+
+        if os.path.isdir(source) is False:
+            logger.error(f"The mount source {source} is not a directory")
+            exit(1)
+        logger.spam("mount source is an absolute path that exists")
+    except TypeError:
+        logger.spam("mount source is not an absolute path")
+    return source
+
+
 @click.command(
     name="show"
 )
@@ -197,38 +275,103 @@ def cli_show(ctx: IocClickContext, jail: str) -> None:
     name="rm"
 )
 @click.argument(
-    "source",
-    nargs=1,
+    "sources",
+    nargs=-1,
     required=False
 )
 @click.argument("jail", nargs=1, required=True)
+@click.option(
+    "--apply", "-a",
+    "apply",
+    is_flag=True,
+    default=False,
+    help="Unmount the removed lines when the jail is running."
+)
 @click.pass_context
-def cli_rm(ctx: IocClickContext, source: str, jail: str) -> None:
-    """Remove a line from a jails fstab file."""
+def cli_rm(
+    ctx: IocClickContext,
+    sources: typing.Tuple[str, ...],
+    jail: str,
+    apply: bool
+) -> None:
+    """Remove lines from a jails fstab file."""
     ioc_jail = get_jail(jail, ctx.parent)
     fstab = ioc_jail.fstab
-    destination = None
-    i = 0
+    removed_lines = []
 
     try:
         fstab.read_file()
-        for existing_line in fstab:
-            i += 1
-            if isinstance(existing_line, FstabLine) is False:
-                continue
-            if existing_line["source"] == source:
-                destination = fstab[i - 1]["destination"]
-                del fstab[i - 1]
-                fstab.save()
-                break
+        for source in sources:
+            i = 0
+            for existing_line in fstab:
+                i += 1
+                if isinstance(existing_line, FstabLine) is False:
+                    continue
+                if existing_line["source"] == source:
+                    destination = fstab[i - 1]["destination"]
+                    del fstab[i - 1]
+                    removed_lines.append((source, destination,))
+                    break
+            else:
+                ctx.parent.logger.error(
+                    f"no matching fstab line found: {source}"
+                )
+                exit(1)
+        if len(removed_lines) > 0:
+            _save_fstab(fstab)
     except libioc.errors.IocException:
         exit(1)
 
-    if destination is None:
+    if len(removed_lines) == 0:
         ctx.parent.logger.error("no matching fstab line found")
         exit(1)
 
-    ctx.parent.logger.log(f"fstab mount removed: {source} -> {destination}")
+    for source, destination in removed_lines:
+        ctx.parent.logger.log(
+            f"fstab mount removed: {source} -> {destination}"
+        )
+
+    if apply is True:
+        try:
+            _apply_fstab(ioc_jail)
+        except libioc.errors.IocException:
+            exit(1)
+
+
+@click.command(
+    name="apply"
+)
+@click.pass_context
+@click.argument("jail", nargs=1, required=True)
+@click.option(
+    "--dry-run", "-n",
+    is_flag=True,
+    default=False,
+    help="Only show the mounts that would be changed."
+)
+@click.option(
+    "--force", "-f",
+    is_flag=True,
+    default=False,
+    help="Forcibly unmount busy filesystems."
+)
+def cli_apply(
+    ctx: IocClickContext,
+    jail: str,
+    dry_run: bool,
+    force: bool
+) -> None:
+    """
+    Apply fstab changes to a running jail.
+
+    The fstab is compared with the filesystems that are currently mounted
+    in the jail, so that only changed lines are mounted or unmounted.
+    """
+    ioc_jail = get_jail(jail, ctx.parent)
+    try:
+        _apply_fstab(ioc_jail, dry_run=dry_run, force=force)
+    except libioc.errors.IocException:
+        exit(1)
 
 
 class FstabCli(click.MultiCommand):
@@ -239,7 +382,8 @@ class FstabCli(click.MultiCommand):
         return [
             "show",
             "add",
-            "rm"
+            "rm",
+            "apply"
         ]
 
     def get_command(
@@ -256,6 +400,8 @@ class FstabCli(click.MultiCommand):
             command = cli_add
         elif cmd_name == "rm":
             command = cli_rm
+        elif cmd_name == "apply":
+            command = cli_apply
 
         if command is None:
             raise NotImplementedError("action does not exist")
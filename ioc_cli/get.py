@@ -32,6 +32,7 @@ import libioc.Jail
 import libioc.Logger
 
 from .shared.click import IocClickContext
+from .shared.config import resolved_configs
 
 
 @click.command(
@@ -103,10 +104,11 @@ def cli(
             logger.error(f"Unknown property '{_prop}'")
             exit(1)
 
-    for key in source_resource.config.all_properties:
+    config = source_resource.config
+    resolved = resolved_configs.resolve(config)
+    for key in resolved.keys():
         if (_prop is None) or (key == _prop):
-            value = source_resource.config.get_string(key)
-            _print_property(key, value)
+            _print_property(key, config.stringify(resolved[key]))
 
 
 def _print_property(key: str, value: str) -> None:
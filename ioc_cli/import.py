@@ -24,12 +24,16 @@
 # POSSIBILITY OF SUCH DAMAGE.
 """Export a jail from the CLI."""
 import click
+import os
+import sys
+import typing
 
 import libioc.errors
 import libioc.Jail
 import libioc.Host
 import libioc.ZFS
 
+from .shared.backup import STDIO_PATH, JailBackup
 from .shared.click import IocClickContext
 
 __rootcmd__ = True
@@ -39,30 +43,78 @@ __rootcmd__ = True
 @click.pass_context
 @click.argument("jail", required=True)
 @click.argument("source", required=True)
+@click.option(
+    "-i", "--incremental",
+    default=False,
+    is_flag=True,
+    help="Apply an incremental ZFS stream to an existing jail"
+)
+@click.option(
+    "-R", "--repository",
+    default=None,
+    help="Restore the backup named source from a deduplicating repository"
+)
 def cli(
     ctx: IocClickContext,
     jail: str,
-    source: str
+    source: str,
+    incremental: bool,
+    repository: typing.Optional[str]
 ) -> None:
-    """Restore a jail from a backup archive."""
+    """
+    Restore a jail from a backup archive or ZFS stream.
+
+    The format and compression of the backup are detected automatically.
+    When the source is '-' the backup is read from stdin. With --repository
+    the source is the name of a backup in a chunk repository.
+    """
     logger = ctx.parent.logger
     zfs: libioc.ZFS.ZFS = ctx.parent.zfs
     host: libioc.Host.HostGenerator = ctx.parent.host
     print_events = ctx.parent.print_events
 
-    ioc_jail = libioc.Jail.JailGenerator(
-        dict(name=jail),
-        logger=logger,
-        zfs=zfs,
-        host=host,
-        new=True
-    )
-
-    if ioc_jail.exists is True:
-        logger.error(f"The jail {jail} already exists")
+    stream = None
+    if (repository is not None) and (source == STDIO_PATH):
+        logger.error("Backups in a repository cannot be streamed")
         exit(1)
+    elif source == STDIO_PATH:
+        if os.isatty(sys.stdin.fileno()) is True:
+            logger.error("Refusing to read a backup from a terminal")
+            exit(1)
+        stream = sys.stdin.buffer
+
+    if incremental is True:
+        try:
+            ioc_jail = libioc.Jail.JailGenerator(
+                jail,
+                logger=logger,
+                zfs=zfs,
+                host=host
+            )
+        except libioc.errors.IocException:
+            exit(1)
+        if ioc_jail.running is True:
+            logger.error(f"The jail {jail} needs to be stopped")
+            exit(1)
+    else:
+        ioc_jail = libioc.Jail.JailGenerator(
+            dict(name=jail),
+            logger=logger,
+            zfs=zfs,
+            host=host,
+            new=True
+        )
+
+        if ioc_jail.exists is True:
+            logger.error(f"The jail {jail} already exists")
+            exit(1)
 
     try:
-        print_events(ioc_jail.backup.restore(source))
+        backup = JailBackup(
+            resource=ioc_jail,
+            stream=stream,
+            repository=repository
+        )
+        print_events(backup.restore(source, incremental=incremental))
     except libioc.errors.IocException:
         exit(1)
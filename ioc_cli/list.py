@@ -33,9 +33,11 @@ import libioc.Host
 import libioc.Datasets
 import libioc.Resource
 import libioc.ListableResource
+import libioc.Jail
 import libioc.Jails
 import libioc.Releases
 
+from .shared.config import get_resolved_string, resolved_configs
 from .shared.output import print_table
 from .shared.click import IocClickContext
 
@@ -240,7 +242,14 @@ def _lookup_resource_values(
     is_resorce = isinstance(resource, libioc.Resource.Resource)
 
     try:
-        if is_resorce and ("getstring" in resource.__dir__()):
+        if isinstance(resource, libioc.Jail.JailGenerator):
+            jail = resource
+            resolved = resolved_configs.resolve(jail.config)
+            return list(map(
+                lambda column: get_resolved_string(jail, column, resolved),
+                columns
+            ))
+        elif is_resorce and ("getstring" in resource.__dir__()):
             _resource = resource  # type: libioc.Resource.Resource
             return list(map(
                 lambda column: str(_resource.getstring(column)),
@@ -21,20 +21,39 @@
 # STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
-"""Migrate jails to the latest format (python-iocage)."""
+"""
+Migrate jails to the latest format (python-iocage).
+
+Legacy jails store their configuration in ZFS properties or UCL files. By
+default they are converted in place: the configuration is written to a JSON
+file in the jail dataset and the jail is renamed to its tag, so that no data
+is copied. With --clone the previous behavior of cloning each legacy jail
+into a new jail and destroying the original is used instead.
+"""
+import os
 import typing
 import click
 
+import libzfs
+
 import libioc.events
 import libioc.errors
 import libioc.helpers
+import libioc.Host
+import libioc.Jail
 import libioc.Jails
 import libioc.Logger
+import libioc.ZFS
 
 from .shared.click import IocClickContext
+from .shared.jail import reload_jail
+from .shared.jobs import JobPool
+from .shared.output import print_job_summary
 
 __rootcmd__ = True
 
+LEGACY_PROPERTY_PREFIX = "org.freebsd.iocage:"
+
 
 class JailMigrationEvent(libioc.events.IocEvent):
     """CLI event that occurs when a jail is migrated from legacy format."""
@@ -49,12 +68,26 @@ class JailMigrationEvent(libioc.events.IocEvent):
 
 @click.command(name="migrate", help="Migrate jails to the latest format.")
 @click.pass_context
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=1,
+    help="Number of jails that are migrated concurrently."
+)
+@click.option(
+    "--clone",
+    is_flag=True,
+    default=False,
+    help="Clone legacy jails into new jails instead of converting in place."
+)
 @click.argument("jails", nargs=-1)
 def cli(
     ctx: IocClickContext,
+    jobs: int,
+    clone: bool,
     jails: typing.Tuple[str, ...]
 ) -> None:
-    """Start one or many jails."""
+    """Migrate one or many jails."""
     logger = ctx.parent.logger
     zfs = libioc.ZFS.get_zfs(logger=logger)
     host = libioc.Host.HostGenerator(logger=logger, zfs=zfs)
@@ -69,92 +102,264 @@ def cli(
     )
 
     if len(ioc_jails) == 0:
-        logger.error(f"No jails started your input: {jails}")
+        logger.error(f"No jails matched your input: {jails}")
         exit(1)
 
+    if jobs > 1:
+        if _migrate_jails_concurrently(
+            list(ioc_jails),
+            jobs=jobs,
+            clone=clone,
+            logger=logger,
+            print_function=ctx.parent.print_events
+        ) is False:
+            exit(1)
+        return
+
     ctx.parent.print_events(_migrate_jails(
         ioc_jails,
-        logger=logger,
-        zfs=zfs,
-        host=host
+        clone=clone,
+        logger=logger
     ))
 
 
 def _migrate_jails(
     jails: 'libioc.Jails.JailsGenerator',
-    logger: 'libioc.Logger.Logger',
-    host: 'libioc.Host.HostGenerator',
-    zfs: 'libioc.ZFS.ZFS'
+    clone: bool,
+    logger: 'libioc.Logger.Logger'
 ) -> typing.Generator['libioc.events.IocEvent', None, None]:
 
     for jail in jails:
+        try:
+            for event in _migrate_jail(jail, clone=clone, logger=logger):
+                if isinstance(event, bool) is False:
+                    yield event
+        except libioc.errors.IocException:
+            continue
 
-        event = JailMigrationEvent(jail=jail)
-        yield event.begin()
 
-        if jail.config.legacy is False:
-            yield event.skip()
-            continue
+def _migrate_jails_concurrently(
+    jails: typing.List['libioc.Jail.JailGenerator'],
+    jobs: int,
+    clone: bool,
+    logger: 'libioc.Logger.Logger',
+    print_function: typing.Callable[
+        [typing.Generator['libioc.events.IocEvent', None, None]],
+        typing.Optional[bool]
+    ]
+) -> bool:
+
+    pool = JobPool(jobs=jobs)
+    for jail in jails:
+        pool.add(jail.full_name, _migrate_job(
+            jail,
+            clone=clone,
+            logger=logger
+        ))
+
+    try:
+        print_function(pool.run())
+    except libioc.errors.IocException:
+        return False
+
+    print_job_summary(pool.results)
+
+    for result in pool.failed:
+        if not isinstance(result.error, libioc.errors.IocException):
+            raise result.error
+
+    return len(pool.failed) == 0
+
+
+def _migrate_job(
+    jail: 'libioc.Jail.JailGenerator',
+    clone: bool,
+    logger: 'libioc.Logger.Logger'
+) -> typing.Callable[[], typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]]:
+
+    def _migrate() -> typing.Generator[
+        typing.Union['libioc.events.IocEvent', bool],
+        None,
+        None
+    ]:
+        worker_jail = reload_jail(jail, logger=logger)
+        yield from _migrate_jail(worker_jail, clone=clone, logger=logger)
+
+    return _migrate
+
+
+def _migrate_jail(
+    jail: 'libioc.Jail.JailGenerator',
+    clone: bool,
+    logger: 'libioc.Logger.Logger'
+) -> typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]:
+    """
+    Migrate a single jail and finally yield whether it was changed.
+
+    A failed migration is rolled back and the error is raised after the
+    failure event was emitted.
+    """
+    event = JailMigrationEvent(jail=jail)
+    yield event.begin()
+
+    if jail.config.legacy is False:
+        yield event.skip()
+        yield False
+        return
 
-        if jail.running is True:
-            yield event.fail(libioc.errors.JailAlreadyRunning(
-                jail=jail,
+    if jail.running is True:
+        error = libioc.errors.JailAlreadyRunning(jail=jail, logger=logger)
+        yield event.fail(error)
+        raise error
+
+    if clone is True:
+        migration = _clone_legacy_jail(jail, event=event, logger=logger)
+    else:
+        migration = _convert_legacy_jail(jail, event=event, logger=logger)
+
+    try:
+        yield from migration
+    except libioc.errors.IocException as e:
+        yield event.fail(e)
+        raise e
+
+    yield event.end()
+    yield True
+
+
+def _get_target_name(jail: 'libioc.Jail.JailGenerator') -> str:
+    if libioc.helpers.validate_name(jail.config["tag"]):
+        return str(jail.config["tag"])
+    return str(jail.humanreadable_name)
+
+
+def _convert_legacy_jail(
+    jail: 'libioc.Jail.JailGenerator',
+    event: JailMigrationEvent,
+    logger: 'libioc.Logger.Logger'
+) -> typing.Generator['libioc.events.IocEvent', None, None]:
+    """Rewrite the configuration and rename the jail dataset in place."""
+    name = _get_target_name(jail)
+    if name != jail.name:
+        target_jail = libioc.Jail.JailGenerator(
+            dict(name=name),
+            root_datasets_name=jail.root_datasets_name,
+            new=True,
+            logger=logger,
+            zfs=jail.zfs,
+            host=jail.host
+        )
+        if target_jail.exists is True:
+            raise libioc.errors.JailAlreadyExists(
+                jail=target_jail,
                 logger=logger
-            ))
-            continue
+            )
+
+    legacy_config_type = jail.config_type
+    jail.config.legacy = False
+    jail.config_type = "json"
+
+    def _revert_config() -> None:
+        config_file = jail.config_json.file
+        logger.verbose(f"Removing unfinished migration config {config_file}")
+        if os.path.isfile(config_file) is True:
+            os.remove(config_file)
+        jail.config_type = legacy_config_type
+        jail.config.legacy = True
+    event.add_rollback_step(_revert_config)
+    # a partially written config is removed as well
+    jail.save()
 
-        if libioc.helpers.validate_name(jail.config["tag"]):
-            name = jail.config["tag"]
-            temporary_name = name
-        else:
-            name = jail.humanreadable_name
-            temporary_name = "import-" + str(hash(name) % (1 << 32))
+    if name != jail.name:
+        legacy_name = jail.name
+        yield from jail.rename(name, event_scope=event.scope)
 
+        def _revert_rename() -> typing.Generator[
+            'libioc.events.IocEvent',
+            None,
+            None
+        ]:
+            logger.verbose(f"Renaming jail {name} back to {legacy_name}")
+            yield from jail.rename(legacy_name, event_scope=event.scope)
+        event.add_rollback_step(_revert_rename)
+
+    # the JSON config takes precedence, so that stale properties are harmless
+    for property_name in list(jail.dataset.properties.keys()):
+        if property_name.startswith(LEGACY_PROPERTY_PREFIX) is False:
+            continue
         try:
-            new_jail = libioc.Jail.JailGenerator(
-                dict(name=temporary_name),
-                root_datasets_name=jail.root_datasets_name,
-                new=True,
-                logger=logger,
-                zfs=zfs,
-                host=host
-            )
-            if new_jail.exists is True:
-                raise libioc.errors.JailAlreadyExists(
-                    jail=new_jail,
-                    logger=logger
-                )
-
-            def _destroy_unclean_migration() -> typing.Generator[
-                'libioc.events.IocEvents',
-                None,
-                None
-            ]:
-                _name = new_jail.humanreadable_name
-                logger.verbose(
-                    f"Destroying unfinished migration target jail {_name}"
-                )
-                yield from new_jail.destroy(
-                    force=True,
-                    event_scope=event.scope
-                )
-            event.add_rollback_step(_destroy_unclean_migration)
-
-            yield from new_jail.clone_from_jail(jail, event_scope=event.scope)
-            new_jail.save()
-            new_jail.promote()
-            yield from jail.destroy(
-                force=True,
-                force_stop=True,
-                event_scope=event.scope
+            jail.dataset.properties[property_name].inherit()
+        except libzfs.ZFSException:
+            logger.warn(
+                f"Failed to remove legacy property {property_name} "
+                f"from {jail.dataset.name}"
             )
 
-        except libioc.errors.IocException as e:
-            yield event.fail(e)
-            continue
 
-        if name != temporary_name:
-            # the jail takes the old jails name
-            yield from new_jail.rename(name, event_scope=event.scope)
+def _clone_legacy_jail(
+    jail: 'libioc.Jail.JailGenerator',
+    event: JailMigrationEvent,
+    logger: 'libioc.Logger.Logger'
+) -> typing.Generator['libioc.events.IocEvent', None, None]:
+    """Clone the legacy jail into a new jail and destroy the original."""
+    name = _get_target_name(jail)
+    if name == jail.config["tag"]:
+        temporary_name = name
+    else:
+        temporary_name = "import-" + str(hash(name) % (1 << 32))
+
+    new_jail = libioc.Jail.JailGenerator(
+        dict(name=temporary_name),
+        root_datasets_name=jail.root_datasets_name,
+        new=True,
+        logger=logger,
+        zfs=jail.zfs,
+        host=jail.host
+    )
+    if new_jail.exists is True:
+        raise libioc.errors.JailAlreadyExists(
+            jail=new_jail,
+            logger=logger
+        )
+
+    # once the original jail is gone the clone must not be rolled back
+    source_destroyed = False
+
+    def _destroy_unclean_migration() -> typing.Generator[
+        'libioc.events.IocEvents',
+        None,
+        None
+    ]:
+        if source_destroyed is True:
+            return
+        _name = new_jail.humanreadable_name
+        logger.verbose(
+            f"Destroying unfinished migration target jail {_name}"
+        )
+        yield from new_jail.destroy(
+            force=True,
+            event_scope=event.scope
+        )
+    event.add_rollback_step(_destroy_unclean_migration)
+
+    yield from new_jail.clone_from_jail(jail, event_scope=event.scope)
+    new_jail.save()
+    new_jail.promote()
+    yield from jail.destroy(
+        force=True,
+        force_stop=True,
+        event_scope=event.scope
+    )
+    source_destroyed = True
 
-        yield event.end()
+    if name != temporary_name:
+        # the jail takes the old jails name
+        yield from new_jail.rename(name, event_scope=event.scope)
@@ -0,0 +1,123 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Move a jail to another root dataset source."""
+import click
+
+import libioc.errors
+import libioc.Host
+import libioc.Jail
+import libioc.ZFS
+
+from .shared.click import IocClickContext
+from .shared.relocation import (
+    PRECOPY_ROUNDS,
+    PRECOPY_THRESHOLD,
+    JailRelocation
+)
+
+__rootcmd__ = True
+
+
+@click.command(name="move", help="Move a jail to another source.")
+@click.pass_context
+@click.argument("jail", nargs=1, required=True)
+@click.argument("source", nargs=1, required=True)
+@click.option(
+    "--keep-source",
+    is_flag=True,
+    default=False,
+    help="Keep the datasets of the jail in its previous source."
+)
+@click.option(
+    "--live",
+    is_flag=True,
+    default=False,
+    help="Copy a running jail and only stop it for the final increment."
+)
+@click.option(
+    "--precopy-threshold",
+    type=int,
+    default=PRECOPY_THRESHOLD // 1024 // 1024,
+    help="MiB of changes that are small enough to stop a live jail."
+)
+@click.option(
+    "--precopy-rounds",
+    type=int,
+    default=PRECOPY_ROUNDS,
+    help="Maximum number of transfers while a live jail is running."
+)
+def cli(
+    ctx: IocClickContext,
+    jail: str,
+    source: str,
+    keep_source: bool,
+    live: bool,
+    precopy_threshold: int,
+    precopy_rounds: int
+) -> None:
+    """
+    Move a jail to another root dataset source.
+
+    Jails on other pools are transferred with ZFS send and receive. An
+    interrupted move continues where it stopped when it is started again.
+    With --live a running jail is copied incrementally while it keeps
+    running and is only stopped to transfer the last changes.
+    """
+    logger = ctx.parent.logger
+    zfs: libioc.ZFS.ZFS = ctx.parent.zfs
+    host: libioc.Host.HostGenerator = ctx.parent.host
+
+    if source not in host.datasets.keys():
+        logger.error(f"The source {source} does not exist")
+        exit(1)
+
+    try:
+        ioc_jail = libioc.Jail.JailGenerator(
+            jail,
+            logger=logger,
+            zfs=zfs,
+            host=host
+        )
+    except libioc.errors.IocException:
+        exit(1)
+
+    if ioc_jail.source == source:
+        logger.error(f"The jail {jail} already is in the source {source}")
+        exit(1)
+
+    relocation = JailRelocation(ioc_jail, target_source=source, logger=logger)
+    try:
+        ctx.parent.print_events(relocation.relocate(
+            keep_source=keep_source,
+            live=live,
+            precopy_threshold=precopy_threshold * 1024 * 1024,
+            precopy_rounds=precopy_rounds
+        ))
+    except libioc.errors.IocException:
+        exit(1)
+
+    if relocation.downtime is not None:
+        downtime = round(relocation.downtime, 3)
+        logger.log(f"The jail {jail} was stopped for {downtime}s")
@@ -23,18 +23,36 @@
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 """Jail package management subcommand for the CLI."""
+import contextlib
+import csv
+import json
+import math
+import sys
 import typing
 import click
 
 import libioc.Jail
-import libioc.Pkg
+import libioc.Jails
 import libioc.Logger
 import libioc.errors
 
 from .shared.click import IocClickContext
+from .shared.jail import reload_jail
+from .shared.jobs import JobPool
+from .shared.output import print_job_summary
+from .shared.pkg import CACHE_SIZE_LIMIT, SharedPkg
+from .shared.pkgdb import (
+    DEFAULT_VULNXML,
+    PkgDatabaseError,
+    VulnerabilityDatabase,
+    compare_versions,
+    iter_inventories
+)
+
+OUTPUT_FORMATS = ("csv", "json",)
 
 
-@click.command(name="pkg", help="Manage packages in a jail.")
+@click.command(name="install", help="Install or remove packages in jails.")
 @click.pass_context
 @click.option(
     "--remove", "-r",
@@ -43,44 +61,423 @@ from .shared.click import IocClickContext
     default=False,
     help="Remove the packages instead of installing/updating them."
 )
+@click.option(
+    "--cache-limit", "-c",
+    type=int,
+    default=CACHE_SIZE_LIMIT,
+    help=(
+        "Prune the shared package mirror to this size in MiB after "
+        "installing (0 disables pruning)."
+    )
+)
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=None,
+    help="Number of jails that packages are managed in concurrently."
+)
 @click.argument("jail")
 @click.argument("packages", nargs=-1)
-def cli(
+def cli_install(
     ctx: IocClickContext,
     remove: bool,
+    cache_limit: int,
+    jobs: typing.Optional[int],
     jail: str,
     packages: typing.Tuple[str, ...]
 ) -> None:
-    """Manage packages within jails using an offline mirror."""
+    """
+    Manage packages within jails using an offline mirror.
+
+    The jail argument is a filter, such as a name, a glob or properties
+    like 'release=12.0-RELEASE', so that packages are rolled out to many
+    jails at once. The mirror is shared by all jails of a release major
+    version, prepared once and mounted read-only into each jail during the
+    installation. Package versions that are mirrored already are not
+    fetched again.
+    """
     logger = ctx.parent.logger
+    print_events = ctx.parent.print_events
+
+    ioc_jails = list(libioc.Jails.JailsGenerator(
+        filters=(jail,),
+        logger=logger,
+        zfs=ctx.parent.zfs,
+        host=ctx.parent.host
+    ))
+
+    if len(ioc_jails) == 0:
+        logger.error(f"No jail matched your input: {jail}")
+        exit(1)
+
+    pkg = SharedPkg(
+        logger=logger,
+        zfs=ctx.parent.zfs,
+        host=ctx.parent.host
+    )
+
+    # one release of each major version the mirror is prepared for
+    releases: typing.Dict[int, 'libioc.Release.ReleaseGenerator'] = {}
+    if remove is False:
+        for ioc_jail in ioc_jails:
+            release = ioc_jail.release
+            releases.setdefault(math.floor(release.version_number), release)
+
+    # keep other processes from pruning between the fetch and the installs
+    with contextlib.ExitStack() as mirror_locks:
+        for release in releases.values():
+            mirror_locks.enter_context(pkg.lock_installs(release))
+
+        try:
+            for release in releases.values():
+                print_events(pkg.fetch(
+                    packages=list(packages),
+                    release=release
+                ))
+        except libioc.errors.IocException:
+            exit(1)
+
+        pool = JobPool(jobs=jobs)
+        for ioc_jail in ioc_jails:
+            pool.add(ioc_jail.full_name, _pkg_job(
+                ioc_jail,
+                packages=list(packages),
+                remove=remove,
+                logger=logger
+            ))
+        print_events(pool.run())
 
     try:
-        ioc_jail = libioc.Jail.JailGenerator(
-            jail,
-            logger=logger,
-            zfs=ctx.parent.zfs,
-            host=ctx.parent.host
+        if cache_limit > 0:
+            for release in releases.values():
+                pkg.prune(
+                    release=release,
+                    size_limit=cache_limit * 1024 * 1024
+                )
+    except libioc.errors.IocException:
+        exit(1)
+
+    if len(ioc_jails) > 1:
+        print_job_summary(pool.results)
+        failed_count = len(pool.failed)
+        logger.screen(
+            f"{len(pool.results) - failed_count} jails succeeded, "
+            f"{failed_count} failed"
         )
-    except libioc.errors.JailNotFound:
+
+    for result in pool.failed:
+        if not isinstance(result.error, libioc.errors.IocException):
+            raise result.error
+
+    if len(pool.failed) > 0:
         exit(1)
 
-    try:
-        pkg = libioc.Pkg.Pkg(
+
+def _pkg_job(
+    jail: 'libioc.Jail.JailGenerator',
+    packages: typing.List[str],
+    remove: bool,
+    logger: libioc.Logger.Logger
+) -> typing.Callable[[], typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]]:
+
+    def _pkg() -> typing.Generator[
+        typing.Union['libioc.events.IocEvent', bool],
+        None,
+        None
+    ]:
+        worker_jail = reload_jail(jail, logger=logger)
+        pkg = SharedPkg(
             logger=logger,
-            zfs=ctx.parent.zfs,
-            host=ctx.parent.host
+            zfs=worker_jail.zfs,
+            host=worker_jail.host
         )
         if remove is False:
-            events = pkg.fetch_and_install(
-                jail=ioc_jail,
-                packages=list(packages)
-            )
+            # the mirror was prepared before the jobs were started
+            yield from pkg.install(packages=packages, jail=worker_jail)
         else:
-            events = pkg.remove(
-                jail=ioc_jail,
-                packages=list(packages)
-            )
-        ctx.parent.print_events(events)
-    except libioc.errors.IocException:
+            yield from pkg.remove(packages=packages, jail=worker_jail)
+        yield True
+
+    return _pkg
+
+
+@click.command(
+    name="inventory",
+    help="List the packages installed in jails."
+)
+@click.pass_context
+@click.option(
+    "--package", "-p",
+    "package_names",
+    multiple=True,
+    help="Only list packages with this name."
+)
+@click.option(
+    "--older-than",
+    default=None,
+    help="Only list packages older than this version."
+)
+@click.option(
+    "--aggregate", "-a",
+    is_flag=True,
+    default=False,
+    help="List each package version once with the jails it is installed in."
+)
+@click.option(
+    "--format", "-f",
+    "output_format",
+    type=click.Choice(OUTPUT_FORMATS),
+    default="csv",
+    help="Output format, JSON is written as one object per line."
+)
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=None,
+    help="Number of package databases that are read concurrently."
+)
+@click.argument("filters", nargs=-1)
+def cli_inventory(
+    ctx: IocClickContext,
+    package_names: typing.Tuple[str, ...],
+    older_than: typing.Optional[str],
+    aggregate: bool,
+    output_format: str,
+    jobs: typing.Optional[int],
+    filters: typing.Tuple[str, ...]
+) -> None:
+    """
+    List the installed packages of all jails matching the filters.
+
+    The pkg database of each jail is read directly and read-only from the
+    host, concurrently and without starting a process in the jail. Rows are
+    written as soon as the database of a jail was read.
+    """
+    logger = ctx.parent.logger
+    root_paths = _get_root_paths(ctx, filters)
+
+    columns = ["jail", "name", "version", "origin"]
+    if aggregate is True:
+        columns = ["name", "version", "count", "jails"]
+    rows = _write_rows(columns, output_format)
+    next(rows)
+
+    failed = False
+    versions: typing.Dict[typing.Tuple[str, str], typing.List[str]] = {}
+    for jail_name, packages in iter_inventories(root_paths, jobs=jobs):
+        if isinstance(packages, Exception):
+            logger.warn(f"Could not read the packages of {jail_name}")
+            failed = True
+            continue
+        for package in packages:
+            if (len(package_names) > 0) and \
+                    (package.name not in package_names):
+                continue
+            if (older_than is not None) and \
+                    (compare_versions(package.version, older_than) >= 0):
+                continue
+            if aggregate is True:
+                versions.setdefault(
+                    (package.name, package.version,),
+                    []
+                ).append(jail_name)
+            else:
+                rows.send(dict(
+                    jail=jail_name,
+                    name=package.name,
+                    version=package.version,
+                    origin=package.origin
+                ))
+
+    for (name, version), jail_names in sorted(versions.items()):
+        rows.send(dict(
+            name=name,
+            version=version,
+            count=len(jail_names),
+            jails=" ".join(sorted(jail_names))
+        ))
+
+    if failed is True:
+        exit(1)
+
+
+@click.command(
+    name="audit",
+    help="Audit the packages installed in jails for vulnerabilities."
+)
+@click.pass_context
+@click.option(
+    "--vulnxml", "-x",
+    default=DEFAULT_VULNXML,
+    help="Path to the VuXML vulnerability database."
+)
+@click.option(
+    "--format", "-f",
+    "output_format",
+    type=click.Choice(OUTPUT_FORMATS),
+    default="csv",
+    help="Output format, JSON is written as one object per line."
+)
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=None,
+    help="Number of package databases that are read concurrently."
+)
+@click.argument("filters", nargs=-1)
+def cli_audit(
+    ctx: IocClickContext,
+    vulnxml: str,
+    output_format: str,
+    jobs: typing.Optional[int],
+    filters: typing.Tuple[str, ...]
+) -> None:
+    """
+    Match the installed packages of jails against a VuXML database.
+
+    The database is usually fetched with `pkg audit -F`. Each package
+    version is matched once, no matter in how many jails it is installed.
+    Exits with 1 when a vulnerable package was found.
+    """
+    logger = ctx.parent.logger
+
+    try:
+        database = VulnerabilityDatabase(vulnxml)
+    except FileNotFoundError:
+        logger.error(
+            f"The vulnerability database {vulnxml} does not exist, "
+            "it can be fetched with `pkg audit -F`"
+        )
         exit(1)
+    except PkgDatabaseError as e:
+        logger.error(str(e))
+        exit(1)
+
+    root_paths = _get_root_paths(ctx, filters)
+    rows = _write_rows(
+        ["jail", "name", "version", "vid", "topic", "references"],
+        output_format
+    )
+    next(rows)
+
+    failed = False
+    vulnerable = False
+    for jail_name, packages in iter_inventories(root_paths, jobs=jobs):
+        if isinstance(packages, Exception):
+            logger.warn(f"Could not read the packages of {jail_name}")
+            failed = True
+            continue
+        for package in packages:
+            for vulnerability in database.match(package.name, package.version):
+                vulnerable = True
+                rows.send(dict(
+                    jail=jail_name,
+                    name=package.name,
+                    version=package.version,
+                    vid=vulnerability.vid,
+                    topic=vulnerability.topic,
+                    references=" ".join(vulnerability.references)
+                ))
+
+    if (failed is True) or (vulnerable is True):
+        exit(1)
+
+
+def _get_root_paths(
+    ctx: IocClickContext,
+    filters: typing.Tuple[str, ...]
+) -> typing.Dict[str, str]:
+    ioc_jails = libioc.Jails.JailsGenerator(
+        filters=filters,
+        logger=ctx.parent.logger,
+        zfs=ctx.parent.zfs,
+        host=ctx.parent.host
+    )
+    return dict(
+        (ioc_jail.full_name, ioc_jail.root_path,) for ioc_jail in ioc_jails
+    )
+
+
+def _write_rows(
+    columns: typing.List[str],
+    output_format: str
+) -> typing.Generator[None, typing.Dict[str, typing.Any], None]:
+    """Write rows sent to the generator to stdout as they arrive."""
+    writer = csv.writer(sys.stdout)
+    if output_format == "csv":
+        writer.writerow(columns)
+    while True:
+        row = yield
+        if output_format == "csv":
+            writer.writerow([row[column] for column in columns])
+        else:
+            print(json.dumps(row, sort_keys=True))
+        sys.stdout.flush()
+
+
+class PkgCli(click.MultiCommand):
+    """
+    Python Click pkg subcommand boilerplate.
+
+    Arguments that do not start with a subcommand are passed to the install
+    subcommand, so that `ioc pkg JAIL PACKAGES` keeps working.
+    """
+
+    def list_commands(self, ctx: click.core.Context) -> list:
+        """Mock subcommands for Python Click."""
+        return [
+            "install",
+            "inventory",
+            "audit"
+        ]
+
+    def get_command(
+        self,
+        ctx: click.core.Context,
+        cmd_name: str
+    ) -> typing.Optional[click.core.Command]:
+        """Wrap subcommand for Python Click."""
+        if cmd_name == "install":
+            return cli_install
+        elif cmd_name == "inventory":
+            return cli_inventory
+        elif cmd_name == "audit":
+            return cli_audit
+        return None
+
+    def resolve_command(
+        self,
+        ctx: click.core.Context,
+        args: typing.List[str]
+    ) -> typing.Tuple[str, click.core.Command, typing.List[str]]:
+        """Fall back to the install subcommand."""
+        if args[0] in self.list_commands(ctx):
+            return super().resolve_command(ctx, args)
+        return ("install", cli_install, args,)
+
+
+@click.group(
+    name="pkg",
+    cls=PkgCli,
+    context_settings=dict(
+        ignore_unknown_options=True,
+    )
+)
+@click.pass_context
+def cli(
+    ctx: IocClickContext
+) -> None:
+    """
+    Manage packages in jails.
 
+    Install packages with `ioc pkg [install] JAIL PACKAGES`, list them with
+    `ioc pkg inventory` or audit them with `ioc pkg audit`.
+    """
+    ctx.logger = ctx.parent.logger
+    ctx.host = ctx.parent.host
+    ctx.zfs = ctx.parent.zfs
+    ctx.print_events = ctx.parent.print_events
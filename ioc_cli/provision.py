@@ -23,18 +23,41 @@
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 """Provision jails from the CLI.."""
+import hashlib
+import json
+import os.path
+import sys
+import threading
 import typing
 import click
 
 import libioc.errors
+import libioc.events
 import libioc.Jails
 import libioc.Logger
+import libioc.Provisioning.ix
 
 from .shared.click import IocClickContext
-from .shared.jail import set_properties
+from .shared.jail import reload_jail, set_properties
+from .shared.jobs import JobPool
+from .shared.output import print_job_summary
+from .shared.pkg import install_shared_pkg
 
 __rootcmd__ = True
 
+# record of the last successful provisioning stored in the jail dataset
+PROVISIONING_RECORD_FILE = "provisioning.json"
+
+PROVISIONING_PROPERTIES = (
+    "provisioning.method",
+    "provisioning.source",
+    "provisioning.rev"
+)
+
+# plugin definitions fetched during this run by provisioning.source
+_plugin_definitions: typing.Dict[str, typing.Optional[str]] = {}
+_plugin_definitions_lock = threading.Lock()
+
 
 @click.command(name="start", help="Trigger provisioning of jails.")
 @click.pass_context
@@ -45,12 +68,33 @@ __rootcmd__ = True
     multiple=True,
     help="Temporarily override jail config options"
 )
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=1,
+    help="Number of jails that are provisioned concurrently."
+)
+@click.option(
+    "--force", "-f",
+    is_flag=True,
+    default=False,
+    help="Provision jails even when nothing changed since the last run."
+)
 def cli(
     ctx: IocClickContext,
     jails: typing.Tuple[str, ...],
-    temporary_config_override: typing.Tuple[str, ...]
+    temporary_config_override: typing.Tuple[str, ...],
+    jobs: int,
+    force: bool
 ) -> None:
-    """Run jail provisioner as defined in jail config."""
+    """
+    Run jail provisioner as defined in jail config.
+
+    A jail is skipped when its last successful provisioning used the same
+    provisioner, provisioning properties, config overrides and release,
+    unless --force is given. For the ix provisioner the fetched plugin
+    definition is compared as well.
+    """
     logger = ctx.parent.logger
     start_args = {
         "zfs": ctx.parent.zfs,
@@ -62,6 +106,8 @@ def cli(
     if not _provision(
         filters=jails,
         temporary_config_override=temporary_config_override,
+        jobs=jobs,
+        force=force,
         **start_args
     ):
         exit(1)
@@ -70,23 +116,42 @@ def cli(
 def _provision(
     filters: typing.Tuple[str, ...],
     temporary_config_override: typing.Tuple[str, ...],
+    jobs: int,
+    force: bool,
     zfs: libioc.ZFS.ZFS,
     host: libioc.Host.HostGenerator,
     logger: libioc.Logger.Logger,
     print_function: typing.Callable[
         [typing.Generator[libioc.events.IocEvent, None, None]],
-        None
+        typing.Optional[bool]
     ]
 ) -> bool:
 
-    jails = libioc.Jails.JailsGenerator(
+    jails = list(libioc.Jails.JailsGenerator(
         logger=logger,
         zfs=zfs,
         host=host,
         filters=filters
-    )
+    ))
+
+    if len(jails) == 0:
+        jails_input = " ".join(list(filters))
+        logger.error(f"No jails matched your input: {jails_input}")
+        return False
+
+    # provisioners fetch to the shared package mirror
+    install_shared_pkg()
+
+    if jobs > 1:
+        return _provision_concurrently(
+            jails,
+            temporary_config_override=temporary_config_override,
+            jobs=jobs,
+            force=force,
+            logger=logger,
+            print_function=print_function
+        )
 
-    changed_jails = []
     failed_jails = []
     for jail in jails:
         try:
@@ -99,22 +164,199 @@ def _provision(
             exit(1)
 
         try:
-            print_function(_execute_provisioner(jail))
+            print_function(_provision_jail(
+                jail,
+                temporary_config_override=temporary_config_override,
+                force=force
+            ))
         except libioc.errors.IocException:
             failed_jails.append(jail)
-            continue
 
-        changed_jails.append(jail)
+    return len(failed_jails) == 0
 
-    if len(failed_jails) > 0:
-        return False
 
-    if len(changed_jails) == 0:
-        jails_input = " ".join(list(jails))
-        logger.error(f"No jails started your input: {jails_input}")
-        return False
+def _provision_concurrently(
+    jails: typing.List['libioc.Jail.JailGenerator'],
+    temporary_config_override: typing.Tuple[str, ...],
+    jobs: int,
+    force: bool,
+    logger: libioc.Logger.Logger,
+    print_function: typing.Callable[
+        [typing.Generator[libioc.events.IocEvent, None, None]],
+        typing.Optional[bool]
+    ]
+) -> bool:
+
+    pool = JobPool(jobs=jobs)
+    for jail in jails:
+        pool.add(jail.full_name, _provision_job(
+            jail,
+            temporary_config_override=temporary_config_override,
+            force=force,
+            logger=logger
+        ))
+    print_function(pool.run())
+    print_job_summary(pool.results)
+
+    for result in pool.failed:
+        if not isinstance(result.error, libioc.errors.IocException):
+            raise result.error
 
-    return True
+    return len(pool.failed) == 0
+
+
+def _provision_job(
+    jail: 'libioc.Jail.JailGenerator',
+    temporary_config_override: typing.Tuple[str, ...],
+    force: bool,
+    logger: libioc.Logger.Logger
+) -> typing.Callable[[], typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]]:
+
+    def _provision_worker() -> typing.Generator[
+        typing.Union['libioc.events.IocEvent', bool],
+        None,
+        None
+    ]:
+        worker_jail = reload_jail(jail, logger=logger)
+        set_properties(
+            properties=temporary_config_override,
+            target=worker_jail,
+            autosave=False
+        )
+        yield from _provision_jail(
+            worker_jail,
+            temporary_config_override=temporary_config_override,
+            force=force
+        )
+
+    return _provision_worker
+
+
+def _provision_jail(
+    jail: 'libioc.Jail.JailGenerator',
+    temporary_config_override: typing.Tuple[str, ...],
+    force: bool
+) -> typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]:
+    """Provision a jail unless its last provisioning is still current."""
+    digest = _get_provisioning_digest(jail, temporary_config_override)
+    if (force is False) and (digest is not None) and (
+        _read_provisioning_digest(jail) == digest
+    ):
+        jailProvisioningEvent = libioc.events.JailProvisioning(jail=jail)
+        yield jailProvisioningEvent.begin()
+        yield jailProvisioningEvent.skip("unchanged")
+        yield False
+        return
+
+    yield from _execute_provisioner(jail)
+    if digest is None:
+        yield True
+        return
+    try:
+        _write_provisioning_digest(jail, digest)
+    except OSError:
+        jail.logger.warn(
+            f"Could not record the provisioning of {jail.humanreadable_name}"
+        )
+    yield True
+
+
+def _get_provisioning_digest(
+    jail: 'libioc.Jail.JailGenerator',
+    temporary_config_override: typing.Tuple[str, ...]
+) -> typing.Optional[str]:
+    """
+    Hash the provisioner, its parameters and the jail release.
+
+    Returns None when the plugin definition of an ix provisioned jail
+    cannot be fetched, so that the jail is provisioned anyways.
+    """
+    digest = hashlib.sha256()
+    for key in PROVISIONING_PROPERTIES:
+        digest.update(f"{key}={jail.config[key]}\n".encode("UTF-8"))
+    for override in sorted(temporary_config_override):
+        digest.update(f"{override}\n".encode("UTF-8"))
+    digest.update(f"release={jail.config['release']}\n".encode("UTF-8"))
+
+    # the implementation of the provisioner
+    method = jail.config["provisioning.method"]
+    module = sys.modules.get(f"libioc.Provisioning.{method}")
+    module_file = getattr(module, "__file__", None)
+    if module_file is not None:
+        with open(module_file, "rb") as f:
+            digest.update(f.read())
+
+    # the plugin definition may change upstream without a new rev
+    if method == "ix":
+        definition = _get_plugin_definition(
+            jail.config["provisioning.source"],
+            logger=jail.logger
+        )
+        if definition is None:
+            return None
+        digest.update(definition.encode("UTF-8"))
+
+    return digest.hexdigest()
+
+
+def _get_plugin_definition(
+    source: str,
+    logger: libioc.Logger.Logger
+) -> typing.Optional[str]:
+    """Fetch an ix plugin definition once per run and serialize it."""
+    with _plugin_definitions_lock:
+        if source not in _plugin_definitions:
+            try:
+                definition = libioc.Provisioning.ix.PluginDefinition(
+                    source,
+                    logger=logger
+                )
+                _plugin_definitions[source] = json.dumps(
+                    definition,
+                    sort_keys=True
+                )
+            except (libioc.errors.IocException, OSError, ValueError):
+                logger.verbose(
+                    f"Could not fetch the ix plugin definition of {source}"
+                )
+                _plugin_definitions[source] = None
+        return _plugin_definitions[source]
+
+
+def _get_provisioning_record_path(jail: 'libioc.Jail.JailGenerator') -> str:
+    return os.path.join(jail.dataset.mountpoint, PROVISIONING_RECORD_FILE)
+
+
+def _read_provisioning_digest(
+    jail: 'libioc.Jail.JailGenerator'
+) -> typing.Optional[str]:
+    try:
+        with open(_get_provisioning_record_path(jail), "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if isinstance(record, dict) is False:
+        return None
+    return record.get("digest")
+
+
+def _write_provisioning_digest(
+    jail: 'libioc.Jail.JailGenerator',
+    digest: str
+) -> None:
+    path = _get_provisioning_record_path(jail)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(dict(digest=digest), f)
+    os.rename(temporary_path, path)
 
 
 def _execute_provisioner(
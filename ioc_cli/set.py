@@ -30,12 +30,18 @@ import libioc.errors
 import libioc.Logger
 import libioc.helpers
 import libioc.Resource
+import libioc.JailState
 import libioc.Jails
 
+from .shared.config import ConfigBatchWriter, ConfigOverrideIndex
 from .shared.jail import set_properties
+from .shared.output import print_table
 
 __rootcmd__ = True
 
+# properties that running jails pick up without a restart
+_LIVE_PROPERTIES = ("boot", "priority", "depends", "notes",)
+
 
 @click.command(
     context_settings=dict(max_content_width=400,),
@@ -45,26 +51,63 @@ __rootcmd__ = True
 @click.pass_context
 @click.argument("props", nargs=-1)
 @click.argument("jail", nargs=1, required=True)
+@click.option(
+    "--dry-run", "-n",
+    is_flag=True,
+    default=False,
+    help="Show the changes without saving them."
+)
+@click.option(
+    "--impact", "-i",
+    is_flag=True,
+    default=False,
+    help="Show the jails affected by changing defaults without saving them."
+)
 def cli(
     ctx: click.core.Context,
     props: typing.Tuple[str, ...],
-    jail: str
+    jail: str,
+    dry_run: bool,
+    impact: bool
 ) -> None:
-    """Set one or many configuration properties of one jail."""
+    """
+    Set one or many configuration properties of jails.
+
+    The jail argument is a filter, such as a name, a glob or properties
+    like 'release=12.0-RELEASE template=no', so that many jails can be
+    changed at once. Their configurations are saved together in one batch.
+
+    With --impact the defaults are not changed. Instead the jails that do
+    not override the changed properties are listed, along with whether
+    they need a restart to pick up the new defaults.
+    """
     parent: typing.Any = ctx.parent
     logger: libioc.Logger.Logger = parent.logger
     host: libioc.Host.HostGenerator = parent.host
 
+    if (impact is True) and (jail != "defaults"):
+        logger.error("--impact is only available for defaults")
+        exit(1)
+
     # Defaults
     if jail == "defaults":
         try:
             updated_properties = set_properties(
                 properties=props,
-                target=host.defaults
+                target=host.defaults,
+                autosave=(impact is False) and (dry_run is False)
             )
+            if impact is True:
+                _print_defaults_impact(host, updated_properties, logger)
+                return
         except libioc.errors.IocException:
             exit(1)
 
+        if dry_run is True:
+            _properties = ", ".join(updated_properties) or "none"
+            logger.screen(f"Defaults that would change: {_properties}")
+            return
+
         if len(updated_properties) > 0:
             logger.screen("Defaults updated: " + ", ".join(updated_properties))
         else:
@@ -72,37 +115,123 @@ def cli(
         return
 
     # Jail Properties
-    filters = (f"name={jail}",)
     ioc_jails = libioc.Jails.JailsGenerator(
-        filters,
+        (jail,),
         host=host,
         logger=logger
     )
 
+    property_names = [prop.split("=", maxsplit=1)[0] for prop in props]
+    writer = ConfigBatchWriter(logger=logger)
+    changes: typing.List[typing.List[str]] = []
     updated_jail_count = 0
 
-    for ioc_jail in ioc_jails:  # type: libioc.Jail.JailGenerator
+    try:
+        for ioc_jail in ioc_jails:  # type: libioc.Jail.JailGenerator
 
-        try:
+            previous_values = dict(
+                (key, _get_value(ioc_jail, key),) for key in property_names
+            )
             updated_properties = set_properties(
                 properties=props,
-                target=ioc_jail
+                target=ioc_jail,
+                autosave=False
             )
-        except libioc.errors.IocException:
-            exit(1)
 
-        if len(updated_properties) == 0:
-            logger.screen(f"Jail '{ioc_jail.humanreadable_name}' unchanged")
-        else:
-            _properties = ", ".join(updated_properties)
-            logger.screen(
-                f"Jail '{ioc_jail.humanreadable_name}' updated: {_properties}"
-            )
+            if len(updated_properties) == 0:
+                logger.screen(
+                    f"Jail '{ioc_jail.humanreadable_name}' unchanged"
+                )
+            else:
+                for key in sorted(updated_properties):
+                    changes.append([
+                        ioc_jail.humanreadable_name,
+                        key,
+                        previous_values.get(key, "-"),
+                        _get_value(ioc_jail, key)
+                    ])
+                if dry_run is False:
+                    writer.add(ioc_jail)
+                    _properties = ", ".join(updated_properties)
+                    logger.screen(
+                        f"Jail '{ioc_jail.humanreadable_name}' updated: "
+                        f"{_properties}"
+                    )
 
-        updated_jail_count += 1
+            updated_jail_count += 1
+
+        writer.commit()
+    except libioc.errors.IocException:
+        writer.abort()
+        exit(1)
+    except BaseException:
+        writer.abort()
+        raise
 
     if updated_jail_count == 0:
         logger.error("No jails to update")
         exit(1)
 
+    if dry_run is True:
+        print_table(changes, ["jail", "property", "current", "new"])
+
     exit(0)
+
+
+def _get_value(ioc_jail: 'libioc.Jail.JailGenerator', key: str) -> str:
+    try:
+        return str(ioc_jail.getstring(key))
+    except (libioc.errors.IocException, KeyError, AttributeError):
+        return "-"
+
+
+def _print_defaults_impact(
+    host: 'libioc.Host.HostGenerator',
+    updated_properties: typing.Set[str],
+    logger: libioc.Logger.Logger
+) -> None:
+
+    if len(updated_properties) == 0:
+        logger.screen("Defaults unchanged, no jail is affected")
+        return
+
+    index = ConfigOverrideIndex(host=host, logger=logger)
+    index.update()
+    states = libioc.JailState.JailStates()
+    states.query(logger=logger)
+
+    affected: typing.List[typing.List[str]] = []
+    running_count = 0
+    restart_count = 0
+    for indexed_jail in index.jails:
+        changed = sorted(updated_properties - indexed_jail.overrides)
+        if len(changed) == 0:
+            continue
+
+        running = indexed_jail.identifier in states
+        restart = (running is True) and any(
+            _requires_restart(key) for key in changed
+        )
+        running_count += 1 if (running is True) else 0
+        restart_count += 1 if (restart is True) else 0
+        affected.append([
+            indexed_jail.full_name,
+            "running" if (running is True) else "stopped",
+            "yes" if (restart is True) else "no",
+            ",".join(changed)
+        ])
+
+    # running jails first
+    affected.sort(key=lambda row: (row[1] != "running", row[0],))
+    print_table(affected, ["jail", "state", "restart", "properties"])
+    logger.screen(
+        f"{len(affected)} jails affected: "
+        f"{running_count} running ({restart_count} need a restart), "
+        f"{len(affected) - running_count} stopped"
+    )
+
+
+def _requires_restart(key: str) -> bool:
+    if (key == "user") or key.startswith("user."):
+        return False
+    return (key in _LIVE_PROPERTIES) is False
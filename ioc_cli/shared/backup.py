@@ -0,0 +1,565 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Jail backups with configurable archive formats."""
+import contextlib
+import io
+import tarfile
+import typing
+
+import libzfs
+
+import libioc.Config.Jail.File.Fstab
+import libioc.errors
+import libioc.events
+import libioc.ResourceBackup
+
+from .chunks import ChunkStore
+from .compression import (
+    CountingReader,
+    CountingWriter,
+    default_thread_count,
+    detect_compression,
+    get_compression
+)
+from .output import to_humanreadable_size, watch_progress
+from .seekable import SeekableGzipWriter, write_indexed_tar
+from .zfs import (
+    MOUNTPOINT_PROPERTY,
+    ZFS_STREAM_HEADER_SIZE,
+    get_send_flags,
+    get_stream_snapshot_name,
+    ignore_sigpipe,
+    is_zfs_stream,
+    receive_from_fileobj,
+    send_to_fileobj
+)
+
+BACKUP_FORMATS = ["archive", "zfs-stream"]
+
+# libioc names the snapshots of exports backup<datetime>
+BACKUP_SNAPSHOT_PREFIX = "backup"
+
+# the path that selects stdin or stdout
+STDIO_PATH = "-"
+
+
+class SendBackupStream(libioc.events.ResourceBackup):
+    """Send the datasets of a resource as ZFS replication stream."""
+
+    pass
+
+
+class ReceiveBackupStream(libioc.events.ResourceBackup):
+    """Receive the datasets of a resource from a ZFS replication stream."""
+
+    pass
+
+
+class JailBackup(libioc.ResourceBackup.LaunchableResourceBackup):
+    """
+    Export and restore jail backups with pluggable compression.
+
+    The archive bundling of libioc is replaced by a streaming implementation
+    that compresses with the selected format on multiple threads. Restores
+    detect the compression format from the archive content.
+
+    In the zfs-stream format the jail dataset is exported as recursive ZFS
+    replication stream instead of a tar archive. The backup snapshot is kept
+    on the exported jail, so that it can be the base of an incremental export
+    later on.
+
+    When a stream is passed, backups are written to or read from it instead
+    of the destination or source path, for example to pipe them through
+    stdout and stdin.
+
+    When a repository is passed, the destination and source are names of
+    backups in this deduplicating chunk repository. The uncompressed backup
+    is split into chunks that are compressed individually, so that content
+    shared with other backups is only stored once.
+
+    Seekable archives are gzip compressed in independent frames and embed
+    an index of all files, so that single files can be read without
+    decompressing the whole archive.
+    """
+
+    compression: str
+    threads: int
+    backup_format: str
+    incremental_from: typing.Optional[str]
+    send_compressed: bool
+    send_raw: bool
+    stream: typing.Optional[typing.BinaryIO]
+    repository: typing.Optional[str]
+    seekable: bool
+    _archive_reader: typing.Optional[typing.BinaryIO]
+    _input: typing.Optional[CountingReader]
+
+    def __init__(
+        self,
+        resource: 'libioc.LaunchableResource.LaunchableResource',
+        compression: str="gzip",
+        threads: typing.Optional[int]=None,
+        backup_format: str="archive",
+        incremental_from: typing.Optional[str]=None,
+        send_compressed: bool=False,
+        send_raw: bool=False,
+        stream: typing.Optional[typing.BinaryIO]=None,
+        repository: typing.Optional[str]=None,
+        seekable: bool=False
+    ) -> None:
+        # chunks in a repository are compressed individually
+        self.compression = "none" if (repository is not None) else compression
+        self.threads = default_thread_count() if (threads is None) else threads
+        self.backup_format = backup_format
+        self.incremental_from = incremental_from
+        self.send_compressed = send_compressed
+        self.send_raw = send_raw
+        self.stream = stream
+        self.repository = repository
+        self.seekable = seekable
+        self._archive_reader = None
+        self._input = None
+        libioc.ResourceBackup.LaunchableResourceBackup.__init__(
+            self,
+            resource=resource
+        )
+
+    def export(
+        self,
+        destination: str,
+        standalone: typing.Optional[bool]=None,
+        recursive: bool=False,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Export the resource in the selected backup format."""
+        if self.backup_format == "zfs-stream":
+            yield from self._export_stream(
+                destination,
+                event_scope=event_scope
+            )
+        else:
+            yield from libioc.ResourceBackup.LaunchableResourceBackup.export(
+                self,
+                destination,
+                standalone=standalone,
+                recursive=recursive,
+                event_scope=event_scope
+            )
+
+    def restore(
+        self,
+        source: str,
+        incremental: bool=False,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """
+        Import a resource from a backup archive or ZFS stream.
+
+        Args:
+            source (str):
+
+                The path to the exported archive or stream file
+
+            incremental (bool):
+
+                Apply an incremental ZFS stream to the existing resource
+        """
+        with self._open_source(source) as f:
+            self._input = CountingReader(f)
+            buffered_input = io.BufferedReader(self._input)  # noqa: T484
+            compression = detect_compression(buffered_input)
+            reader = compression.reader(buffered_input)
+            if hasattr(reader, "peek") is False:
+                reader = typing.cast(
+                    typing.BinaryIO,
+                    io.BufferedReader(reader)  # noqa: T484
+                )
+            head = reader.peek(ZFS_STREAM_HEADER_SIZE)  # noqa: T484
+            try:
+                if is_zfs_stream(head) is True:
+                    yield from self._restore_stream(
+                        reader,
+                        snapshot_name=get_stream_snapshot_name(head),
+                        incremental=incremental,
+                        event_scope=event_scope
+                    )
+                elif incremental is True:
+                    raise libioc.errors.IocException(
+                        message=(
+                            "Only ZFS streams can be applied incrementally"
+                        ),
+                        logger=self.logger
+                    )
+                else:
+                    self._archive_reader = reader
+                    yield from self._restore_archive(source, event_scope)
+            finally:
+                self._archive_reader = None
+                self._input = None
+                reader.close()
+
+    def _restore_archive(
+        self,
+        source: str,
+        event_scope: typing.Optional['libioc.events.Scope']
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        yield from libioc.ResourceBackup.LaunchableResourceBackup.restore(
+            self,
+            source,
+            event_scope=event_scope
+        )
+
+    def _take_resource_snapshot(self) -> None:
+        # the mountpoint is sent along to relocate fstab paths on import
+        self.resource.dataset.snapshot(
+            self.full_snapshot_name,
+            fsopts={MOUNTPOINT_PROPERTY: self.resource.dataset.mountpoint},
+            recursive=True
+        )
+
+    def _export_stream(
+        self,
+        destination: str,
+        event_scope: typing.Optional['libioc.events.Scope']
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+
+        resourceBackupEvent = libioc.events.ResourceBackup(
+            self.resource,
+            scope=event_scope
+        )
+        _scope = resourceBackupEvent.scope
+        yield resourceBackupEvent.begin()
+
+        self._lock()
+        resourceBackupEvent.add_rollback_step(self._unlock)
+
+        sendBackupStreamEvent = SendBackupStream(
+            self.resource,
+            scope=_scope
+        )
+        yield sendBackupStreamEvent.begin()
+
+        try:
+            incremental_from = self.incremental_from
+            if incremental_from is not None:
+                incremental_from = incremental_from.split("@").pop()
+            flags = get_send_flags(
+                incremental=(incremental_from is not None),
+                compressed=self.send_compressed,
+                raw=self.send_raw
+            )
+            compression = get_compression(self.compression)
+
+            self._take_resource_snapshot()
+            sendBackupStreamEvent.add_rollback_step(
+                self._delete_resource_snapshot
+            )
+
+            self.logger.verbose(
+                f"Sending {self.full_snapshot_name} to {destination}"
+            )
+            with self._open_destination(destination) as f:
+                output = CountingWriter(f)
+                writer = compression.writer(output, threads=self.threads)
+
+                def _send() -> None:
+                    send_to_fileobj(
+                        self.resource.dataset,
+                        writer,
+                        toname=self.snapshot_name,
+                        fromname=incremental_from,
+                        flags=flags
+                    )
+                    writer.close()
+
+                yield from watch_progress(
+                    sendBackupStreamEvent,
+                    _send,
+                    lambda: _format_progress(output.bytes_written, "written")
+                )
+        except Exception as e:
+            yield from sendBackupStreamEvent.fail_generator(e)
+            yield from resourceBackupEvent.fail_generator(e)
+            raise e
+
+        size = to_humanreadable_size(output.bytes_written)
+        yield sendBackupStreamEvent.end(f"@{self.snapshot_name} ({size})")
+
+        self._unlock()
+        yield resourceBackupEvent.end()
+
+    def _restore_stream(
+        self,
+        reader: typing.BinaryIO,
+        snapshot_name: typing.Optional[str],
+        incremental: bool,
+        event_scope: typing.Optional['libioc.events.Scope']
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+
+        resourceBackupEvent = libioc.events.ResourceBackup(
+            self.resource,
+            scope=event_scope
+        )
+        _scope = resourceBackupEvent.scope
+        yield resourceBackupEvent.begin()
+
+        receiveBackupStreamEvent = ReceiveBackupStream(
+            self.resource,
+            scope=_scope
+        )
+        yield receiveBackupStreamEvent.begin()
+
+        dataset_name = self.resource.dataset_name
+        if incremental is False:
+            def _destroy_failed_import() -> None:
+                try:
+                    dataset = self.zfs.get_dataset(dataset_name)
+                    self.zfs.delete_dataset_recursive(dataset)
+                except libzfs.ZFSException:
+                    pass
+            receiveBackupStreamEvent.add_rollback_step(_destroy_failed_import)
+
+        try:
+            self.logger.verbose(f"Receiving ZFS stream to {dataset_name}")
+            with ignore_sigpipe():
+                yield from watch_progress(
+                    receiveBackupStreamEvent,
+                    lambda: receive_from_fileobj(
+                        self.zfs,
+                        dataset_name,
+                        reader,
+                        force=incremental
+                    ),
+                    self._get_input_progress
+                )
+            if snapshot_name is not None:
+                self._relocate_fstab(snapshot_name.split("@").pop())
+        except Exception as e:
+            yield from receiveBackupStreamEvent.fail_generator(e)
+            yield from resourceBackupEvent.fail_generator(e)
+            raise e
+
+        yield receiveBackupStreamEvent.end()
+        yield resourceBackupEvent.end()
+
+    def _relocate_fstab(self, snapshot_name: str) -> None:
+        """Rewrite fstab paths of the exported jail to the restored one."""
+        dataset = self.zfs.get_dataset(self.resource.dataset_name)
+        snapshot = self.zfs.get_snapshot(f"{dataset.name}@{snapshot_name}")
+        exported_mountpoint = snapshot.properties.get(MOUNTPOINT_PROPERTY)
+        if exported_mountpoint is None:
+            return
+        if exported_mountpoint.value == dataset.mountpoint:
+            return
+
+        fstab = libioc.Config.Jail.File.Fstab.Fstab(
+            jail=self.resource,
+            release=None,
+            logger=self.logger,
+            host=self.resource.host
+        )
+        fstab.read_file()
+        fstab.replace_path(exported_mountpoint.value, dataset.mountpoint)
+        fstab.save()
+
+    def _extract_bundle(
+        self,
+        source: str,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+
+        extractBundleEvent = libioc.events.ExtractBundle(
+            source=source,
+            destination=self.work_dir,
+            resource=self.resource,
+            scope=event_scope
+        )
+        yield extractBundleEvent.begin()
+        try:
+            if self._archive_reader is None:
+                raise libioc.errors.IocException(
+                    message="The backup archive was not opened",
+                    logger=self.logger
+                )
+            self.logger.verbose(f"Extracting archive {source}")
+            archive_reader = self._archive_reader
+            yield from watch_progress(
+                extractBundleEvent,
+                lambda: extract_tar_stream(
+                    archive_reader,
+                    destination=self.work_dir,
+                    asset_name=source,
+                    logger=self.logger
+                ),
+                self._get_input_progress
+            )
+        except Exception as e:
+            yield extractBundleEvent.fail(e)
+            raise e
+
+        yield extractBundleEvent.end()
+
+    def _bundle_backup(
+        self,
+        destination: str,
+        event_scope: typing.Optional['libioc.events.Scope']
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Create the archive file from the backup assets."""
+        bundleBackupEvent = libioc.events.BundleBackup(
+            destination=destination,
+            resource=self.resource,
+            scope=event_scope
+        )
+        yield bundleBackupEvent.begin()
+
+        try:
+            compression = get_compression(self.compression)
+            self.logger.verbose(
+                f"Bundling backup to {destination} ({compression.name})"
+            )
+            with self._open_destination(destination) as f:
+                output = CountingWriter(f)
+                if self.seekable is True:
+                    seekable_writer = SeekableGzipWriter(
+                        typing.cast(typing.BinaryIO, output),
+                        threads=self.threads
+                    )
+
+                    def _bundle() -> None:
+                        seekable_writer.files = write_indexed_tar(
+                            self.work_dir,
+                            typing.cast(typing.BinaryIO, seekable_writer)
+                        )
+                        seekable_writer.close()
+                else:
+                    writer = compression.writer(output, threads=self.threads)
+
+                    def _bundle() -> None:
+                        with tarfile.open(fileobj=writer, mode="w|") as tar:
+                            tar.add(self.work_dir, arcname=".")
+                        writer.close()
+
+                yield from watch_progress(
+                    bundleBackupEvent,
+                    _bundle,
+                    lambda: _format_progress(output.bytes_written, "written")
+                )
+        except Exception as e:
+            yield bundleBackupEvent.fail(e)
+            raise e
+
+        size = to_humanreadable_size(output.bytes_written)
+        archive_type = "seekable gzip" if self.seekable else compression.name
+        yield bundleBackupEvent.end(f"{archive_type} archive ({size})")
+
+    def _get_input_progress(self) -> str:
+        bytes_read = 0 if (self._input is None) else self._input.bytes_read
+        return _format_progress(bytes_read, "read")
+
+    @contextlib.contextmanager
+    def _open_destination(
+        self,
+        destination: str
+    ) -> typing.Iterator[typing.BinaryIO]:
+        if self.stream is not None:
+            yield self.stream
+            self.stream.flush()
+        elif self.repository is not None:
+            store = ChunkStore(
+                self.repository,
+                create=True,
+                logger=self.logger
+            )
+            writer = store.writer(destination, threads=self.threads)
+            try:
+                yield typing.cast(typing.BinaryIO, writer)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+            self.logger.verbose(
+                f"Stored {writer.new_chunks} of {len(writer.chunks)} chunks "
+                f"({to_humanreadable_size(writer.stored_size)}) "
+                f"in {store.path}"
+            )
+        else:
+            with open(destination, "wb") as f:
+                yield f
+
+    @contextlib.contextmanager
+    def _open_source(self, source: str) -> typing.Iterator[typing.BinaryIO]:
+        if self.stream is not None:
+            yield self.stream
+        elif self.repository is not None:
+            store = ChunkStore(self.repository, logger=self.logger)
+            with store.reader(source, threads=self.threads) as f:
+                yield typing.cast(typing.BinaryIO, f)
+        else:
+            with open(source, "rb") as f:
+                yield f
+
+
+def _format_progress(size: int, verb: str) -> str:
+    return f"{to_humanreadable_size(size)} {verb}"
+
+
+def extract_tar_stream(
+    fileobj: typing.BinaryIO,
+    destination: str,
+    asset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> None:
+    """
+    Extract a tar stream member by member.
+
+    The archive is read sequentially, so that it does not need to be
+    seekable. As in libioc.SecureTarfile, all members must have relative
+    names without parent directory references.
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            _check_tar_member(member, asset_name=asset_name, logger=logger)
+            tar.extract(member, destination)
+
+
+def _check_tar_member(
+    member: tarfile.TarInfo,
+    asset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']
+) -> None:
+    if member.name == ".":
+        return
+    if not member.name.startswith("./"):
+        reason = "Names in archives must be relative and begin with './'"
+    elif ".." in member.name.split("/"):
+        reason = "Names in archives must not contain '..'"
+    else:
+        return
+
+    raise libioc.errors.IllegalArchiveContent(
+        asset_name=asset_name,
+        reason=reason,
+        logger=logger
+    )
@@ -0,0 +1,604 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Store backups as deduplicated content-defined chunks."""
+import collections
+import concurrent.futures
+import datetime
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import typing
+import zlib
+
+import libioc.errors
+import libioc.Logger
+
+from .compression import default_thread_count
+
+REPOSITORY_VERSION = 1
+REPOSITORY_CONFIG_FILE = "repository.json"
+REPOSITORY_LOCK_FILE = "lock"
+CHUNKS_DIRECTORY = "chunks"
+MANIFESTS_DIRECTORY = "manifests"
+MANIFEST_SUFFIX = ".json"
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_COMPRESSION_LEVEL = 6
+
+# every 3 byte anchor matches once in 16 MiB of random data, so 32 of them
+# cut a chunk every 512 KiB after the minimum chunk size on average
+ANCHOR_COUNT = 32
+ANCHOR_LENGTH = 3
+
+ChunkReference = typing.Tuple[str, int]
+
+
+def _get_anchor_pattern() -> typing.Pattern[bytes]:
+    anchors = [
+        hashlib.sha256(f"ioc-chunk-anchor-{i}".encode()).digest()
+        [:ANCHOR_LENGTH]
+        for i in range(ANCHOR_COUNT)
+    ]
+    return re.compile(b"|".join(re.escape(anchor) for anchor in anchors))
+
+
+ANCHOR_PATTERN = _get_anchor_pattern()
+
+
+class Chunker:
+    """
+    Split a byte stream into content-defined chunks.
+
+    Chunks end after one of a fixed set of anchor byte sequences, so that
+    inserting or removing data only changes the chunks around the edit and
+    identical content produces identical chunks wherever it is located in
+    the stream. The anchors are found by the regular expression engine,
+    which scans much faster than a rolling hash computed in Python.
+    """
+
+    min_size: int
+    max_size: int
+    _buffer: bytearray
+    _scanned: int
+
+    def __init__(
+        self,
+        min_size: int=MIN_CHUNK_SIZE,
+        max_size: int=MAX_CHUNK_SIZE
+    ) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self._buffer = bytearray()
+        self._scanned = min_size
+
+    def split(self, data: bytes) -> typing.Iterator[bytes]:
+        """Add data to the stream and return all completed chunks."""
+        self._buffer.extend(data)
+        while True:
+            cut_point = self._find_cut_point()
+            if cut_point is None:
+                return
+            chunk = bytes(self._buffer[:cut_point])
+            del self._buffer[:cut_point]
+            self._scanned = self.min_size
+            yield chunk
+
+    def finish(self) -> typing.Iterator[bytes]:
+        """Return the remaining data as final chunk."""
+        if len(self._buffer) > 0:
+            yield bytes(self._buffer)
+        self._buffer = bytearray()
+        self._scanned = self.min_size
+
+    def _find_cut_point(self) -> typing.Optional[int]:
+        length = len(self._buffer)
+        if length < self.min_size:
+            return None
+        end = min(length, self.max_size)
+        match = ANCHOR_PATTERN.search(self._buffer, self._scanned, end)
+        if match is not None:
+            return match.end()
+        if length >= self.max_size:
+            return self.max_size
+        # anchors may span the end of the data that was scanned
+        self._scanned = max(self.min_size, end - ANCHOR_LENGTH + 1)
+        return None
+
+
+class RepositoryStats:
+    """Space usage of a chunk repository."""
+
+    backups: int
+    chunks: int
+    logical_size: int
+    unique_size: int
+    stored_size: int
+
+    def __init__(self) -> None:
+        self.backups = 0
+        self.chunks = 0
+        self.logical_size = 0
+        self.unique_size = 0
+        self.stored_size = 0
+
+    @property
+    def dedupe_ratio(self) -> float:
+        """Return the ratio of backup size to unique chunk size."""
+        if self.unique_size == 0:
+            return 1.0
+        return self.logical_size / self.unique_size
+
+    @property
+    def compression_ratio(self) -> float:
+        """Return the ratio of unique chunk size to the stored size."""
+        if self.stored_size == 0:
+            return 1.0
+        return self.unique_size / self.stored_size
+
+
+class GarbageCollectionStats:
+    """Outcome of a chunk repository garbage collection."""
+
+    removed_chunks: int
+    freed_size: int
+
+    def __init__(self) -> None:
+        self.removed_chunks = 0
+        self.freed_size = 0
+
+
+class ChunkStore:
+    """
+    A local repository of deduplicated backup chunks.
+
+    Chunks are stored zlib compressed in files named after the SHA256
+    checksum of their uncompressed content. Every backup is a manifest that
+    lists its chunks in order. Writers hold a shared lock on the repository,
+    so that garbage collection cannot remove chunks of a backup that is
+    still being written.
+    """
+
+    path: str
+    logger: libioc.Logger.Logger
+
+    def __init__(
+        self,
+        path: str,
+        create: bool=False,
+        logger: typing.Optional[libioc.Logger.Logger]=None
+    ) -> None:
+        self.path = os.path.abspath(path)
+        self.logger = libioc.Logger.Logger() if (logger is None) else logger
+        if create is True:
+            self._create()
+        self._check_version()
+
+    @property
+    def chunks_directory(self) -> str:
+        """Return the directory containing the chunk files."""
+        return os.path.join(self.path, CHUNKS_DIRECTORY)
+
+    @property
+    def manifests_directory(self) -> str:
+        """Return the directory containing the backup manifests."""
+        return os.path.join(self.path, MANIFESTS_DIRECTORY)
+
+    def exists(self, name: str) -> bool:
+        """Return True if a backup with this name exists."""
+        return os.path.isfile(self._get_manifest_path(name))
+
+    def list_backups(self) -> typing.List[str]:
+        """Return the names of all backups in the repository."""
+        return sorted(
+            filename[:-len(MANIFEST_SUFFIX)]
+            for filename in os.listdir(self.manifests_directory)
+            if filename.endswith(MANIFEST_SUFFIX)
+        )
+
+    def read_manifest(self, name: str) -> typing.Dict[str, typing.Any]:
+        """Return the manifest of a backup."""
+        try:
+            with open(self._get_manifest_path(name), "r") as f:
+                manifest: typing.Dict[str, typing.Any] = json.load(f)
+        except FileNotFoundError:
+            raise libioc.errors.IocException(
+                message=f"The backup {name} does not exist in {self.path}",
+                logger=self.logger
+            )
+        except ValueError:
+            raise libioc.errors.IocException(
+                message=f"The manifest of the backup {name} is invalid",
+                logger=self.logger
+            )
+        return manifest
+
+    def writer(
+        self,
+        name: str,
+        threads: typing.Optional[int]=None
+    ) -> 'ChunkWriter':
+        """Return a file object that writes a new backup."""
+        if self.exists(name) is True:
+            raise libioc.errors.IocException(
+                message=f"The backup {name} already exists in {self.path}",
+                logger=self.logger
+            )
+        return ChunkWriter(self, name, threads=threads)
+
+    def reader(
+        self,
+        name: str,
+        threads: typing.Optional[int]=None
+    ) -> 'ChunkReader':
+        """Return a file object that reads a backup."""
+        chunks = [
+            (checksum, size,)
+            for checksum, size in self.read_manifest(name)["chunks"]
+        ]
+        return ChunkReader(self, chunks, threads=threads)
+
+    def delete(self, name: str) -> None:
+        """Delete the manifest of a backup and keep its chunks."""
+        try:
+            os.remove(self._get_manifest_path(name))
+        except FileNotFoundError:
+            raise libioc.errors.IocException(
+                message=f"The backup {name} does not exist in {self.path}",
+                logger=self.logger
+            )
+
+    def stats(self) -> RepositoryStats:
+        """Return the space usage and the dedupe ratio of the repository."""
+        stats = RepositoryStats()
+        referenced: typing.Dict[str, int] = {}
+        for name in self.list_backups():
+            manifest = self.read_manifest(name)
+            stats.backups += 1
+            stats.logical_size += manifest["size"]
+            for checksum, size in manifest["chunks"]:
+                referenced[checksum] = size
+        stats.chunks = len(referenced)
+        stats.unique_size = sum(referenced.values())
+        for checksum in referenced.keys():
+            try:
+                stats.stored_size += os.stat(self._get_chunk_path(
+                    checksum
+                )).st_size
+            except FileNotFoundError:
+                self.logger.warn(f"The chunk {checksum} is missing")
+        return stats
+
+    def collect_garbage(self, dry_run: bool=False) -> GarbageCollectionStats:
+        """Remove all chunks that are not referenced by any backup."""
+        stats = GarbageCollectionStats()
+        with self.lock(exclusive=True):
+            referenced = set()
+            for name in self.list_backups():
+                for checksum, _ in self.read_manifest(name)["chunks"]:
+                    referenced.add(checksum)
+
+            for root, _, files in os.walk(self.chunks_directory):
+                for filename in files:
+                    if filename in referenced:
+                        continue
+                    path = os.path.join(root, filename)
+                    stats.removed_chunks += 1
+                    stats.freed_size += os.stat(path).st_size
+                    if dry_run is False:
+                        os.remove(path)
+        return stats
+
+    def lock(self, exclusive: bool=False) -> 'RepositoryLock':
+        """Return a context manager that locks the repository."""
+        return RepositoryLock(self, exclusive=exclusive)
+
+    def has_chunk(self, checksum: str) -> bool:
+        """Return True if the chunk is stored in the repository."""
+        return os.path.isfile(self._get_chunk_path(checksum))
+
+    def write_chunk(self, checksum: str, data: bytes) -> int:
+        """Store a chunk and return the number of bytes written."""
+        path = self._get_chunk_path(checksum)
+        if os.path.isfile(path) is True:
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed_data = zlib.compress(data, CHUNK_COMPRESSION_LEVEL)
+        temporary_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_file, "wb") as f:
+            f.write(compressed_data)
+        os.replace(temporary_file, path)
+        return len(compressed_data)
+
+    def read_chunk(self, checksum: str, size: int) -> bytes:
+        """Read and verify a chunk."""
+        try:
+            with open(self._get_chunk_path(checksum), "rb") as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            raise libioc.errors.IocException(
+                message=f"The chunk {checksum} is missing in {self.path}",
+                logger=self.logger
+            )
+        except zlib.error:
+            data = b""
+        if (len(data) != size) or (_checksum(data) != checksum):
+            raise libioc.errors.IocException(
+                message=f"The chunk {checksum} in {self.path} is corrupted",
+                logger=self.logger
+            )
+        return data
+
+    def write_manifest(
+        self,
+        name: str,
+        chunks: typing.List[ChunkReference]
+    ) -> None:
+        """Atomically write the manifest of a backup."""
+        manifest = dict(
+            version=REPOSITORY_VERSION,
+            name=name,
+            created=datetime.datetime.utcnow().isoformat(),
+            size=sum(size for _, size in chunks),
+            chunks=chunks
+        )
+        path = self._get_manifest_path(name)
+        temporary_file = f"{path}.tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temporary_file, path)
+
+    def _create(self) -> None:
+        os.makedirs(self.chunks_directory, exist_ok=True)
+        os.makedirs(self.manifests_directory, exist_ok=True)
+        config_file = os.path.join(self.path, REPOSITORY_CONFIG_FILE)
+        if os.path.isfile(config_file) is True:
+            return
+        with open(config_file, "w") as f:
+            json.dump(dict(
+                version=REPOSITORY_VERSION,
+                min_chunk_size=MIN_CHUNK_SIZE,
+                max_chunk_size=MAX_CHUNK_SIZE
+            ), f)
+
+    def _check_version(self) -> None:
+        try:
+            with open(os.path.join(self.path, REPOSITORY_CONFIG_FILE)) as f:
+                version = json.load(f).get("version")
+        except (FileNotFoundError, ValueError):
+            raise libioc.errors.IocException(
+                message=f"{self.path} is not a backup repository",
+                logger=self.logger
+            )
+        if version != REPOSITORY_VERSION:
+            raise libioc.errors.IocException(
+                message=(
+                    f"The backup repository {self.path} has the "
+                    f"unsupported version {version}"
+                ),
+                logger=self.logger
+            )
+
+    def _get_manifest_path(self, name: str) -> str:
+        if (name == "") or ("/" in name) or name.startswith("."):
+            raise libioc.errors.IocException(
+                message=f"Invalid backup name: {name}",
+                logger=self.logger
+            )
+        return os.path.join(
+            self.manifests_directory,
+            f"{name}{MANIFEST_SUFFIX}"
+        )
+
+    def _get_chunk_path(self, checksum: str) -> str:
+        return os.path.join(self.chunks_directory, checksum[:2], checksum)
+
+
+class RepositoryLock:
+    """Lock a chunk repository with flock(2)."""
+
+    def __init__(self, store: ChunkStore, exclusive: bool=False) -> None:
+        self.store = store
+        self.exclusive = exclusive
+        self._file: typing.Optional[typing.IO[str]] = None
+
+    def __enter__(self) -> 'RepositoryLock':
+        """Acquire the lock or fail if it is held by another process."""
+        operation = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        self._file = open(
+            os.path.join(self.store.path, REPOSITORY_LOCK_FILE),
+            "a"
+        )
+        try:
+            fcntl.flock(self._file.fileno(), operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            raise libioc.errors.IocException(
+                message=f"The backup repository {self.store.path} is in use",
+                logger=self.store.logger
+            )
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        """Release the lock."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    Write a backup to a chunk repository.
+
+    Chunks are checksummed, compressed and stored on multiple threads while
+    the stream is split. The backup only becomes visible in the repository
+    when its manifest is written on close.
+    """
+
+    store: ChunkStore
+    name: str
+    chunks: typing.List[ChunkReference]
+    new_chunks: int
+    stored_size: int
+
+    def __init__(
+        self,
+        store: ChunkStore,
+        name: str,
+        threads: typing.Optional[int]=None
+    ) -> None:
+        self.store = store
+        self.name = name
+        self.threads = default_thread_count() if (threads is None) else threads
+        self.chunks = []
+        self.new_chunks = 0
+        self.stored_size = 0
+        self._chunker = Chunker()
+        self._pending: typing.Deque[concurrent.futures.Future] = \
+            collections.deque()
+        self._lock = store.lock()
+        self._lock.__enter__()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, self.threads)
+        )
+
+    def writable(self) -> bool:
+        """Return True, because this is a writable stream."""
+        return True
+
+    def write(self, data: bytes) -> int:  # noqa: T484
+        """Split the data into chunks and store the completed ones."""
+        for chunk in self._chunker.split(data):
+            self._add_chunk(chunk)
+        return len(data)
+
+    def close(self) -> None:
+        """Store the remaining chunks and write the backup manifest."""
+        if self.closed:
+            return
+        try:
+            for chunk in self._chunker.finish():
+                self._add_chunk(chunk)
+            while len(self._pending) > 0:
+                self._collect(self._pending.popleft())
+            self.store.write_manifest(self.name, self.chunks)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._lock.__exit__()
+            io.RawIOBase.close(self)
+
+    def abort(self) -> None:
+        """Discard the backup without writing its manifest."""
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._lock.__exit__()
+        io.RawIOBase.close(self)
+
+    def _add_chunk(self, chunk: bytes) -> None:
+        # bound the memory used by chunks waiting to be stored
+        while len(self._pending) >= (self.threads * 2):
+            self._collect(self._pending.popleft())
+        self._pending.append(self._executor.submit(self._store_chunk, chunk))
+
+    def _store_chunk(self, chunk: bytes) -> typing.Tuple[str, int, int]:
+        checksum = _checksum(chunk)
+        return (checksum, len(chunk), self.store.write_chunk(checksum, chunk),)
+
+    def _collect(self, future: concurrent.futures.Future) -> None:
+        checksum, size, stored_size = future.result()
+        self.chunks.append((checksum, size,))
+        if stored_size > 0:
+            self.new_chunks += 1
+            self.stored_size += stored_size
+
+
+class ChunkReader(io.RawIOBase):
+    """Read a backup from a chunk repository with read-ahead."""
+
+    store: ChunkStore
+
+    def __init__(
+        self,
+        store: ChunkStore,
+        chunks: typing.List[ChunkReference],
+        threads: typing.Optional[int]=None
+    ) -> None:
+        self.store = store
+        self.threads = default_thread_count() if (threads is None) else threads
+        self._chunks = collections.deque(chunks)
+        self._pending: typing.Deque[concurrent.futures.Future] = \
+            collections.deque()
+        self._buffer = memoryview(b"")
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, self.threads)
+        )
+
+    def readable(self) -> bool:
+        """Return True, because this is a readable stream."""
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:  # noqa: T484
+        """Read the next bytes of the backup."""
+        if len(self._buffer) == 0:
+            self._read_ahead()
+            if len(self._pending) == 0:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+        length = min(len(buffer), len(self._buffer))
+        buffer[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return length
+
+    def close(self) -> None:
+        """Stop reading chunks ahead."""
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        io.RawIOBase.close(self)
+
+    def _read_ahead(self) -> None:
+        while (len(self._chunks) > 0) and (
+            len(self._pending) < (self.threads * 2)
+        ):
+            checksum, size = self._chunks.popleft()
+            self._pending.append(self._executor.submit(
+                self.store.read_chunk,
+                checksum,
+                size
+            ))
+
+
+def _checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
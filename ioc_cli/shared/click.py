@@ -29,6 +29,7 @@ import click.core
 import libioc.events
 import libioc.Logger
 import libioc.Host
+import libioc.ZFS
 
 
 class IocClickContext(click.core.Context):
@@ -36,6 +37,7 @@ class IocClickContext(click.core.Context):
 
     logger: libioc.Logger.Logger
     host: libioc.Host.Host
+    zfs: libioc.ZFS.ZFS
     parent: 'IocClickContext'
     print_events: typing.Callable[
         [typing.Generator[libioc.events.IocEvent, None, None]],
@@ -0,0 +1,436 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Pluggable stream compression for jail backup archives."""
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import io
+import lzma
+import os
+import shutil
+import struct
+import subprocess  # nosec: B404
+import time
+import typing
+import zlib
+
+import libioc.errors
+
+# FreeBSD ships zstd in the base system since 12.0
+ZSTD_BINARY = "/usr/bin/zstd"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+BZIP2_MAGIC = b"BZh"
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+
+def default_thread_count() -> int:
+    """Return the number of compression threads used by default."""
+    return os.cpu_count() or 1
+
+
+class CountingWriter(io.RawIOBase):
+    """Count the bytes written to a file object."""
+
+    def __init__(self, fileobj: typing.BinaryIO) -> None:
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def writable(self) -> bool:
+        """Return True, because this is a writable stream."""
+        return True
+
+    def write(self, data: bytes) -> int:  # noqa: T484
+        """Write data to the underlying file object."""
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+
+class CountingReader(io.RawIOBase):
+    """Count the bytes read from a file object."""
+
+    def __init__(self, fileobj: typing.BinaryIO) -> None:
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        """Return True, because this is a readable stream."""
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:  # noqa: T484
+        """Read data from the underlying file object."""
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write a gzip stream compressed by multiple threads.
+
+    The input is split into blocks that are deflated concurrently. Like pigz
+    does, every block is primed with the last 32 KiB of its predecessor and
+    ends on a byte boundary, so that the blocks form a single deflate stream
+    with a compression ratio close to the one of single-threaded gzip. The
+    output can be read by every gzip implementation.
+    """
+
+    def __init__(
+        self,
+        fileobj: typing.BinaryIO,
+        threads: int,
+        level: int=6,
+        block_size: int=DEFAULT_BLOCK_SIZE
+    ) -> None:
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = max(1, threads)
+        self.bytes_read = 0
+        self._crc = 0
+        self._buffer = bytearray()
+        self._previous_block = b""
+        self._pending: typing.Deque[concurrent.futures.Future] = \
+            collections.deque()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self._pending_block: typing.Optional[bytes] = None
+        mtime = struct.pack("<L", int(time.time()))
+        self.fileobj.write(b"".join(
+            [GZIP_MAGIC, b"\x08\x00", mtime, b"\x00\xff"]
+        ))
+
+    def writable(self) -> bool:
+        """Return True, because this is a writable stream."""
+        return True
+
+    def write(self, data: bytes) -> int:  # noqa: T484
+        """Buffer data and compress all completed blocks."""
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._add_block(block)
+        return len(data)
+
+    def close(self) -> None:
+        """Compress the remaining data and write the gzip trailer."""
+        if self.closed:
+            return
+        if len(self._buffer) > 0:
+            self._add_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._submit(self._pending_block or b"", last=True)
+        self._pending_block = None
+        while len(self._pending) > 0:
+            self.fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown(wait=True)
+        self.fileobj.write(struct.pack(
+            "<LL",
+            self._crc & 0xffffffff,
+            self.bytes_read & 0xffffffff
+        ))
+        super().close()
+
+    def _add_block(self, block: bytes) -> None:
+        self._crc = zlib.crc32(block, self._crc)
+        self.bytes_read += len(block)
+        # the last block needs to be known when it is submitted
+        if self._pending_block is not None:
+            self._submit(self._pending_block, last=False)
+        self._pending_block = block
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        dictionary = self._previous_block[-DEFLATE_WINDOW_SIZE:]
+        self._pending.append(self._executor.submit(
+            _deflate_block,
+            block,
+            dictionary,
+            self.level,
+            last
+        ))
+        self._previous_block = block
+        # bound the memory used by blocks that are not written yet
+        while len(self._pending) > (self.threads * 2):
+            self.fileobj.write(self._pending.popleft().result())
+
+
+def _deflate_block(
+    block: bytes,
+    dictionary: bytes,
+    level: int,
+    last: bool
+) -> bytes:
+    if len(dictionary) > 0:
+        compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            -zlib.MAX_WBITS,
+            zdict=dictionary
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    flush_mode = zlib.Z_FINISH if (last is True) else zlib.Z_SYNC_FLUSH
+    return compressor.compress(block) + compressor.flush(flush_mode)
+
+
+class PipeWriter(io.RawIOBase):
+    """Write through an external compression command."""
+
+    def __init__(
+        self,
+        fileobj: typing.BinaryIO,
+        command: typing.List[str]
+    ) -> None:
+        self.fileobj = fileobj
+        self.command = command
+        self._process = subprocess.Popen(  # nosec: trusted command
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        self._copy_thread = concurrent.futures.ThreadPoolExecutor(1)
+        self._copy_result = self._copy_thread.submit(
+            shutil.copyfileobj,
+            self._process.stdout,
+            self.fileobj
+        )
+
+    def writable(self) -> bool:
+        """Return True, because this is a writable stream."""
+        return True
+
+    def write(self, data: bytes) -> int:  # noqa: T484
+        """Pass data to the compression command."""
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        """Wait for the compression command to finish."""
+        if self.closed:
+            return
+        self._process.stdin.close()
+        self._copy_result.result()
+        self._copy_thread.shutdown(wait=True)
+        if self._process.wait() != 0:
+            raise libioc.errors.IocException(
+                message=f"{self.command[0]} exited with an error"
+            )
+        super().close()
+
+
+class PipeReader(io.RawIOBase):
+    """Read the output of an external decompression command."""
+
+    def __init__(
+        self,
+        fileobj: typing.BinaryIO,
+        command: typing.List[str]
+    ) -> None:
+        self.command = command
+        self._process = subprocess.Popen(  # nosec: trusted command
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        self._copy_thread = concurrent.futures.ThreadPoolExecutor(1)
+        self._copy_result = self._copy_thread.submit(
+            self._feed,
+            fileobj
+        )
+
+    def _feed(self, fileobj: typing.BinaryIO) -> None:
+        try:
+            shutil.copyfileobj(fileobj, self._process.stdin)
+        except BrokenPipeError:
+            pass
+        finally:
+            self._process.stdin.close()
+
+    def readable(self) -> bool:
+        """Return True, because this is a readable stream."""
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:  # noqa: T484
+        """Read decompressed data."""
+        return int(self._process.stdout.readinto(buffer))
+
+    def close(self) -> None:
+        """Wait for the decompression command to finish."""
+        if self.closed:
+            return
+        self._process.stdout.close()
+        self._copy_result.result()
+        self._copy_thread.shutdown(wait=True)
+        if self._process.wait() != 0:
+            raise libioc.errors.IocException(
+                message=f"{self.command[0]} exited with an error"
+            )
+        super().close()
+
+
+class Compression:
+    """A compression format for backup archives."""
+
+    name: str
+    magic: typing.Optional[bytes] = None
+
+    def writer(
+        self,
+        fileobj: typing.BinaryIO,
+        threads: int
+    ) -> typing.BinaryIO:
+        """Return a file object that compresses to fileobj."""
+        raise NotImplementedError("To be implemented by inheriting classes")
+
+    def reader(self, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+        """Return a file object that decompresses fileobj."""
+        raise NotImplementedError("To be implemented by inheriting classes")
+
+
+class NoCompression(Compression):
+    """Uncompressed tar archives."""
+
+    name = "none"
+
+    def writer(
+        self,
+        fileobj: typing.BinaryIO,
+        threads: int
+    ) -> typing.BinaryIO:
+        """Return a file object that writes to fileobj."""
+        return typing.cast(typing.BinaryIO, CountingWriter(fileobj))
+
+    def reader(self, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+        """Return the unchanged file object."""
+        return fileobj
+
+
+class GzipCompression(Compression):
+    """gzip compatible compression of blocks on multiple threads."""
+
+    name = "gzip"
+    magic = GZIP_MAGIC
+
+    def writer(
+        self,
+        fileobj: typing.BinaryIO,
+        threads: int
+    ) -> typing.BinaryIO:
+        """Return a parallel gzip writer."""
+        return typing.cast(
+            typing.BinaryIO,
+            ParallelGzipWriter(fileobj, threads=threads)
+        )
+
+    def reader(self, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+        """Return a gzip reader."""
+        return typing.cast(typing.BinaryIO, gzip.GzipFile(fileobj=fileobj))
+
+
+class ZstdCompression(Compression):
+    """Multi-threaded zstd compression with the zstd command."""
+
+    name = "zstd"
+    magic = ZSTD_MAGIC
+
+    def writer(
+        self,
+        fileobj: typing.BinaryIO,
+        threads: int
+    ) -> typing.BinaryIO:
+        """Return a writer that pipes through zstd."""
+        return typing.cast(typing.BinaryIO, PipeWriter(
+            fileobj,
+            [ZSTD_BINARY, "-q", "-c", f"-T{threads}"]
+        ))
+
+    def reader(self, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+        """Return a reader that pipes through zstd."""
+        return typing.cast(typing.BinaryIO, PipeReader(
+            fileobj,
+            [ZSTD_BINARY, "-q", "-d", "-c"]
+        ))
+
+
+class XzCompression(Compression):
+    """Read-only support for xz compressed archives."""
+
+    name = "xz"
+    magic = XZ_MAGIC
+
+    def reader(self, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+        """Return a xz reader."""
+        return typing.cast(typing.BinaryIO, lzma.LZMAFile(fileobj))
+
+
+class Bzip2Compression(Compression):
+    """Read-only support for bzip2 compressed archives."""
+
+    name = "bzip2"
+    magic = BZIP2_MAGIC
+
+    def reader(self, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+        """Return a bzip2 reader."""
+        return typing.cast(typing.BinaryIO, bz2.BZ2File(fileobj))
+
+
+COMPRESSIONS: typing.List[Compression] = [
+    GzipCompression(),
+    ZstdCompression(),
+    NoCompression(),
+    XzCompression(),
+    Bzip2Compression()
+]
+
+# formats that can be selected for exports
+EXPORT_COMPRESSIONS = ["gzip", "zstd", "none"]
+
+
+def get_compression(name: str) -> Compression:
+    """Return the compression with the given name."""
+    for compression in COMPRESSIONS:
+        if compression.name == name:
+            return compression
+    raise libioc.errors.IocException(
+        message=f"Unknown compression format: {name}"
+    )
+
+
+def detect_compression(fileobj: io.BufferedReader) -> Compression:
+    """Detect the compression of a stream from its leading bytes."""
+    head = fileobj.peek(8)
+    for compression in COMPRESSIONS:
+        if compression.magic is None:
+            continue
+        if head.startswith(compression.magic):
+            return compression
+    return get_compression("none")
@@ -0,0 +1,539 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Write and cache jail configurations."""
+import copy
+import json
+import marshal
+import os
+import typing
+
+import libzfs
+
+import libioc.errors
+import libioc.helpers
+import libioc.Config.Jail.JailConfig
+import libioc.Config.Prototype
+import libioc.Config.Type.JSON
+import libioc.Config.Type.UCL
+import libioc.Jail
+import libioc.Logger
+import libioc.Resource
+
+# config types that are stored in a file of the jail dataset
+FILE_CONFIG_TYPES = ("json", "ucl")
+
+# bump when the layout of parsed config cache files changes
+PARSED_CONFIG_CACHE_VERSION = 3
+
+# index of the properties overridden by jails, stored in the jails dataset
+OVERRIDE_INDEX_FILE = ".overrides.json"
+OVERRIDE_INDEX_VERSION = 2
+
+
+class ConfigBatchWriter:
+    """
+    Durably save the configurations of many jails at once.
+
+    Each configuration is written to a temporary file next to its config
+    file first. After a single sync the temporary files replace the config
+    files with a rename, so that every config file is either completely
+    old or completely new, without paying for a sync per jail. Legacy
+    configurations stored in ZFS properties are saved directly.
+    """
+
+    logger: libioc.Logger.Logger
+    _pending: typing.List[typing.Tuple['libioc.Jail.JailGenerator', str]]
+
+    def __init__(
+        self,
+        logger: typing.Optional[libioc.Logger.Logger]=None
+    ) -> None:
+        self.logger = libioc.Logger.Logger() if (logger is None) else logger
+        self._pending = []
+
+    def add(self, jail: 'libioc.Jail.JailGenerator') -> None:
+        """Stage the current configuration of a jail."""
+        if jail.config_type not in FILE_CONFIG_TYPES:
+            jail.save()
+            return
+
+        handler = jail.config_handler
+        temporary_path = f"{handler.file}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            f.write(str(handler.map_output(jail.config.data)))
+        self._pending.append((jail, temporary_path,))
+
+    def commit(self) -> None:
+        """Sync all staged configurations and move them into place."""
+        if len(self._pending) == 0:
+            return
+        os.sync()
+        for jail, temporary_path in self._pending:
+            os.rename(temporary_path, jail.config_handler.file)
+            # rc.conf and fstab are derived from the configuration
+            jail._save_autoconfig()
+        self.logger.verbose(f"{len(self._pending)} jail configs written")
+        self._pending = []
+
+    def abort(self) -> None:
+        """Discard all staged configurations."""
+        for _, temporary_path in self._pending:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self._pending = []
+
+
+ConfigFingerprint = typing.Optional[typing.Tuple[int, int]]
+
+
+def _get_config_fingerprint(
+    resource: 'libioc.Resource.Resource'
+) -> ConfigFingerprint:
+    """Return modification time and size of a resources config file."""
+    if resource.config_type not in FILE_CONFIG_TYPES:
+        return None
+    try:
+        stat = os.stat(resource.config_handler.file)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size,)
+
+
+class ResolvedConfig:
+    """
+    The effective configuration of a jail, resolved once per property.
+
+    Properties that a jail neither configures nor computes with a getter
+    are taken from the resolved defaults, which are shared between all
+    jails of the process. Every other property is resolved by libioc.
+    """
+
+    config: 'libioc.Config.Jail.BaseConfig.BaseConfig'
+    _defaults_config: typing.Optional[
+        'libioc.Config.Jail.Defaults.JailConfigDefaults'
+    ]
+    _defaults_values: typing.Dict[str, typing.Any]
+    _values: typing.Dict[str, typing.Any]
+
+    def __init__(
+        self,
+        config: 'libioc.Config.Jail.BaseConfig.BaseConfig',
+        defaults_config: typing.Optional[
+            'libioc.Config.Jail.Defaults.JailConfigDefaults'
+        ]=None,
+        defaults_values: typing.Optional[typing.Dict[str, typing.Any]]=None
+    ) -> None:
+        self.config = config
+        self._defaults_config = defaults_config
+        self._defaults_values = {} if (defaults_values is None) \
+            else defaults_values
+        self._values = {}
+
+    def __getitem__(self, key: str) -> typing.Any:
+        """Return the resolved value of a config property."""
+        if key not in self._values:
+            self._values[key] = self._resolve(key)
+        return self._values[key]
+
+    def keys(self) -> typing.List[str]:
+        """Return the names of all config properties."""
+        return list(self.config.all_properties)
+
+    def _resolve(self, key: str) -> typing.Any:
+        config = self.config
+        if self._defaults_config is None:
+            return config[key]
+        if (key in config.data) or (key in _get_getter_names(type(config))):
+            return config[key]
+        if key not in self._defaults_config:
+            # special and unknown properties are handled by the jail config
+            return config[key]
+        if key not in self._defaults_values:
+            self._defaults_values[key] = self._defaults_config[key]
+        return self._defaults_values[key]
+
+
+def _get_getter_names(config_class: type) -> typing.FrozenSet[str]:
+    """Return the properties a config class computes with _get_ methods."""
+    if config_class not in _getter_names:
+        _getter_names[config_class] = frozenset(
+            name[len("_get_"):] for name in dir(config_class)
+            if name.startswith("_get_")
+        )
+    return _getter_names[config_class]
+
+
+_getter_names: typing.Dict[type, typing.FrozenSet[str]] = {}
+
+
+class ResolvedConfigCache:
+    """
+    Share the resolved defaults between the jails of one process.
+
+    Listing many jails resolves the same defaults for every jail that does
+    not override them. The defaults are resolved once and reused as long as
+    the defaults data is unchanged, which is compared in memory once per
+    resolved jail instead of checking files on every lookup.
+    """
+
+    _defaults: typing.Optional[typing.Tuple[
+        'libioc.Config.Jail.Defaults.JailConfigDefaults',
+        typing.Dict[str, typing.Any],
+        typing.Dict[str, typing.Any]
+    ]]
+
+    def __init__(self) -> None:
+        self._defaults = None
+
+    def resolve(
+        self,
+        config: 'libioc.Config.Jail.BaseConfig.BaseConfig'
+    ) -> ResolvedConfig:
+        """Return the effective configuration of a jail config."""
+        JailConfig = libioc.Config.Jail.JailConfig.JailConfig
+        if isinstance(config, JailConfig) is False:
+            return ResolvedConfig(config)
+        if config.ignore_source_config is True:
+            # only hardcoded defaults apply
+            return ResolvedConfig(config)
+
+        defaults_config = config.host.defaults.config
+        return ResolvedConfig(
+            config,
+            defaults_config=defaults_config,
+            defaults_values=self._get_defaults_values(defaults_config)
+        )
+
+    def invalidate(self) -> None:
+        """Forget the resolved defaults."""
+        self._defaults = None
+
+    def _get_defaults_values(
+        self,
+        defaults_config: 'libioc.Config.Jail.Defaults.JailConfigDefaults'
+    ) -> typing.Dict[str, typing.Any]:
+        if self._defaults is not None:
+            cached_config, snapshot, values = self._defaults
+            if cached_config is defaults_config:
+                if snapshot == defaults_config.data:
+                    return values
+        values = {}
+        self._defaults = (
+            defaults_config,
+            copy.deepcopy(dict(defaults_config.data)),
+            values
+        )
+        return values
+
+
+resolved_configs = ResolvedConfigCache()
+
+
+def get_resolved_string(
+    resource: 'libioc.Jail.JailGenerator',
+    key: str,
+    resolved: ResolvedConfig
+) -> str:
+    """
+    Get any jail property as string or '-'.
+
+    Behaves like Resource.getstring, but config properties are looked up
+    in the resolved configuration of the jail.
+    """
+    try:
+        value = libioc.Resource.Resource.get(resource, key)
+    except AttributeError:
+        value = resolved[key]
+    return str(libioc.helpers.to_string(value, none="-"))
+
+
+def get_parsed_config_cache_path(config_file: str) -> str:
+    """Return the path of the parsed config cache of a config file."""
+    directory, filename = os.path.split(config_file)
+    return os.path.join(directory, f".{filename}.cache")
+
+
+def _read_parsed_config_cache(
+    cache_file: str,
+    stat: os.stat_result
+) -> typing.Optional['libioc.Config.Prototype.ConfigDataDict']:
+    # the cache is written by the CLI with mode 0600 to the jail dataset,
+    # outside of the jail root, so that jails cannot tamper with it
+    try:
+        with open(cache_file, "rb") as f:
+            cache = marshal.loads(f.read())  # nosec: B302
+        version, mtime, size, data = cache
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != PARSED_CONFIG_CACHE_VERSION:
+        return None
+    if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+        return None
+    if isinstance(data, dict) is False:
+        return None
+    return data
+
+
+def _write_parsed_config_cache(
+    cache_file: str,
+    stat: os.stat_result,
+    data: 'libioc.Config.Prototype.ConfigDataDict'
+) -> None:
+    try:
+        payload = marshal.dumps((
+            PARSED_CONFIG_CACHE_VERSION,
+            stat.st_mtime_ns,
+            stat.st_size,
+            data
+        ))
+    except ValueError:
+        return
+    _write_cache_file(cache_file, payload)
+
+
+def _write_json_cache_file(cache_file: str, data: typing.Any) -> None:
+    try:
+        payload = json.dumps(data).encode("UTF-8")
+    except (ValueError, TypeError):
+        return
+    _write_cache_file(cache_file, payload)
+
+
+def _write_cache_file(cache_file: str, payload: bytes) -> None:
+    temporary_path = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(
+            temporary_path,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            0o600
+        )
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.rename(temporary_path, cache_file)
+    except OSError:
+        # caches are optional, e.g. on read-only datasets
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+class _ParsedConfigCache:
+    """
+    Read a text config from its binary parsed config cache when valid.
+
+    The cache is stored next to the config file and records the mtime and
+    size of the config file it was parsed from. Whenever they do not match
+    or the cache cannot be read, the text config is parsed and the cache
+    is rewritten.
+    """
+
+    file: str
+
+    def read(self) -> 'libioc.Config.Prototype.ConfigDataDict':
+        """Read from the parsed config cache or the configuration file."""
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return {}
+
+        cache_file = get_parsed_config_cache_path(self.file)
+        data = _read_parsed_config_cache(cache_file, stat)
+        if data is not None:
+            return data
+
+        data = super().read()  # noqa: T484
+        _write_parsed_config_cache(cache_file, stat, data)
+        return data
+
+
+class CachedDatasetConfigJSON(
+    _ParsedConfigCache,
+    libioc.Config.Type.JSON.DatasetConfigJSON
+):
+    """ResourceConfig in JSON format with a parsed config cache."""
+
+    pass
+
+
+class CachedDatasetConfigUCL(
+    _ParsedConfigCache,
+    libioc.Config.Type.UCL.DatasetConfigUCL
+):
+    """ResourceConfig in UCL format with a parsed config cache."""
+
+    pass
+
+
+def install_parsed_config_cache() -> None:
+    """Let resources read their JSON and UCL configs through the cache."""
+    libioc.Config.Type.JSON.DatasetConfigJSON = (  # type: ignore
+        CachedDatasetConfigJSON
+    )
+    libioc.Config.Type.UCL.DatasetConfigUCL = (  # type: ignore
+        CachedDatasetConfigUCL
+    )
+
+
+class _RawConfigResource(libioc.Resource.Resource):
+    """Read the unresolved configuration of a resource dataset."""
+
+    def destroy(
+        self,
+        force: bool=False
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Cannot destroy a raw config resource."""
+        raise NotImplementedError("destroy unimplemented for raw configs")
+
+    def save(self) -> None:
+        """Cannot save a raw config resource."""
+        raise NotImplementedError("save unimplemented for raw configs")
+
+
+class IndexedJail:
+    """A jail and the config properties it overrides."""
+
+    source: str
+    name: str
+    overrides: typing.FrozenSet[str]
+
+    def __init__(
+        self,
+        source: str,
+        name: str,
+        overrides: typing.Iterable[str]
+    ) -> None:
+        self.source = source
+        self.name = name
+        self.overrides = frozenset(overrides)
+
+    @property
+    def full_name(self) -> str:
+        """Return the name of the jail prefixed with its source."""
+        return f"{self.source}/{self.name}"
+
+    @property
+    def identifier(self) -> str:
+        """Return the jail name used by jls."""
+        return f"{self.source}-{self.name}"
+
+
+class ConfigOverrideIndex:
+    """
+    Know which jails override which config properties.
+
+    The property names configured by each jail are remembered per source in
+    an index file in the jails dataset, along with the mtime and size of
+    the config file they were read from. Only configs that changed since
+    are read again, and no configuration is resolved against the defaults.
+    """
+
+    logger: libioc.Logger.Logger
+    jails: typing.List[IndexedJail]
+
+    def __init__(
+        self,
+        host: 'libioc.Host.HostGenerator',
+        logger: typing.Optional[libioc.Logger.Logger]=None
+    ) -> None:
+        self.host = host
+        self.logger = libioc.Logger.Logger() if (logger is None) else logger
+        self.jails = []
+
+    def update(self) -> None:
+        """Refresh the index from the jail configs of all sources."""
+        self.jails = []
+        for source_name, root_datasets in self.host.datasets.items():
+            self.jails += self._update_source(source_name, root_datasets.jails)
+
+    def get_inheriting_jails(self, key: str) -> typing.List[IndexedJail]:
+        """Return the jails that inherit a property from the defaults."""
+        return [jail for jail in self.jails if key not in jail.overrides]
+
+    def _update_source(
+        self,
+        source_name: str,
+        jails_dataset: libzfs.ZFSDataset
+    ) -> typing.List[IndexedJail]:
+        index_file = os.path.join(
+            jails_dataset.mountpoint,
+            OVERRIDE_INDEX_FILE
+        )
+        previous_index = _read_override_index(index_file)
+        index: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        jails = []
+
+        for dataset in jails_dataset.children:
+            name = dataset.name.rsplit("/", maxsplit=1)[-1]
+            resource = _RawConfigResource(
+                dataset=dataset,
+                logger=self.logger,
+                zfs=self.host.zfs
+            )
+            fingerprint = _get_config_fingerprint(resource)
+            keys = _get_indexed_keys(previous_index.get(name), fingerprint)
+            if keys is None:
+                try:
+                    keys = sorted(resource.read_config().keys())
+                except (ValueError, libioc.errors.IocException):
+                    self.logger.warn(f"Skipping unreadable config of {name}")
+                    continue
+            if fingerprint is not None:
+                mtime, size = fingerprint
+                index[name] = dict(mtime=mtime, size=size, keys=keys)
+            jails.append(IndexedJail(source_name, name, keys))
+
+        if index != previous_index:
+            _write_json_cache_file(index_file, dict(
+                version=OVERRIDE_INDEX_VERSION,
+                jails=index
+            ))
+        return jails
+
+
+def _read_override_index(index_file: str) -> typing.Dict[str, typing.Any]:
+    try:
+        with open(index_file, "r") as f:
+            data = json.load(f)
+        version = data["version"]
+        index = data["jails"]
+    except (OSError, ValueError, TypeError, KeyError):
+        return {}
+    if (version != OVERRIDE_INDEX_VERSION) or not isinstance(index, dict):
+        return {}
+    return index
+
+
+def _get_indexed_keys(
+    entry: typing.Any,
+    fingerprint: ConfigFingerprint
+) -> typing.Optional[typing.List[str]]:
+    """Return the indexed keys of a jail unless its config changed."""
+    if (fingerprint is None) or (isinstance(entry, dict) is False):
+        return None
+    if (entry.get("mtime"), entry.get("size"),) != fingerprint:
+        return None
+    keys = entry.get("keys")
+    if isinstance(keys, list) is False:
+        return None
+    return keys
@@ -0,0 +1,229 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Reconcile the fstab of a running jail with its mounted filesystems."""
+import os
+import typing
+
+import libioc.Config.Jail.File.Fstab
+import libioc.helpers
+import libioc.Logger
+
+MOUNT_BINARY = "/sbin/mount"
+UMOUNT_BINARY = "/sbin/umount"
+
+# filesystems mounted by jail parameters or ZFS instead of the fstab
+UNMANAGED_TYPES = (
+    "devfs",
+    "fdescfs",
+    "procfs",
+    "linprocfs",
+    "linsysfs",
+    "zfs"
+)
+
+
+class MountEntry:
+    """A filesystem that is or should be mounted."""
+
+    source: str
+    destination: str
+    type: str
+    options: str
+
+    def __init__(
+        self,
+        source: str,
+        destination: str,
+        type: str,
+        options: str
+    ) -> None:
+        self.source = _normalize_path(source)
+        self.destination = _normalize_path(destination)
+        self.type = type
+        self.options = options
+
+    @property
+    def readonly(self) -> bool:
+        """Return True when the filesystem is mounted read-only."""
+        return "ro" in self.options.split(",")
+
+    @property
+    def depth(self) -> int:
+        """Return the number of path components of the destination."""
+        return len(self.destination.strip("/").split("/"))
+
+    def matches(self, other: 'MountEntry') -> bool:
+        """Return True when both entries mount the same filesystem alike."""
+        own = (self.source, self.destination, self.type, self.readonly,)
+        return own == (
+            other.source,
+            other.destination,
+            other.type,
+            other.readonly,
+        )
+
+    def is_below(self, destination: str) -> bool:
+        """Return True when the entry is mounted inside the destination."""
+        return self.destination.startswith(f"{destination.rstrip('/')}/")
+
+    def __str__(self) -> str:
+        """Return a humanreadable description of the mount."""
+        return f"{self.source} -> {self.destination} ({self.options})"
+
+
+class FstabReconciliation:
+    """
+    Compute and apply the mount changes that make a jail match its fstab.
+
+    Entries that are mounted but no longer desired, or that changed, are
+    unmounted from the deepest destination upwards. New or changed entries
+    are mounted from the shallowest destination downwards. Unchanged mounts
+    nested inside a changed destination would be shadowed or block the
+    unmount, so that they are unmounted and mounted again as well.
+    """
+
+    unmount: typing.List[MountEntry]
+    mount: typing.List[MountEntry]
+    logger: libioc.Logger.Logger
+
+    def __init__(
+        self,
+        desired: typing.List[MountEntry],
+        current: typing.List[MountEntry],
+        logger: typing.Optional[libioc.Logger.Logger]=None
+    ) -> None:
+        self.logger = libioc.Logger.Logger() if (logger is None) else logger
+        desired_by_destination = dict((x.destination, x,) for x in desired)
+        current_by_destination = dict((x.destination, x,) for x in current)
+
+        unmount = [
+            entry for entry in current
+            if _is_changed(entry, desired_by_destination)
+        ]
+        mount = [
+            entry for entry in desired
+            if _is_changed(entry, current_by_destination)
+        ]
+
+        changed_destinations = set(x.destination for x in (unmount + mount))
+        for entry in desired:
+            if (entry in mount) or (entry.destination in changed_destinations):
+                continue
+            if any(entry.is_below(x) for x in changed_destinations):
+                unmount.append(current_by_destination[entry.destination])
+                mount.append(entry)
+
+        self.unmount = sorted(unmount, key=lambda x: x.depth, reverse=True)
+        self.mount = sorted(mount, key=lambda x: x.depth)
+
+    @property
+    def changed(self) -> bool:
+        """Return True when mounts need to be changed."""
+        return (len(self.unmount) + len(self.mount)) > 0
+
+    def apply(self, force: bool=False) -> None:
+        """Unmount and mount the changed entries."""
+        for entry in self.unmount:
+            command = [UMOUNT_BINARY]
+            if force is True:
+                command.append("-f")
+            command.append(entry.destination)
+            libioc.helpers.exec(command, logger=self.logger)
+            self.logger.verbose(f"Unmounted {entry}")
+
+        for entry in self.mount:
+            os.makedirs(entry.destination, exist_ok=True)
+            libioc.helpers.exec(
+                [
+                    MOUNT_BINARY,
+                    "-t", entry.type,
+                    "-o", entry.options,
+                    entry.source,
+                    entry.destination
+                ],
+                logger=self.logger
+            )
+            self.logger.verbose(f"Mounted {entry}")
+
+
+def get_desired_mounts(
+    fstab: 'libioc.Config.Jail.File.Fstab.Fstab'
+) -> typing.List[MountEntry]:
+    """Return the entries of an fstab, including auto-created lines."""
+    return [
+        MountEntry(
+            source=str(line["source"]),
+            destination=str(line["destination"]),
+            type=line.get("type", "nullfs"),
+            options=line.get("options", "ro")
+        )
+        for line in fstab
+        if isinstance(line, libioc.Config.Jail.File.Fstab.FstabLine)
+    ]
+
+
+def get_current_mounts(
+    root_path: str,
+    logger: typing.Optional[libioc.Logger.Logger]=None
+) -> typing.List[MountEntry]:
+    """Return the fstab managed filesystems mounted inside a jail root."""
+    root_path = _normalize_path(os.path.realpath(root_path))
+    stdout, _, _ = libioc.helpers.exec([MOUNT_BINARY, "-p"], logger=logger)
+    entries = []
+    for line in (stdout or "").splitlines():
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        entry = MountEntry(
+            source=_unescape(fields[0]),
+            destination=_unescape(fields[1]),
+            type=fields[2],
+            options=fields[3]
+        )
+        if entry.is_below(root_path) is False:
+            continue
+        if entry.type in UNMANAGED_TYPES:
+            continue
+        entries.append(entry)
+    return entries
+
+
+def _normalize_path(path: str) -> str:
+    if path == "/":
+        return path
+    return path.rstrip("/")
+
+
+def _unescape(value: str) -> str:
+    # mount -p escapes whitespace in paths with octal sequences
+    return value.replace("\\040", " ").replace("\\011", "\t")
+
+
+def _is_changed(
+    entry: MountEntry,
+    entries_by_destination: typing.Dict[str, MountEntry]
+) -> bool:
+    other = entries_by_destination.get(entry.destination)
+    return (other is None) or (entry.matches(other) is False)
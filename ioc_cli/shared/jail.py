@@ -26,8 +26,10 @@
 import typing
 
 import libioc.errors
+import libioc.Host
 import libioc.Jail
 import libioc.Logger
+import libioc.ZFS
 
 from .click import IocClickContext
 
@@ -47,6 +49,27 @@ def get_jail(
         exit(1)
 
 
+def reload_jail(
+    jail: libioc.Jail.JailGenerator,
+    logger: libioc.Logger.Logger
+) -> libioc.Jail.JailGenerator:
+    """
+    Return a new instance of a jail with its own ZFS handle.
+
+    libzfs handles must not be shared between threads, so that jails
+    processed by concurrent jobs are loaded again from within the job.
+    """
+    zfs = libioc.ZFS.get_zfs(logger=logger)
+    host = libioc.Host.HostGenerator(logger=logger, zfs=zfs)
+    return libioc.Jail.JailGenerator(
+        dict(id=jail.name),
+        root_datasets_name=jail.root_datasets_name,
+        logger=logger,
+        zfs=zfs,
+        host=host
+    )
+
+
 def set_properties(
     properties: typing.Iterable[str],
     target: 'libioc.LaunchableResource.LaunchableResource',
@@ -0,0 +1,162 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Run event generating CLI jobs on a bounded pool of worker threads."""
+import concurrent.futures
+import os
+import queue
+import time
+import typing
+
+import libioc.events
+
+EventGenerator = typing.Generator[
+    typing.Union[libioc.events.IocEvent, bool],
+    None,
+    None
+]
+
+
+def default_job_count() -> int:
+    """Return the number of workers used when --jobs is not specified."""
+    return max(1, min(4, os.cpu_count() or 1))
+
+
+class JobResult:
+    """Outcome of a single job that was run on the pool."""
+
+    name: str
+    value: typing.Optional[bool]
+    error: typing.Optional[BaseException]
+    duration: float
+
+    def __init__(
+        self,
+        name: str,
+        value: typing.Optional[bool]=None,
+        error: typing.Optional[BaseException]=None,
+        duration: float=0
+    ) -> None:
+        self.name = name
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def failed(self) -> bool:
+        """Return True when the job raised an exception."""
+        return self.error is not None
+
+    @property
+    def state(self) -> str:
+        """Return a humanreadable outcome of the job."""
+        if self.failed is True:
+            return "failed"
+        return "changed" if (self.value is True) else "unchanged"
+
+
+class JobPool:
+    """
+    Run multiple event generators concurrently.
+
+    The events emitted by the jobs are passed to the calling thread, so that
+    they can be consumed by print_events, which is not thread-safe. Jobs are
+    callables returning an event generator and are started on the workers,
+    so that all blocking work happens off the main thread.
+    """
+
+    jobs: int
+    results: typing.List[JobResult]
+    _queue: queue.Queue
+    _pending: typing.List[
+        typing.Tuple[str, typing.Callable[[], EventGenerator]]
+    ]
+
+    def __init__(self, jobs: typing.Optional[int]=None) -> None:
+        if (jobs is None) or (jobs < 1):
+            jobs = default_job_count()
+        self.jobs = jobs
+        self.results = []
+        self._queue = queue.Queue()
+        self._pending = []
+
+    def add(
+        self,
+        name: str,
+        job: typing.Callable[[], EventGenerator]
+    ) -> None:
+        """Schedule a job that is started when the pool runs."""
+        self._pending.append((name, job,))
+
+    def run(self) -> typing.Generator[libioc.events.IocEvent, None, None]:
+        """Run all scheduled jobs and yield their events as they arrive."""
+        pending = self._pending
+        self._pending = []
+        remaining = len(pending)
+        if remaining == 0:
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.jobs, remaining)
+        )
+        futures = [
+            executor.submit(self._run_job, name, job)
+            for name, job in pending
+        ]
+        try:
+            while remaining > 0:
+                item = self._queue.get()
+                if isinstance(item, JobResult):
+                    self.results.append(item)
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _run_job(
+        self,
+        name: str,
+        job: typing.Callable[[], EventGenerator]
+    ) -> None:
+        result = JobResult(name)
+        start_time = time.monotonic()
+        try:
+            for event in job():
+                if isinstance(event, bool):
+                    result.value = event
+                    break
+                self._queue.put(event)
+        except BaseException as e:
+            result.error = e
+        finally:
+            result.duration = time.monotonic() - start_time
+            self._queue.put(result)
+
+    @property
+    def failed(self) -> typing.List[JobResult]:
+        """Return the results of all jobs that raised an exception."""
+        return [result for result in self.results if result.failed]
@@ -23,9 +23,19 @@
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 """Use CLI helper functions for console output."""
+import concurrent.futures
+import os
+import sys
 import typing
 import texttable
 
+import libioc.events
+
+from .jobs import JobResult
+
+# seconds between progress updates of long running events
+PROGRESS_INTERVAL = 1.0
+
 
 def print_table(
     data: typing.List[typing.List[str]],
@@ -57,3 +67,52 @@ def print_table(
         table.add_rows(table_data, header=False)
 
     print(table.draw())
+
+
+def print_job_summary(results: typing.Iterable[JobResult]) -> None:
+    """Print the outcome of concurrently executed jobs as a table."""
+    data = [
+        [result.name, result.state, f"{round(result.duration, 3)}s"]
+        for result in results
+    ]
+    print_table(data, ["name", "result", "duration"], sort_key="name")
+
+
+def to_humanreadable_size(size: float) -> str:
+    """Return a byte size with a binary unit suffix."""
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    return f"{round(size, 1)} {unit}"
+
+
+def watch_progress(
+    event: 'libioc.events.IocEvent',
+    function: typing.Callable[[], None],
+    get_progress: typing.Callable[[], str]
+) -> typing.Generator['libioc.events.IocEvent', None, None]:
+    """Run a blocking function and report its progress on the event."""
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        future = executor.submit(function)
+        while True:
+            try:
+                future.result(timeout=PROGRESS_INTERVAL)
+                return
+            except concurrent.futures.TimeoutError:
+                yield event.step(get_progress())
+
+
+def detach_stdout() -> typing.BinaryIO:
+    """
+    Return stdout as binary stream and redirect text output to stderr.
+
+    Everything printed afterwards, including the event output, is written to
+    stderr, so that a data stream written to stdout is not interleaved with
+    messages.
+    """
+    sys.stdout.flush()
+    stdout_fd = sys.stdout.fileno()
+    data_fd = os.dup(stdout_fd)
+    os.dup2(sys.stderr.fileno(), stdout_fd)
+    return os.fdopen(data_fd, "wb")
@@ -0,0 +1,347 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Share the package mirror between jails and concurrent installs."""
+import fcntl
+import json
+import math
+import os
+import time
+import typing
+
+import libioc.errors
+import libioc.events
+import libioc.helpers
+import libioc.Logger
+import libioc.Pkg
+
+# locks and fetch record stored in the package mirror dataset of an ABI
+FETCH_LOCK_FILE = ".fetch.lock"
+INSTALL_LOCK_FILE = ".install.lock"
+FETCH_RECORD_FILE = ".fetched.json"
+
+# default size limit of the package mirror of an ABI in MiB
+CACHE_SIZE_LIMIT = 4096
+
+PACKAGE_ARCHIVE_EXTENSIONS = (".pkg", ".txz", ".tbz", ".tgz", ".tar")
+
+
+class MirrorLock:
+    """
+    Serialize the work on the package mirror of an ABI with flock(2).
+
+    Fetches hold the fetch lock exclusively. Installs share the install
+    lock, which prune acquires exclusively before the fetch lock, so that
+    no archive is removed while a jail installs from the mirror.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        logger: libioc.Logger.Logger,
+        filename: str=FETCH_LOCK_FILE,
+        shared: bool=False
+    ) -> None:
+        self.path = os.path.join(directory, filename)
+        self.logger = logger
+        self.operation = fcntl.LOCK_SH if (shared is True) else fcntl.LOCK_EX
+        self._file: typing.Optional[typing.IO[str]] = None
+
+    def __enter__(self) -> 'MirrorLock':
+        """Acquire the lock and wait while another process holds it."""
+        self._file = open(self.path, "a")
+        try:
+            fcntl.flock(self._file.fileno(), self.operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.logger.verbose("Waiting for the package mirror lock")
+            fcntl.flock(self._file.fileno(), self.operation)
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        """Release the lock."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SharedPkg(libioc.Pkg.Pkg):
+    """
+    Pkg with deduplicated fetches to the shared package mirror.
+
+    The mirror of each release major version is a host-wide dataset that is
+    nullfs-mounted read-only into jails while packages are installed. Fetches
+    to the mirror of an ABI are serialized with a lock. The requested
+    packages and their dependencies are resolved to versions from the
+    repository catalog first, and when all of them were mirrored before,
+    pkg fetch is skipped. An install to many jails therefore only pays for
+    fetching each package version once. Pruning waits until no fetch or
+    install uses the mirror.
+    """
+
+    def lock_installs(
+        self,
+        release: 'libioc.Release.ReleaseGenerator'
+    ) -> MirrorLock:
+        """Return a shared lock that keeps prune off the release mirror."""
+        release_major_version = math.floor(release.version_number)
+        pkg_ds = self._get_release_pkg_dataset(release_major_version)
+        return MirrorLock(
+            pkg_ds.mountpoint,
+            logger=self.logger,
+            filename=INSTALL_LOCK_FILE,
+            shared=True
+        )
+
+    def fetch(
+        self,
+        packages: typing.Union[str, typing.List[str]],
+        release: 'libioc.Release.ReleaseGenerator',
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Fetch packages to the mirror unless all versions are mirrored."""
+        _packages = self._normalize_packages(packages)
+        release_major_version = math.floor(release.version_number)
+        pkg_ds = self._get_release_pkg_dataset(release_major_version)
+
+        fetch_lock = MirrorLock(pkg_ds.mountpoint, logger=self.logger)
+        with self.lock_installs(release), fetch_lock:
+            self._config_host_repo(release_major_version)
+            self._update_host_repo(release_major_version)
+            resolved = self._resolve_package_versions(
+                _packages + ["pkg"],
+                release_major_version
+            )
+
+            record = _read_fetch_record(pkg_ds.mountpoint)
+            if (resolved is not None) and resolved.issubset(record.keys()):
+                packageFetchEvent = libioc.events.PackageFetch(
+                    packages=_packages,
+                    scope=event_scope
+                )
+                yield packageFetchEvent.begin()
+                yield packageFetchEvent.skip("all versions mirrored")
+                return
+
+            yield from super().fetch(
+                packages=list(_packages),
+                release=release,
+                event_scope=event_scope
+            )
+
+            if resolved is not None:
+                now = time.time()
+                for package in resolved:
+                    record[package] = now
+                _write_fetch_record(pkg_ds.mountpoint, record)
+
+    def install(
+        self,
+        packages: typing.Union[str, typing.List[str]],
+        jail: 'libioc.Jail.JailGenerator',
+        event_scope: typing.Optional['libioc.events.Scope']=None,
+        **kwargs: typing.Any
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Install packages from the mirror while no prune can run."""
+        with self.lock_installs(jail.release):
+            yield from super().install(
+                packages=packages,
+                jail=jail,
+                event_scope=event_scope,
+                **kwargs
+            )
+
+    def _resolve_package_versions(
+        self,
+        packages: typing.List[str],
+        release_major_version: int
+    ) -> typing.Optional[typing.Set[str]]:
+        """
+        Resolve packages and their dependencies from the repository catalog.
+
+        Returns the repository qualified name-version of every package that
+        pkg fetch --dependencies mirrors, or None when the catalog does not
+        know one of the packages.
+        """
+        repo_name = self._get_repo_name(release_major_version)
+        command = self._get_pkg_command(release_major_version) + [
+            "rquery",
+            "--repository", repo_name
+        ]
+        resolved: typing.Set[str] = set()
+        seen: typing.Set[str] = set()
+        pending = set(packages)
+        while len(pending) > 0:
+            seen.update(pending)
+            names = sorted(pending)
+            versions, _, returncode = libioc.helpers.exec(
+                command + ["%n-%v"] + names,
+                logger=self.logger,
+                ignore_error=True
+            )
+            dependencies, _, _ = libioc.helpers.exec(
+                command + ["%dn"] + names,
+                logger=self.logger,
+                ignore_error=True
+            )
+            found = (versions or "").split()
+            if (returncode != 0) or (len(found) < len(names)):
+                return None
+            resolved.update(f"{repo_name}/{version}" for version in found)
+            pending = set((dependencies or "").split()) - seen
+        return resolved
+
+    def prune(
+        self,
+        release: 'libioc.Release.ReleaseGenerator',
+        size_limit: int
+    ) -> int:
+        """
+        Shrink the package mirror of a release below a size limit in bytes.
+
+        Superseded versions of a package are removed first, then the least
+        recently fetched archives. The newest pkg archive is kept, because it
+        bootstraps pkg in jails. Returns the number of bytes freed.
+        """
+        release_major_version = math.floor(release.version_number)
+        pkg_ds = self._get_release_pkg_dataset(release_major_version)
+        cache_directory = os.path.join(pkg_ds.mountpoint, "cache")
+
+        install_lock = MirrorLock(
+            pkg_ds.mountpoint,
+            logger=self.logger,
+            filename=INSTALL_LOCK_FILE
+        )
+        # fetches and installs take the install lock before the fetch lock
+        with install_lock, MirrorLock(pkg_ds.mountpoint, logger=self.logger):
+            archives = _list_package_archives(cache_directory)
+            total_size = sum(size for _, _, _, size in archives)
+            if total_size <= size_limit:
+                return 0
+
+            freed_size = 0
+            removed_versions = set()
+            for path, size in _get_prune_candidates(archives):
+                if (total_size - freed_size) <= size_limit:
+                    break
+                os.remove(path)
+                freed_size += size
+                filename = os.path.basename(path)
+                removed_versions.add(os.path.splitext(filename)[0])
+            _remove_dangling_links(cache_directory)
+
+            # forget removed versions so that they are fetched again
+            record = _read_fetch_record(pkg_ds.mountpoint)
+            _write_fetch_record(pkg_ds.mountpoint, dict(
+                (key, fetched_at,) for key, fetched_at in record.items()
+                if key.split("/", maxsplit=1)[-1] not in removed_versions
+            ))
+            self._build_mirror_index(release_major_version)
+
+        self.logger.verbose(
+            f"Pruned {freed_size} bytes from the package mirror "
+            f"of release {release_major_version}"
+        )
+        return freed_size
+
+
+def install_shared_pkg() -> None:
+    """
+    Let libioc install packages through the shared package mirror locks.
+
+    Provisioners create their own libioc.Pkg.Pkg instances, so that their
+    fetches would otherwise race concurrent fetches, installs and prunes.
+    """
+    libioc.Pkg.Pkg = SharedPkg  # type: ignore
+
+
+def _read_fetch_record(directory: str) -> typing.Dict[str, float]:
+    try:
+        with open(os.path.join(directory, FETCH_RECORD_FILE), "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return record if isinstance(record, dict) else {}
+
+
+def _write_fetch_record(
+    directory: str,
+    record: typing.Dict[str, float]
+) -> None:
+    path = os.path.join(directory, FETCH_RECORD_FILE)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(record, f)
+    os.rename(temporary_path, path)
+
+
+def _get_package_name(filename: str) -> str:
+    """Return the package name of an archive like name-1.0~abc.txz."""
+    return filename.rsplit("-", maxsplit=1)[0]
+
+
+def _list_package_archives(
+    directory: str
+) -> typing.List[typing.Tuple[str, str, float, int]]:
+    """Return path, package name, mtime and size of mirrored archives."""
+    archives = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(PACKAGE_ARCHIVE_EXTENSIONS) is False:
+                continue
+            path = os.path.join(root, filename)
+            if os.path.islink(path) is True:
+                continue
+            stat = os.stat(path)
+            archives.append((
+                path,
+                _get_package_name(filename),
+                stat.st_mtime,
+                stat.st_size
+            ))
+    return archives
+
+
+def _get_prune_candidates(
+    archives: typing.List[typing.Tuple[str, str, float, int]]
+) -> typing.List[typing.Tuple[str, int]]:
+    """Return archives in the order they are pruned."""
+    newest: typing.Dict[str, typing.Tuple[str, str, float, int]] = {}
+    for archive in archives:
+        name = archive[1]
+        if (name not in newest) or (newest[name][2] < archive[2]):
+            newest[name] = archive
+
+    superseded = [x for x in archives if newest[x[1]] is not x]
+    current = [x for x in newest.values() if x[1] != "pkg"]
+    superseded.sort(key=lambda x: x[2])
+    current.sort(key=lambda x: x[2])
+    return [(x[0], x[3],) for x in (superseded + current)]
+
+
+def _remove_dangling_links(directory: str) -> None:
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if os.path.islink(path) and not os.path.exists(path):
+                os.remove(path)
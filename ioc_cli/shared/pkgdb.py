@@ -0,0 +1,293 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Read the package databases of jails and audit them against VuXML."""
+import concurrent.futures
+import os.path
+import re
+import sqlite3
+import typing
+
+import defusedxml.ElementTree
+
+from .jobs import default_job_count
+
+# path of the pkg database relative to the root of a jail
+PKG_DATABASE = "var/db/pkg/local.sqlite"
+
+# vulnerability database fetched by `pkg audit -F`
+DEFAULT_VULNXML = "/var/db/pkg/vuln.xml"
+
+VUXML_NAMESPACE = "{http://www.vuxml.org/apps/vuxml-1}"
+
+_PRERELEASE_WORDS = ("alpha", "beta", "pre", "rc")
+_VERSION_ATOM_PATTERN = re.compile(r"[0-9]+|[a-z]+")
+
+
+class PkgDatabaseError(Exception):
+    """Raised when a package or vulnerability database cannot be read."""
+
+    pass
+
+
+class InstalledPackage:
+    """A package installed in a jail."""
+
+    name: str
+    version: str
+    origin: str
+
+    def __init__(self, name: str, version: str, origin: str) -> None:
+        self.name = name
+        self.version = version
+        self.origin = origin
+
+
+class Vulnerability:
+    """A VuXML entry affecting a range of package versions."""
+
+    vid: str
+    topic: str
+    references: typing.List[str]
+
+    def __init__(
+        self,
+        vid: str,
+        topic: str,
+        references: typing.List[str]
+    ) -> None:
+        self.vid = vid
+        self.topic = topic
+        self.references = references
+
+
+def read_installed_packages(root_path: str) -> typing.List[InstalledPackage]:
+    """
+    Read the installed packages from the pkg database of a jail root.
+
+    The database path is resolved on the host, so that a symlink placed
+    inside the jail cannot point the reader to files outside of its root.
+    """
+    real_root_path = os.path.realpath(root_path)
+    database_path = os.path.realpath(os.path.join(root_path, PKG_DATABASE))
+    if os.path.commonpath([real_root_path, database_path]) != real_root_path:
+        raise PkgDatabaseError(
+            f"The pkg database of {root_path} points outside of the jail"
+        )
+    if os.path.isfile(database_path) is False:
+        return []
+    connection = sqlite3.connect(
+        f"file:{database_path}?mode=ro",
+        uri=True,
+        check_same_thread=False
+    )
+    try:
+        rows = connection.execute(
+            "SELECT name, version, origin FROM packages ORDER BY name"
+        ).fetchall()
+    finally:
+        connection.close()
+    return [InstalledPackage(*row) for row in rows]
+
+
+def iter_inventories(
+    root_paths: typing.Dict[str, str],
+    jobs: typing.Optional[int]=None
+) -> typing.Generator[
+    typing.Tuple[str, typing.Union[typing.List[InstalledPackage], Exception]],
+    None,
+    None
+]:
+    """
+    Read the package databases of many jails concurrently.
+
+    The packages of each jail are yielded as soon as its database was read,
+    or the exception reading it raised.
+    """
+    if (jobs is None) or (jobs < 1):
+        jobs = default_job_count()
+    if len(root_paths) == 0:
+        return
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = dict(
+            (executor.submit(read_installed_packages, root_path), name,)
+            for name, root_path in root_paths.items()
+        )
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield (futures[future], future.result(),)
+            except (sqlite3.Error, OSError, PkgDatabaseError) as e:
+                yield (futures[future], e,)
+
+
+def _split_version(version: str) -> typing.Tuple[int, str, int]:
+    """Split a version like 1.2.3_4,1 into epoch, version and revision."""
+    epoch = 0
+    revision = 0
+    if "," in version:
+        version, _epoch = version.rsplit(",", maxsplit=1)
+        epoch = int(_epoch) if _epoch.isdigit() else 0
+    if "_" in version:
+        version, _revision = version.rsplit("_", maxsplit=1)
+        revision = int(_revision) if _revision.isdigit() else 0
+    return (epoch, version, revision,)
+
+
+def _get_version_atoms(
+    version: str
+) -> typing.List[typing.Tuple[int, int, str]]:
+    atoms = []
+    for atom in _VERSION_ATOM_PATTERN.findall(version.lower()):
+        if atom.isdigit():
+            atoms.append((1, int(atom), "",))
+        elif atom in _PRERELEASE_WORDS:
+            # 1.0rc1 comes before 1.0
+            atoms.append((0, _PRERELEASE_WORDS.index(atom), "",))
+        else:
+            # 1.1.1k and 1.0pl1 come after 1.1.1 and 1.0
+            atoms.append((2, 0, atom,))
+    return atoms
+
+
+def compare_versions(a: str, b: str) -> int:
+    """
+    Compare two package versions like pkg-version(8).
+
+    Returns a negative number when a is older than b, zero when both are
+    equal and a positive number when a is newer than b. Epoch and port
+    revision are honoured, letters following a number denote later
+    versions and alpha, beta, pre and rc denote earlier versions.
+    """
+    epoch_a, version_a, revision_a = _split_version(a)
+    epoch_b, version_b, revision_b = _split_version(b)
+    if epoch_a != epoch_b:
+        return epoch_a - epoch_b
+
+    atoms_a = _get_version_atoms(version_a)
+    atoms_b = _get_version_atoms(version_b)
+    padding = (1, 0, "",)
+    for index in range(max(len(atoms_a), len(atoms_b))):
+        atom_a = atoms_a[index] if (index < len(atoms_a)) else padding
+        atom_b = atoms_b[index] if (index < len(atoms_b)) else padding
+        if atom_a != atom_b:
+            return -1 if (atom_a < atom_b) else 1
+
+    return revision_a - revision_b
+
+
+_RANGE_OPERATORS: typing.Dict[str, typing.Callable[[int], bool]] = dict(
+    lt=lambda x: x < 0,
+    le=lambda x: x <= 0,
+    eq=lambda x: x == 0,
+    ge=lambda x: x >= 0,
+    gt=lambda x: x > 0
+)
+
+
+class VulnerabilityDatabase:
+    """
+    Match package versions against a VuXML vulnerability database.
+
+    The database is parsed incrementally and only the affected package
+    ranges and a few descriptive fields are kept in memory. Matches are
+    memoized per package version, because fleets of jails mostly share
+    the same package versions.
+    """
+
+    path: str
+    _affected: typing.Dict[str, typing.List[typing.Tuple[
+        Vulnerability,
+        typing.List[typing.List[typing.Tuple[str, str]]]
+    ]]]
+    _matches: typing.Dict[typing.Tuple[str, str], typing.List[Vulnerability]]
+
+    def __init__(self, path: str=DEFAULT_VULNXML) -> None:
+        self.path = path
+        self._affected = {}
+        self._matches = {}
+        self._load()
+
+    def match(self, name: str, version: str) -> typing.List[Vulnerability]:
+        """Return the vulnerabilities affecting a package version."""
+        key = (name, version,)
+        if key not in self._matches:
+            self._matches[key] = [
+                vulnerability
+                for vulnerability, ranges in self._affected.get(name, [])
+                if any(_in_range(version, r) for r in ranges)
+            ]
+        return self._matches[key]
+
+    def _load(self) -> None:
+        try:
+            self._parse()
+        except (
+            defusedxml.ElementTree.ParseError,
+            defusedxml.DefusedXmlException
+        ) as e:
+            raise PkgDatabaseError(
+                f"The vulnerability database {self.path} is invalid: {e}"
+            )
+
+    def _parse(self) -> None:
+        ns = VUXML_NAMESPACE
+        for _, element in defusedxml.ElementTree.iterparse(self.path):
+            if element.tag != f"{ns}vuln":
+                continue
+
+            vulnerability = Vulnerability(
+                vid=element.get("vid", ""),
+                topic=(element.findtext(f"{ns}topic") or "").strip(),
+                references=[
+                    reference.text.strip()
+                    for reference in element.iter(f"{ns}cvename")
+                    if reference.text is not None
+                ]
+            )
+            for package in element.iter(f"{ns}package"):
+                ranges = [
+                    [
+                        (condition.tag[len(ns):], (condition.text or ""))
+                        for condition in version_range
+                    ]
+                    for version_range in package.iter(f"{ns}range")
+                ]
+                for name in package.iter(f"{ns}name"):
+                    self._affected.setdefault(name.text or "", []).append(
+                        (vulnerability, ranges,)
+                    )
+            element.clear()
+
+
+def _in_range(
+    version: str,
+    conditions: typing.List[typing.Tuple[str, str]]
+) -> bool:
+    for operator, bound in conditions:
+        if operator not in _RANGE_OPERATORS:
+            return False
+        difference = compare_versions(version, bound)
+        if _RANGE_OPERATORS[operator](difference) is False:
+            return False
+    return len(conditions) > 0
@@ -0,0 +1,535 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Relocate jails between root dataset sources with ZFS send and receive."""
+import time
+import typing
+
+import libzfs
+
+import libioc.Config.Jail.File.Fstab
+import libioc.errors
+import libioc.events
+import libioc.Jail
+import libioc.Logger
+
+from .output import to_humanreadable_size, watch_progress
+from .zfs import (
+    abort_receive,
+    create_snapshots,
+    destroy_snapshots,
+    get_resume_token,
+    get_written_size,
+    list_snapshot_names,
+    send_receive
+)
+
+SNAPSHOT_PREFIX = "ioc-move-"
+
+# changes of a running jail that are small enough to stop it
+PRECOPY_THRESHOLD = 64 * 1024 * 1024
+PRECOPY_ROUNDS = 5
+
+# child of a source that holds received and retired jail datasets
+STAGING_DATASET = "relocate"
+
+
+class JailRelocate(libioc.events.JailEvent):
+    """Relocate a jail to another root dataset source."""
+
+    pass
+
+
+class JailRelocationTransfer(libioc.events.JailEvent):
+    """Send the datasets of a jail to the target source."""
+
+    pass
+
+
+class JailRelocationVerify(libioc.events.JailEvent):
+    """Compare the transferred snapshots with their sources."""
+
+    pass
+
+
+class JailRelocationSwap(libioc.events.JailEvent):
+    """Replace the jail dataset with the transferred one."""
+
+    pass
+
+
+class JailRelocation:
+    """
+    Move a jail to another root dataset source.
+
+    The datasets of the jail are sent one by one into a staging dataset of
+    the target source with resumable receives. When a relocation was
+    interrupted, the next attempt continues the partial streams from their
+    resume tokens and afterwards sends the changes since the last
+    transferred snapshot incrementally.
+
+    Once the received snapshots match their sources GUIDs, the jail is
+    swapped with two renames: the source dataset is retired to the staging
+    dataset of its own source before the received dataset takes its place
+    in the jails dataset of the target. Sources on the same pool are
+    relocated with a single rename.
+
+    Running jails can be relocated live: they are transferred repeatedly
+    while running, so that only the last small increment is sent while the
+    jail is stopped.
+    """
+
+    jail: 'libioc.Jail.JailGenerator'
+    target_source: str
+    logger: 'libioc.Logger.Logger'
+    transferred_bytes: int
+    downtime: typing.Optional[float]
+
+    def __init__(
+        self,
+        jail: 'libioc.Jail.JailGenerator',
+        target_source: str,
+        logger: typing.Optional['libioc.Logger.Logger']=None
+    ) -> None:
+        self.jail = jail
+        self.target_source = target_source
+        self.logger = jail.logger if (logger is None) else logger
+        self.transferred_bytes = 0
+        self.downtime = None
+        self._swapped = False
+        self._source_dataset_name = jail.dataset.name
+        self._source_mountpoint = jail.dataset.mountpoint
+
+    @property
+    def zfs(self) -> 'libioc.ZFS.ZFS':
+        """Return the ZFS handle of the jail."""
+        return self.jail.zfs
+
+    @property
+    def source_dataset_name(self) -> str:
+        """Return the name of the jail dataset before the relocation."""
+        return str(self._source_dataset_name)
+
+    @property
+    def destination_dataset_name(self) -> str:
+        """Return the name of the jail dataset in the target source."""
+        target = self.jail.host.datasets.get_root_source(self.target_source)
+        return f"{target.jails.name}/{self.jail.name}"
+
+    @property
+    def staging_dataset_name(self) -> str:
+        """Return the name of the dataset that receives the jail."""
+        target = self.jail.host.datasets.get_root_source(self.target_source)
+        return f"{target.root.name}/{STAGING_DATASET}/{self.jail.name}"
+
+    @property
+    def retired_dataset_name(self) -> str:
+        """Return the name that the source dataset is retired to."""
+        source = self.jail.host.datasets.find_root_datasets(
+            self.source_dataset_name
+        )
+        return f"{source.root.name}/{STAGING_DATASET}/{self.jail.name}"
+
+    @property
+    def same_pool(self) -> bool:
+        """Return True when the jail can be relocated with a rename."""
+        source_pool = self.source_dataset_name.split("/", maxsplit=1)[0]
+        target_pool = self.destination_dataset_name.split("/", maxsplit=1)[0]
+        return (source_pool == target_pool)
+
+    def relocate(
+        self,
+        keep_source: bool=False,
+        live: bool=False,
+        precopy_threshold: int=PRECOPY_THRESHOLD,
+        precopy_rounds: int=PRECOPY_ROUNDS,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """
+        Relocate the jail to the target source.
+
+        Args:
+            keep_source (bool):
+                Keep the retired source dataset instead of destroying it
+
+            live (bool):
+                Relocate a running jail. Its datasets are transferred while
+                it keeps running, until the changes since the last transfer
+                are smaller than precopy_threshold bytes or precopy_rounds
+                transfers were made. Then the jail is stopped, the remaining
+                changes are sent and the jail is started in the target
+                source. The time it was not running is stored in downtime.
+        """
+        jailRelocateEvent = JailRelocate(jail=self.jail, scope=event_scope)
+        _scope = jailRelocateEvent.scope
+        yield jailRelocateEvent.begin()
+
+        restart = (live is True) and (self.jail.running is True)
+        try:
+            if restart is False:
+                self.jail.require_jail_stopped()
+            self._require_destination_available()
+            if (restart is True) and (self.same_pool is False):
+                yield from self._precopy(
+                    precopy_threshold,
+                    precopy_rounds,
+                    event_scope=_scope
+                )
+            if restart is True:
+                stopped_at = time.monotonic()
+                yield from self.jail.stop(event_scope=_scope)
+                jailRelocateEvent.add_rollback_step(self._restart_source)
+            if self.same_pool is True:
+                yield from self._rename(event_scope=_scope)
+            else:
+                snapshot_name = self.take_snapshot()
+                yield from self.transfer(snapshot_name, event_scope=_scope)
+                yield from self.verify(snapshot_name, event_scope=_scope)
+                yield from self.swap(keep_source, event_scope=_scope)
+            if restart is True:
+                yield from self._get_relocated_jail().start(
+                    event_scope=_scope
+                )
+                self.downtime = time.monotonic() - stopped_at
+        except libioc.errors.IocException as e:
+            yield from jailRelocateEvent.fail_generator(e)
+            raise e
+
+        if self.downtime is None:
+            yield jailRelocateEvent.end()
+        else:
+            downtime = round(self.downtime, 3)
+            yield jailRelocateEvent.end(f"downtime {downtime}s")
+
+    def take_snapshot(self) -> str:
+        """Take a recursive snapshot of the jail and return its name."""
+        indices = [
+            int(name[len(SNAPSHOT_PREFIX):])
+            for name in self._list_relocation_snapshots(
+                self.source_dataset_name
+            )
+        ]
+        snapshot_name = f"{SNAPSHOT_PREFIX}{max(indices, default=0) + 1}"
+        create_snapshots(
+            [f"{self.source_dataset_name}@{snapshot_name}"],
+            recursive=True,
+            logger=self.logger
+        )
+        return snapshot_name
+
+    def transfer(
+        self,
+        snapshot_name: str,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Send all jail datasets up to the snapshot to the staging dataset."""
+        transferEvent = JailRelocationTransfer(
+            jail=self.jail,
+            scope=event_scope
+        )
+        yield transferEvent.begin()
+
+        self.zfs.get_or_create_dataset(
+            self.staging_dataset_name.rsplit("/", maxsplit=1)[0]
+        )
+        transferred_before = self.transferred_bytes
+        try:
+            for source_name, target_name in self._get_dataset_pairs():
+                yield from watch_progress(
+                    transferEvent,
+                    lambda: self._send_dataset(
+                        source_name,
+                        target_name,
+                        snapshot_name
+                    ),
+                    lambda: _format_size(self.transferred_bytes, "sent")
+                )
+        except (libioc.errors.IocException, libzfs.ZFSException) as e:
+            yield from transferEvent.fail_generator(e)
+            raise e
+
+        size = self.transferred_bytes - transferred_before
+        yield transferEvent.end(f"@{snapshot_name} ({_format_size(size)})")
+
+    def verify(
+        self,
+        snapshot_name: str,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Compare the GUIDs of the received snapshots with their sources."""
+        verifyEvent = JailRelocationVerify(jail=self.jail, scope=event_scope)
+        yield verifyEvent.begin()
+
+        for source_name, target_name in self._get_dataset_pairs():
+            source_guid = self._get_snapshot_guid(
+                f"{source_name}@{snapshot_name}"
+            )
+            target_guid = self._get_snapshot_guid(
+                f"{target_name}@{snapshot_name}"
+            )
+            if (target_guid is None) or (source_guid != target_guid):
+                error = libioc.errors.ZFSException(
+                    message=(
+                        f"The received snapshot {target_name}@{snapshot_name}"
+                        f" does not match {source_name}@{snapshot_name}"
+                    ),
+                    logger=self.logger
+                )
+                yield from verifyEvent.fail_generator(error)
+                raise error
+
+        yield verifyEvent.end()
+
+    def swap(
+        self,
+        keep_source: bool=False,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Put the received datasets in place of the jail dataset."""
+        swapEvent = JailRelocationSwap(jail=self.jail, scope=event_scope)
+        yield swapEvent.begin()
+
+        source_name = self.source_dataset_name
+        retired_name = self.retired_dataset_name
+        try:
+            self.zfs.get_or_create_dataset(
+                retired_name.rsplit("/", maxsplit=1)[0]
+            )
+            self.zfs.get_dataset(source_name).rename(retired_name)
+
+            def _restore_source() -> None:
+                self.logger.verbose(f"Restoring {source_name}")
+                self.zfs.get_dataset(retired_name).rename(source_name)
+            swapEvent.add_rollback_step(_restore_source)
+
+            staging_name = self.staging_dataset_name
+            destination_name = self.destination_dataset_name
+            self.zfs.get_dataset(staging_name).rename(destination_name)
+
+            def _restore_staging() -> None:
+                self.zfs.get_dataset(destination_name).rename(staging_name)
+            swapEvent.add_rollback_step(_restore_staging)
+
+            destination = self.zfs.get_dataset(self.destination_dataset_name)
+            destination.mount_recursive()
+            self._swapped = True
+        except libzfs.ZFSException as e:
+            error = libioc.errors.ZFSException(
+                message=f"Swapping the jail datasets failed: {e}",
+                logger=self.logger
+            )
+            yield from swapEvent.fail_generator(error)
+            raise error
+
+        self._relocate_fstab()
+        destroy_snapshots(
+            self.destination_dataset_name,
+            self._list_relocation_snapshots(self.destination_dataset_name),
+            logger=self.logger
+        )
+        if keep_source is True:
+            self.logger.verbose(f"The source was retired to {retired_name}")
+        else:
+            self.zfs.delete_dataset_recursive(
+                self.zfs.get_dataset(retired_name)
+            )
+
+        yield swapEvent.end()
+
+    def _precopy(
+        self,
+        threshold: int,
+        rounds: int,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        """Transfer the running jail until its changes become small."""
+        for i in range(1, max(1, rounds) + 1):
+            snapshot_name = self.take_snapshot()
+            yield from self.transfer(snapshot_name, event_scope=event_scope)
+            changed = get_written_size(self.source_dataset_name, self.logger)
+            self.logger.verbose(
+                f"Pre-copy round {i}: {_format_size(changed)} changed "
+                f"since @{snapshot_name}"
+            )
+            if changed <= threshold:
+                return
+
+    def _restart_source(self) -> typing.Generator[
+        'libioc.events.IocEvent',
+        None,
+        None
+    ]:
+        if self._swapped is True:
+            return
+        self.logger.verbose(f"Starting {self.jail.humanreadable_name} again")
+        yield from self.jail.start()
+
+    def _rename(
+        self,
+        event_scope: typing.Optional['libioc.events.Scope']=None
+    ) -> typing.Generator['libioc.events.IocEvent', None, None]:
+        swapEvent = JailRelocationSwap(jail=self.jail, scope=event_scope)
+        yield swapEvent.begin()
+        try:
+            self.zfs.get_dataset(self.source_dataset_name).rename(
+                self.destination_dataset_name
+            )
+        except libzfs.ZFSException as e:
+            error = libioc.errors.ZFSException(
+                message=f"Renaming the jail dataset failed: {e}",
+                logger=self.logger
+            )
+            yield from swapEvent.fail_generator(error)
+            raise error
+        self._swapped = True
+        self._relocate_fstab()
+        yield swapEvent.end()
+
+    def _require_destination_available(self) -> None:
+        for dataset_name in (
+            self.destination_dataset_name,
+            self.retired_dataset_name
+        ):
+            try:
+                self.zfs.get_dataset(dataset_name)
+            except libzfs.ZFSException:
+                continue
+            raise libioc.errors.ZFSException(
+                message=f"The dataset {dataset_name} already exists",
+                logger=self.logger
+            )
+
+    def _get_dataset_pairs(self) -> typing.List[typing.Tuple[str, str]]:
+        """Return the source and staging names of all jail datasets."""
+        source_dataset = self.zfs.get_dataset(self.source_dataset_name)
+        names = sorted([source_dataset.name] + [
+            child.name for child in source_dataset.children_recursive
+        ])
+        prefix_length = len(self.source_dataset_name)
+        return [
+            (name, f"{self.staging_dataset_name}{name[prefix_length:]}",)
+            for name in names
+        ]
+
+    def _send_dataset(
+        self,
+        source_name: str,
+        target_name: str,
+        snapshot_name: str
+    ) -> None:
+        transferred_before = self.transferred_bytes
+
+        def _progress(transferred: int) -> None:
+            self.transferred_bytes = transferred_before + transferred
+
+        resume_token = get_resume_token(target_name, logger=self.logger)
+        if resume_token is not None:
+            try:
+                description = self.zfs.describe_resume_token(resume_token)
+                self.logger.verbose(
+                    f"Resuming the transfer of {description.get('toname')}"
+                )
+                send_receive(
+                    f"{source_name}@{snapshot_name}",
+                    target_name,
+                    resume_token=resume_token,
+                    progress=_progress,
+                    logger=self.logger
+                )
+            except (libioc.errors.ZFSException, libzfs.ZFSException):
+                self.logger.warn(
+                    f"Discarding the interrupted transfer to {target_name}"
+                )
+                abort_receive(target_name, logger=self.logger)
+            transferred_before = self.transferred_bytes
+
+        target_snapshots = list_snapshot_names(target_name, self.logger)
+        if snapshot_name in target_snapshots:
+            return
+
+        source_snapshots = set(list_snapshot_names(source_name, self.logger))
+        common_snapshots = [
+            name for name in target_snapshots if name in source_snapshots
+        ]
+        fromname = None
+        if len(common_snapshots) > 0:
+            fromname = f"{source_name}@{common_snapshots[-1]}"
+        send_receive(
+            f"{source_name}@{snapshot_name}",
+            target_name,
+            fromname=fromname,
+            force=(fromname is not None),
+            progress=_progress,
+            logger=self.logger
+        )
+
+    def _get_snapshot_guid(self, identifier: str) -> typing.Optional[str]:
+        try:
+            snapshot = self.zfs.get_snapshot(identifier)
+        except libzfs.ZFSException:
+            return None
+        return str(snapshot.properties["guid"].value)
+
+    def _list_relocation_snapshots(
+        self,
+        dataset_name: str
+    ) -> typing.List[str]:
+        prefix_length = len(SNAPSHOT_PREFIX)
+        snapshot_names = list_snapshot_names(dataset_name, self.logger)
+        return [
+            name for name in snapshot_names
+            if name.startswith(SNAPSHOT_PREFIX) and (
+                name[prefix_length:].isdigit() is True
+            )
+        ]
+
+    def _get_relocated_jail(self) -> 'libioc.Jail.JailGenerator':
+        return libioc.Jail.JailGenerator(
+            dict(id=self.jail.name),
+            root_datasets_name=self.target_source,
+            logger=self.logger,
+            zfs=self.zfs,
+            host=self.jail.host
+        )
+
+    def _relocate_fstab(self) -> None:
+        """Rewrite fstab paths from the previous to the new mountpoint."""
+        jail = self._get_relocated_jail()
+        if jail.dataset.mountpoint == self._source_mountpoint:
+            return
+        fstab = libioc.Config.Jail.File.Fstab.Fstab(
+            jail=jail,
+            release=None,
+            logger=self.logger,
+            host=jail.host
+        )
+        fstab.read_file()
+        fstab.replace_path(self._source_mountpoint, jail.dataset.mountpoint)
+        fstab.save()
+
+
+def _format_size(size: int, verb: typing.Optional[str]=None) -> str:
+    if verb is None:
+        return to_humanreadable_size(size)
+    return f"{to_humanreadable_size(size)} {verb}"
@@ -0,0 +1,108 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Select snapshots to prune with declarative retention rules."""
+import datetime
+import typing
+
+Snapshot = typing.Dict[str, typing.Any]
+
+# strftime patterns that put snapshots of the same period into one bucket
+RETENTION_PERIODS = [
+    ("hourly", "%Y-%m-%d %H",),
+    ("daily", "%Y-%m-%d",),
+    ("weekly", "%G-%V",),
+    ("monthly", "%Y-%m",),
+    ("yearly", "%Y",)
+]
+
+
+class RetentionPolicy:
+    """
+    Decide which snapshots of a dataset are kept.
+
+    Like the retention rules of common backup tools, the latest snapshots
+    are kept as well as the latest snapshot of each of the last hours,
+    days, weeks, months and years that have snapshots. A snapshot that is
+    kept by any rule is not pruned.
+    """
+
+    keep_last: int
+    keep_periods: typing.Dict[str, int]
+
+    def __init__(
+        self,
+        keep_last: int=0,
+        **keep_periods: int
+    ) -> None:
+        unknown_periods = set(keep_periods.keys()) - set(
+            name for name, _ in RETENTION_PERIODS
+        )
+        if len(unknown_periods) > 0:
+            raise ValueError(f"Unknown retention periods: {unknown_periods}")
+        self.keep_last = keep_last
+        self.keep_periods = keep_periods
+
+    @property
+    def empty(self) -> bool:
+        """Return True if the policy would not keep any snapshot."""
+        return (self.keep_last <= 0) and all(
+            count <= 0 for count in self.keep_periods.values()
+        )
+
+    def select(
+        self,
+        snapshots: typing.Iterable[Snapshot]
+    ) -> typing.Tuple[typing.List[Snapshot], typing.List[Snapshot]]:
+        """
+        Split snapshots into the ones to keep and the ones to prune.
+
+        Snapshots are dicts with a name and the creation time as UNIX
+        timestamp, as returned by list_snapshots.
+        """
+        ordered_snapshots = sorted(
+            snapshots,
+            key=lambda x: (x["creation"], x["name"],),
+            reverse=True
+        )
+        kept_names = set(
+            snapshot["name"]
+            for snapshot in ordered_snapshots[:max(0, self.keep_last)]
+        )
+        for period, pattern in RETENTION_PERIODS:
+            count = self.keep_periods.get(period, 0)
+            buckets: typing.Set[str] = set()
+            for snapshot in ordered_snapshots:
+                if len(buckets) >= count:
+                    break
+                bucket = datetime.datetime.fromtimestamp(
+                    snapshot["creation"]
+                ).strftime(pattern)
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    kept_names.add(snapshot["name"])
+
+        kept = [x for x in ordered_snapshots if x["name"] in kept_names]
+        pruned = [x for x in ordered_snapshots if x["name"] not in kept_names]
+        return kept, pruned
@@ -0,0 +1,298 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Seekable gzip archives with an embedded file index."""
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import os
+import struct
+import tarfile
+import typing
+
+import libioc.errors
+
+from .compression import DEFAULT_BLOCK_SIZE, GZIP_MAGIC
+
+SEEKABLE_INDEX_VERSION = 1
+
+# the footer is an empty gzip member with an extra field that points to the
+# index, so that it is skipped by every gzip implementation
+FOOTER_SUBFIELD_ID = b"IX"
+FOOTER_FORMAT = "<QQ"
+FOOTER_EXTRA = b"".join([
+    FOOTER_SUBFIELD_ID,
+    struct.pack("<H", struct.calcsize(FOOTER_FORMAT))
+])
+FOOTER_HEADER = b"".join([
+    GZIP_MAGIC,
+    b"\x08\x04",
+    b"\x00\x00\x00\x00",
+    b"\x00\xff",
+    struct.pack("<H", len(FOOTER_EXTRA) + struct.calcsize(FOOTER_FORMAT)),
+    FOOTER_EXTRA
+])
+# an empty final deflate block followed by the CRC32 and size of nothing
+FOOTER_TRAILER = b"\x03\x00" + struct.pack("<LL", 0, 0)
+FOOTER_SIZE = sum([
+    len(FOOTER_HEADER),
+    struct.calcsize(FOOTER_FORMAT),
+    len(FOOTER_TRAILER)
+])
+
+# archive member name -> (offset, length) in the uncompressed tar stream
+FileIndex = typing.Dict[str, typing.Tuple[int, int]]
+
+
+class SeekableGzipWriter(io.RawIOBase):
+    """
+    Write a gzip stream of independently compressed frames.
+
+    Every frame is a complete gzip member, so that the archive can be read
+    by every gzip implementation as a whole, while single frames can be
+    decompressed on their own. The frames are compressed on multiple
+    threads. On close the offsets of all frames and the file index are
+    appended in a JSON gzip member that is located by a fixed size footer.
+    """
+
+    files: FileIndex
+
+    def __init__(
+        self,
+        fileobj: typing.BinaryIO,
+        threads: int,
+        level: int=6,
+        frame_size: int=DEFAULT_BLOCK_SIZE
+    ) -> None:
+        self.fileobj = fileobj
+        self.level = level
+        self.frame_size = frame_size
+        self.threads = max(1, threads)
+        self.files = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._frames: typing.List[typing.Tuple[int, int]] = []
+        self._buffer = bytearray()
+        self._pending: typing.Deque[
+            typing.Tuple[int, concurrent.futures.Future]
+        ] = collections.deque()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+
+    def writable(self) -> bool:
+        """Return True, because this is a writable stream."""
+        return True
+
+    def write(self, data: bytes) -> int:  # noqa: T484
+        """Buffer data and compress all completed frames."""
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.frame_size:
+            frame = bytes(self._buffer[:self.frame_size])
+            del self._buffer[:self.frame_size]
+            self._submit(frame)
+        return len(data)
+
+    def close(self) -> None:
+        """Compress the remaining data and write the index and footer."""
+        if self.closed:
+            return
+        if len(self._buffer) > 0:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while len(self._pending) > 0:
+            self._write_frame()
+        self._executor.shutdown(wait=True)
+
+        index_offset = self.bytes_written
+        index = gzip.compress(json.dumps(dict(
+            version=SEEKABLE_INDEX_VERSION,
+            size=self.bytes_read,
+            frames=self._frames,
+            end=index_offset,
+            files=self.files
+        )).encode("utf-8"), mtime=0)
+        self._write(index)
+        self._write(b"".join([
+            FOOTER_HEADER,
+            struct.pack(FOOTER_FORMAT, index_offset, len(index)),
+            FOOTER_TRAILER
+        ]))
+        super().close()
+
+    def _submit(self, frame: bytes) -> None:
+        self._pending.append((self.bytes_read, self._executor.submit(
+            gzip.compress,
+            frame,
+            self.level,
+            mtime=0
+        ),))
+        self.bytes_read += len(frame)
+        # bound the memory used by frames that are not written yet
+        while len(self._pending) > (self.threads * 2):
+            self._write_frame()
+
+    def _write_frame(self) -> None:
+        uncompressed_offset, future = self._pending.popleft()
+        self._frames.append((self.bytes_written, uncompressed_offset,))
+        self._write(future.result())
+
+    def _write(self, data: bytes) -> None:
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+
+class SeekableArchive:
+    """Read single files from a seekable gzip tar archive."""
+
+    path: str
+    files: FileIndex
+    size: int
+
+    def __init__(
+        self,
+        path: str,
+        logger: typing.Optional['libioc.Logger.Logger']=None
+    ) -> None:
+        self.path = path
+        self.logger = logger
+        with open(path, "rb") as f:
+            index = self._read_index(f)
+        self.size = index["size"]
+        self.files = {
+            name: (offset, length,)
+            for name, (offset, length) in index["files"].items()
+        }
+        self._frame_offsets = [frame[0] for frame in index["frames"]]
+        self._frame_offsets.append(index["end"])
+        self._uncompressed_offsets = [frame[1] for frame in index["frames"]]
+        self._uncompressed_offsets.append(self.size)
+
+    def read_file(self, name: str) -> bytes:
+        """Return the content of a regular file in the archive."""
+        name = get_member_name(name)
+        if name not in self.files:
+            raise libioc.errors.IocException(
+                message=f"{name} was not found in {self.path}",
+                logger=self.logger
+            )
+        offset, length = self.files[name]
+        data = self.read_range(offset, length)
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+            member = tar.next()
+            if (member is None) or (member.isreg() is False):
+                raise libioc.errors.IocException(
+                    message=f"{name} is not a regular file in {self.path}",
+                    logger=self.logger
+                )
+            f = tar.extractfile(member)
+            return b"" if (f is None) else f.read()
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        """Decompress only the frames that contain the requested bytes."""
+        first = bisect.bisect_right(self._uncompressed_offsets, offset) - 1
+        last = bisect.bisect_left(
+            self._uncompressed_offsets,
+            offset + length
+        )
+        first = max(0, first)
+        last = min(last, len(self._frame_offsets) - 1)
+        with open(self.path, "rb") as f:
+            f.seek(self._frame_offsets[first])
+            compressed_data = f.read(
+                self._frame_offsets[last] - self._frame_offsets[first]
+            )
+        data = gzip.decompress(compressed_data)
+        start = offset - self._uncompressed_offsets[first]
+        return data[start:start + length]
+
+    def _read_index(self, f: typing.BinaryIO) -> typing.Dict[str, typing.Any]:
+        f.seek(0, os.SEEK_END)
+        if f.tell() >= FOOTER_SIZE:
+            f.seek(-FOOTER_SIZE, os.SEEK_END)
+            footer = f.read(FOOTER_SIZE)
+        else:
+            footer = b""
+        if footer.startswith(FOOTER_HEADER) is False:
+            raise libioc.errors.IocException(
+                message=f"{self.path} is not a seekable archive",
+                logger=self.logger
+            )
+        index_offset, index_length = struct.unpack_from(
+            FOOTER_FORMAT,
+            footer,
+            len(FOOTER_HEADER)
+        )
+        f.seek(index_offset)
+        index: typing.Dict[str, typing.Any] = json.loads(
+            gzip.decompress(f.read(index_length)).decode("utf-8")
+        )
+        if index.get("version") != SEEKABLE_INDEX_VERSION:
+            raise libioc.errors.IocException(
+                message=f"The index of {self.path} has an unknown version",
+                logger=self.logger
+            )
+        return index
+
+
+def write_indexed_tar(source: str, fileobj: typing.BinaryIO) -> FileIndex:
+    """Write a directory as tar stream and return the offsets of members."""
+    files: FileIndex = {}
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        _add_indexed(tar, source, ".", files)
+    return files
+
+
+def _add_indexed(
+    tar: tarfile.TarFile,
+    path: str,
+    arcname: str,
+    files: FileIndex
+) -> None:
+    tarinfo = tar.gettarinfo(path, arcname)
+    if tarinfo is None:
+        # sockets cannot be archived
+        return
+    offset = tar.offset
+    if tarinfo.isreg():
+        with open(path, "rb") as f:
+            tar.addfile(tarinfo, f)
+    else:
+        tar.addfile(tarinfo)
+    files[arcname] = (offset, tar.offset - offset,)
+    if tarinfo.isdir():
+        for name in sorted(os.listdir(path)):
+            _add_indexed(
+                tar,
+                os.path.join(path, name),
+                f"{arcname}/{name}",
+                files
+            )
+
+
+def get_member_name(path: str) -> str:
+    """Return the archive member name of a path relative to the backup."""
+    name = os.path.normpath(path.lstrip("/"))
+    return "." if (name == ".") else f"./{name}"
@@ -0,0 +1,377 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Incrementally synchronize directory trees using a persisted manifest."""
+import concurrent.futures
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import typing
+
+import libioc.Logger
+
+from .jobs import default_job_count
+
+MANIFEST_VERSION = 1
+
+ManifestEntry = typing.Dict[str, typing.Any]
+Manifest = typing.Dict[str, ManifestEntry]
+
+
+class SyncStats:
+    """Counters of a tree synchronization."""
+
+    copied: int
+    updated: int
+    deleted: int
+    unchanged: int
+    hashed: int
+
+    def __init__(self) -> None:
+        self.copied = 0
+        self.updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+        self.hashed = 0
+
+    def __str__(self) -> str:
+        """Return a humanreadable summary of the synchronization."""
+        return (
+            f"{self.copied} copied, {self.updated} updated, "
+            f"{self.deleted} deleted, {self.unchanged} unchanged"
+        )
+
+
+class TreeSync:
+    """
+    Mirror a source directory into a destination directory.
+
+    A manifest of the source tree (type, size, mtime, ownership, mode and
+    SHA256 checksum of every entry) is stored after each synchronization.
+    Subsequent runs only hash files whose size or mtime differ from the
+    manifest and only copy files whose content changed. Entries that are
+    no longer present in the source are deleted from the destination.
+
+    Like `rsync -a` file flags are not replicated, but they are cleared on
+    the destination before files are replaced or deleted.
+    """
+
+    source: str
+    destination: str
+    manifest_file: str
+    jobs: int
+    logger: libioc.Logger.Logger
+
+    def __init__(
+        self,
+        source: str,
+        destination: str,
+        manifest_file: str,
+        jobs: typing.Optional[int]=None,
+        logger: typing.Optional[libioc.Logger.Logger]=None
+    ) -> None:
+        self.source = os.path.abspath(source)
+        self.destination = os.path.abspath(destination)
+        self.manifest_file = manifest_file
+        self.jobs = default_job_count() if (jobs is None) else max(1, jobs)
+        self.logger = libioc.Logger.Logger() if (logger is None) else logger
+
+    @property
+    def has_manifest(self) -> bool:
+        """Return True when a manifest of a previous run exists."""
+        return self._read_manifest() is not None
+
+    def sync(self) -> SyncStats:
+        """Synchronize the destination with the source tree."""
+        stats = SyncStats()
+        previous = self._read_manifest() or {}
+        current = self._scan()
+        self._hash_changed_files(current, previous, stats)
+
+        removed = [
+            path for path, entry in previous.items()
+            if (current.get(path, {}).get("type") != entry["type"])
+        ]
+        for path in sorted(removed, key=_path_depth, reverse=True):
+            if self._remove(path) is True:
+                stats.deleted += 1
+
+        for path in sorted(current.keys(), key=_path_depth):
+            entry = current[path]
+            if entry["type"] == "d":
+                os.makedirs(self._destination_path(path), exist_ok=True)
+                continue
+            self._sync_entry(path, entry, previous.get(path), stats)
+
+        # directory mtimes change when their content is written
+        for path in sorted(current.keys(), key=_path_depth, reverse=True):
+            if current[path]["type"] == "d":
+                self._apply_metadata(path, current[path])
+
+        self._write_manifest(current)
+        return stats
+
+    def build_manifest(self) -> SyncStats:
+        """Record the manifest of a source that was copied by other means."""
+        stats = SyncStats()
+        current = self._scan()
+        self._hash_changed_files(current, {}, stats)
+        self._write_manifest(current)
+        return stats
+
+    def _scan(self) -> Manifest:
+        entries: Manifest = {}
+        for root, dirs, files in os.walk(self.source):
+            for name in (dirs + files):
+                absolute_path = os.path.join(root, name)
+                path = os.path.relpath(absolute_path, self.source)
+                entry = self._stat_entry(absolute_path)
+                if entry is not None:
+                    entries[path] = entry
+        entries["."] = self._stat_entry(self.source)
+        return entries
+
+    def _stat_entry(self, path: str) -> typing.Optional[ManifestEntry]:
+        st = os.lstat(path)
+        entry: ManifestEntry = dict(
+            mode=stat.S_IMODE(st.st_mode),
+            uid=st.st_uid,
+            gid=st.st_gid,
+            mtime_ns=st.st_mtime_ns
+        )
+        if stat.S_ISDIR(st.st_mode):
+            entry["type"] = "d"
+        elif stat.S_ISLNK(st.st_mode):
+            entry["type"] = "l"
+            entry["target"] = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            entry["type"] = "f"
+            entry["size"] = st.st_size
+        else:
+            self.logger.spam(f"Skipping special file {path}")
+            return None
+        return entry
+
+    def _hash_changed_files(
+        self,
+        current: Manifest,
+        previous: Manifest,
+        stats: SyncStats
+    ) -> None:
+        unknown = []
+        for path, entry in current.items():
+            if entry["type"] != "f":
+                continue
+            known = previous.get(path)
+            if (known is not None) and (known["type"] == "f") and all(
+                known.get(key) == entry[key] for key in ("size", "mtime_ns")
+            ):
+                entry["sha256"] = known["sha256"]
+            else:
+                unknown.append(path)
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            checksums = executor.map(
+                lambda path: _sha256(os.path.join(self.source, path)),
+                unknown
+            )
+            for path, checksum in zip(unknown, checksums):
+                current[path]["sha256"] = checksum
+                stats.hashed += 1
+
+    def _sync_entry(
+        self,
+        path: str,
+        entry: ManifestEntry,
+        known: typing.Optional[ManifestEntry],
+        stats: SyncStats
+    ) -> None:
+        destination = self._destination_path(path)
+        try:
+            destination_stat: typing.Optional[os.stat_result]
+            destination_stat = os.lstat(destination)
+        except FileNotFoundError:
+            destination_stat = None
+
+        if self._is_content_equal(entry, known, destination_stat) is False:
+            if entry["type"] == "l":
+                self._replace_symlink(path, entry, destination_stat)
+            else:
+                self._replace_file(path, destination_stat)
+            self._apply_metadata(path, entry)
+            stats.copied += 1
+        elif _is_metadata_equal(entry, known, destination_stat) is False:
+            self._apply_metadata(path, entry)
+            stats.updated += 1
+        else:
+            stats.unchanged += 1
+
+    def _is_content_equal(
+        self,
+        entry: ManifestEntry,
+        known: typing.Optional[ManifestEntry],
+        destination_stat: typing.Optional[os.stat_result]
+    ) -> bool:
+        if (known is None) or (destination_stat is None):
+            return False
+        if entry["type"] == "l":
+            if stat.S_ISLNK(destination_stat.st_mode) is False:
+                return False
+            return bool(known.get("target") == entry["target"])
+        if stat.S_ISREG(destination_stat.st_mode) is False:
+            return False
+        if destination_stat.st_size != known["size"]:
+            return False
+        return bool(known["sha256"] == entry["sha256"])
+
+    def _replace_file(
+        self,
+        path: str,
+        destination_stat: typing.Optional[os.stat_result]
+    ) -> None:
+        destination = self._destination_path(path)
+        if destination_stat is not None:
+            _clear_flags(destination, destination_stat)
+            if stat.S_ISDIR(destination_stat.st_mode):
+                shutil.rmtree(destination)
+        temporary_file = os.path.join(
+            os.path.dirname(destination),
+            f".{os.path.basename(destination)}.ioc-sync"
+        )
+        shutil.copyfile(
+            os.path.join(self.source, path),
+            temporary_file,
+            follow_symlinks=False
+        )
+        # running processes keep the previous inode
+        os.replace(temporary_file, destination)
+
+    def _replace_symlink(
+        self,
+        path: str,
+        entry: ManifestEntry,
+        destination_stat: typing.Optional[os.stat_result]
+    ) -> None:
+        destination = self._destination_path(path)
+        if destination_stat is not None:
+            self._remove(path)
+        os.symlink(entry["target"], destination)
+
+    def _apply_metadata(self, path: str, entry: ManifestEntry) -> None:
+        destination = self._destination_path(path)
+        is_link = (entry["type"] == "l")
+        os.chown(
+            destination,
+            entry["uid"],
+            entry["gid"],
+            follow_symlinks=False
+        )
+        if is_link is False:
+            os.chmod(destination, entry["mode"])
+        if (is_link is False) or (os.utime in os.supports_follow_symlinks):
+            os.utime(
+                destination,
+                ns=(entry["mtime_ns"], entry["mtime_ns"],),
+                follow_symlinks=(is_link is False)
+            )
+
+    def _remove(self, path: str) -> bool:
+        destination = self._destination_path(path)
+        try:
+            destination_stat = os.lstat(destination)
+        except FileNotFoundError:
+            return False
+
+        _clear_flags(destination, destination_stat)
+        if stat.S_ISDIR(destination_stat.st_mode) is False:
+            os.unlink(destination)
+            return True
+
+        try:
+            os.rmdir(destination)
+        except OSError as e:
+            # directories that are mountpoints of other datasets are kept
+            if e.errno not in (errno.EBUSY, errno.ENOTEMPTY,):
+                raise
+            self.logger.warn(f"Could not remove directory {destination}")
+            return False
+        return True
+
+    def _destination_path(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.destination, path))
+
+    def _read_manifest(self) -> typing.Optional[Manifest]:
+        try:
+            with open(self.manifest_file, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self.logger.warn(f"Ignoring invalid manifest {self.manifest_file}")
+            return None
+
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+
+        entries: Manifest = data["entries"]
+        return entries
+
+    def _write_manifest(self, entries: Manifest) -> None:
+        temporary_file = f"{self.manifest_file}.tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(dict(version=MANIFEST_VERSION, entries=entries), f)
+        os.replace(temporary_file, self.manifest_file)
+
+
+def _is_metadata_equal(
+    entry: ManifestEntry,
+    known: typing.Optional[ManifestEntry],
+    destination_stat: typing.Optional[os.stat_result]
+) -> bool:
+    if (known is None) or (destination_stat is None):
+        return False
+    if any(known[key] != entry[key] for key in ("uid", "gid", "mode",)):
+        return False
+    return bool(destination_stat.st_mtime_ns == entry["mtime_ns"])
+
+
+def _clear_flags(path: str, path_stat: os.stat_result) -> None:
+    if getattr(path_stat, "st_flags", 0) == 0:
+        return
+    os.chflags(path, 0, follow_symlinks=False)
+
+
+def _path_depth(path: str) -> int:
+    return 0 if (path == ".") else (path.count(os.sep) + 1)
+
+
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
@@ -0,0 +1,641 @@
+# Copyright (c) 2017-2019, Stefan Grönke
+# Copyright (c) 2014-2018, iocage
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Stream ZFS datasets with send and receive."""
+import concurrent.futures
+import contextlib
+import os
+import signal
+import struct
+import subprocess  # nosec: B404
+import threading
+import typing
+
+import libzfs
+
+import libioc.errors
+import libioc.helpers
+
+ZFS_BINARY = "/sbin/zfs"
+ZPOOL_BINARY = "/sbin/zpool"
+
+# DRR_BEGIN records start with this magic in the senders byte order
+ZFS_STREAM_MAGIC = 0x2F5BACBAC
+ZFS_STREAM_HEADER_SIZE = 312
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# user property attached to backup snapshots
+MOUNTPOINT_PROPERTY = "org.freebsd.ioc:backup-mountpoint"
+
+
+def is_zfs_stream(head: bytes) -> bool:
+    """Return True if the bytes are the beginning of a ZFS send stream."""
+    if len(head) < 16:
+        return False
+    return head[8:16] in (
+        struct.pack("<Q", ZFS_STREAM_MAGIC),
+        struct.pack(">Q", ZFS_STREAM_MAGIC)
+    )
+
+
+def get_stream_snapshot_name(head: bytes) -> typing.Optional[str]:
+    """Return the full snapshot name from the header of a ZFS stream."""
+    if (is_zfs_stream(head) is False) or (len(head) < 56):
+        return None
+    name = head[56:ZFS_STREAM_HEADER_SIZE].split(b"\x00", maxsplit=1)[0]
+    return name.decode("utf-8", errors="replace") or None
+
+
+def get_send_flags(
+    replicate: bool=True,
+    incremental: bool=False,
+    compressed: bool=False,
+    raw: bool=False
+) -> typing.Set[libzfs.SendFlag]:
+    """Return the send flags for the requested stream features."""
+    flags = set()
+    if replicate is True:
+        flags.add(libzfs.SendFlag.REPLICATE)
+    if incremental is True:
+        # include intermediary snapshots like `zfs send -I`
+        flags.add(libzfs.SendFlag.DOALL)
+    if compressed is True:
+        flags.add(_get_optional_send_flag("COMPRESS"))
+    if raw is True:
+        flags.add(_get_optional_send_flag("RAW"))
+    return flags
+
+
+def _get_optional_send_flag(name: str) -> libzfs.SendFlag:
+    try:
+        return getattr(libzfs.SendFlag, name)
+    except AttributeError:
+        raise libioc.errors.IocException(
+            message=f"The installed libzfs does not support {name} sends"
+        )
+
+
+def send_to_fileobj(
+    dataset: libzfs.ZFSDataset,
+    fileobj: typing.BinaryIO,
+    toname: str,
+    fromname: typing.Optional[str]=None,
+    flags: typing.Optional[typing.Set[libzfs.SendFlag]]=None
+) -> None:
+    """
+    Send a dataset snapshot to a file object.
+
+    libzfs writes the stream to a file descriptor from a worker thread, while
+    the data is copied to the file object, so that the stream can be
+    compressed or counted on its way.
+    """
+    _flags = set() if (flags is None) else flags
+    read_fd, write_fd = os.pipe()
+
+    def _send() -> None:
+        try:
+            dataset.send(
+                write_fd,
+                fromname=fromname,
+                toname=toname,
+                flags=_flags
+            )
+        finally:
+            os.close(write_fd)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        sender = executor.submit(_send)
+        with os.fdopen(read_fd, "rb") as stream:
+            for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b""):
+                fileobj.write(chunk)
+        sender.result()
+
+
+def receive_from_fileobj(
+    zfs: libzfs.ZFS,
+    dataset_name: str,
+    fileobj: typing.BinaryIO,
+    force: bool=False,
+    resumable: bool=False
+) -> None:
+    """
+    Receive a ZFS stream that is read from a file object.
+
+    When the receiver fails early, writing the remaining stream raises a
+    BrokenPipeError only while SIGPIPE is ignored (see ignore_sigpipe).
+    The error of the receiver is raised instead.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def _receive() -> None:
+        try:
+            zfs.receive(
+                dataset_name,
+                read_fd,
+                force=force,
+                resumable=resumable
+            )
+        finally:
+            os.close(read_fd)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        receiver = executor.submit(_receive)
+        stream = os.fdopen(write_fd, "wb")
+        try:
+            for chunk in iter(lambda: fileobj.read(STREAM_CHUNK_SIZE), b""):
+                if receiver.done() is True:
+                    # stop writing when the receiver failed early
+                    break
+                stream.write(chunk)
+        except BrokenPipeError:
+            # the receiver failed and raises its error below
+            pass
+        finally:
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+        receiver.result()
+
+
+@contextlib.contextmanager
+def ignore_sigpipe() -> typing.Iterator[None]:
+    """
+    Ignore SIGPIPE while streams are written to a receiver.
+
+    The CLI restores the default SIGPIPE handler, which terminates the process
+    when a receiver exits before the stream was written completely. Signal
+    handlers can only be changed from the main thread, so that the handler
+    is left untouched when entered from other threads.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous_handler = signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGPIPE, previous_handler)
+
+
+def get_resume_token(
+    dataset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> typing.Optional[str]:
+    """
+    Return the resume token of an interrupted receive into a dataset.
+
+    Resumable receives persist the state of a partially received stream on
+    the target dataset, so that the transfer can continue from there.
+    """
+    stdout, _, returncode = libioc.helpers.exec(
+        [
+            ZFS_BINARY, "get", "-H", "-o", "value",
+            "receive_resume_token", dataset_name
+        ],
+        logger=logger,
+        ignore_error=True
+    )
+    if (returncode > 0) or (stdout in (None, "", "-")):
+        return None
+    return str(stdout)
+
+
+def abort_receive(
+    dataset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> None:
+    """Discard the partially received state of a dataset."""
+    libioc.helpers.exec(
+        [ZFS_BINARY, "receive", "-A", dataset_name],
+        logger=logger,
+        ignore_error=True
+    )
+
+
+def list_snapshot_names(
+    dataset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> typing.List[str]:
+    """Return the snapshot names of a dataset from the oldest to newest."""
+    stdout, _, returncode = libioc.helpers.exec(
+        [
+            ZFS_BINARY, "list", "-H", "-d", "1", "-t", "snapshot",
+            "-s", "createtxg", "-o", "name", dataset_name
+        ],
+        logger=logger,
+        ignore_error=True
+    )
+    if returncode > 0:
+        return []
+    return [
+        line.split("@", maxsplit=1)[1]
+        for line in (stdout or "").splitlines()
+        if "@" in line
+    ]
+
+
+def get_written_size(
+    dataset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> int:
+    """Return the bytes written to a dataset tree since its last snapshot."""
+    stdout, _, _ = libioc.helpers.exec(
+        [
+            ZFS_BINARY, "get", "-H", "-p", "-r", "-t", "filesystem,volume",
+            "-o", "value", "written", dataset_name
+        ],
+        logger=logger
+    )
+    return sum(
+        int(value) for value in (stdout or "").splitlines()
+        if value.isdigit()
+    )
+
+
+def send_receive(
+    snapshot_name: str,
+    target_dataset_name: str,
+    fromname: typing.Optional[str]=None,
+    resume_token: typing.Optional[str]=None,
+    force: bool=False,
+    progress: typing.Optional[typing.Callable[[int], None]]=None,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> int:
+    """
+    Pipe a snapshot from zfs send into a resumable zfs receive.
+
+    The receiver reads the stream directly from the sender, so that a failing
+    receive terminates the send instead of the CLI. Progress is taken from the
+    parsable verbose output of zfs send. An interrupted receive leaves a
+    resume token on the target, which continues the transfer when it is
+    passed as resume_token. Returns the number of bytes that were transferred.
+    """
+    send_command = [ZFS_BINARY, "send", "-v", "-P"]
+    if resume_token is not None:
+        send_command += ["-t", resume_token]
+    else:
+        send_command.append("-p")
+        if fromname is not None:
+            send_command += ["-i", fromname]
+        send_command.append(snapshot_name)
+
+    receive_command = [ZFS_BINARY, "receive", "-s", "-u"]
+    if force is True:
+        receive_command.append("-F")
+    receive_command.append(target_dataset_name)
+
+    if logger is not None:
+        send_str = " ".join(send_command)
+        receive_str = " ".join(receive_command)
+        logger.spam(f"Executing: {send_str} | {receive_str}")
+
+    sender = subprocess.Popen(  # nosec: trusted command
+        send_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    receiver = subprocess.Popen(  # nosec: trusted command
+        receive_command,
+        stdin=sender.stdout,
+        stderr=subprocess.PIPE
+    )
+    # the receiver holds the only read end of the stream
+    sender.stdout.close()  # noqa: T484
+
+    transferred = 0
+    estimated_size = 0
+    send_errors = []
+    for raw_line in sender.stderr:  # noqa: T484
+        line = raw_line.decode("UTF-8", errors="replace").strip()
+        fields = line.split("\t")
+        is_number = (len(fields) > 1) and fields[1].isdigit()
+        if (len(fields) == 3) and (":" in fields[0]) and is_number:
+            # periodic progress: time, bytes and snapshot name
+            transferred = int(fields[1])
+            if progress is not None:
+                progress(transferred)
+        elif (fields[0] == "size") and is_number:
+            estimated_size = int(fields[1])
+        elif fields[0] not in ("full", "incremental"):
+            send_errors.append(line)
+    sender.stderr.close()  # noqa: T484
+
+    receive_error = receiver.stderr.read()  # noqa: T484
+    receiver.stderr.close()  # noqa: T484
+    receive_returncode = receiver.wait()
+    send_returncode = sender.wait()
+    if (send_returncode != 0) or (receive_returncode != 0):
+        send_error = "\n".join(send_errors).strip()
+        message = receive_error.decode("UTF-8").strip() or send_error
+        raise libioc.errors.ZFSException(
+            message=f"Transfer to {target_dataset_name} failed: {message}",
+            logger=logger
+        )
+
+    # short transfers complete before the first progress report
+    transferred = max(transferred, estimated_size)
+    if progress is not None:
+        progress(transferred)
+    return transferred
+
+
+def snapshot_exists(zfs: libzfs.ZFS, identifier: str) -> bool:
+    """Return True if the snapshot exists."""
+    try:
+        zfs.get_snapshot(identifier)
+        return True
+    except libzfs.ZFSException:
+        return False
+
+
+def create_snapshots(
+    identifiers: typing.Iterable[str],
+    recursive: bool=True,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> None:
+    """
+    Create many snapshots with a single zfs command per pool.
+
+    ZFS takes all snapshots of one invocation in the same transaction group,
+    so that they represent the same point in time. Snapshots of different
+    pools cannot share a transaction group.
+    """
+    pools: typing.Dict[str, typing.List[str]] = {}
+    for identifier in identifiers:
+        pool_name = identifier.split("/", maxsplit=1)[0]
+        pools.setdefault(pool_name, []).append(identifier)
+
+    for pool_snapshots in pools.values():
+        command = [ZFS_BINARY, "snapshot"]
+        if recursive is True:
+            command.append("-r")
+        command += sorted(pool_snapshots)
+        try:
+            libioc.helpers.exec(command, logger=logger)
+        except libioc.errors.CommandFailure:
+            raise libioc.errors.SnapshotCreation(
+                reason=f"{ZFS_BINARY} snapshot failed",
+                logger=logger
+            )
+
+
+# datasets passed to one zfs command, so that the arguments stay short
+ZFS_LIST_BATCH_SIZE = 256
+
+
+def list_snapshots(
+    dataset_names: typing.Iterable[str],
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Return the snapshots of datasets with their space usage.
+
+    The properties of all snapshots are queried in bulk from `zfs list`.
+    Snapshots of the same name in the children of a dataset belong to the
+    same recursive snapshot, so that their space usage and clones are
+    accumulated.
+    """
+    dataset_names = list(dataset_names)
+    snapshots: typing.Dict[
+        typing.Tuple[str, str],
+        typing.Dict[str, typing.Any]
+    ] = {}
+    for i in range(0, len(dataset_names), ZFS_LIST_BATCH_SIZE):
+        batch = dataset_names[i:i + ZFS_LIST_BATCH_SIZE]
+        requested_datasets = set(batch)
+        stdout, _, _ = libioc.helpers.exec(
+            [
+                ZFS_BINARY, "list", "-H", "-p", "-r",
+                "-t", "snapshot",
+                "-o", "name,used,referenced,creation,clones"
+            ] + batch,
+            logger=logger
+        )
+        for line in (stdout or "").splitlines():
+            name, used, referenced, creation, clones = line.split("\t")
+            dataset_name, snapshot_name = name.split("@", maxsplit=1)
+            parent = _find_parent_dataset(dataset_name, requested_datasets)
+            if parent is None:
+                continue
+            key = (parent, snapshot_name,)
+            if key not in snapshots:
+                snapshots[key] = dict(
+                    dataset=parent,
+                    name=snapshot_name,
+                    used=0,
+                    referenced=0,
+                    creation=int(creation),
+                    clones=0
+                )
+            snapshot = snapshots[key]
+            snapshot["used"] += int(used)
+            snapshot["referenced"] += int(referenced)
+            snapshot["creation"] = min(snapshot["creation"], int(creation))
+            if clones not in ("", "-"):
+                snapshot["clones"] += len(clones.split(","))
+    return list(snapshots.values())
+
+
+def _find_parent_dataset(
+    dataset_name: str,
+    parents: typing.Set[str]
+) -> typing.Optional[str]:
+    while True:
+        if dataset_name in parents:
+            return dataset_name
+        if "/" not in dataset_name:
+            return None
+        dataset_name = dataset_name.rsplit("/", maxsplit=1)[0]
+
+
+def destroy_snapshots(
+    dataset_name: str,
+    snapshot_names: typing.List[str],
+    recursive: bool=True,
+    defer: bool=True,
+    dry_run: bool=False,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> int:
+    """
+    Destroy many snapshots of a dataset with a single zfs command.
+
+    Deferred destroys do not fail on snapshots that are held or cloned,
+    but mark them for destruction once they are released. Returns the
+    number of bytes that are (or would be on a dry run) reclaimed.
+    """
+    if len(snapshot_names) == 0:
+        return 0
+    command = [ZFS_BINARY, "destroy", "-v", "-p"]
+    if dry_run is True:
+        command.append("-n")
+    if defer is True:
+        command.append("-d")
+    if recursive is True:
+        command.append("-r")
+    command.append(f"{dataset_name}@{','.join(snapshot_names)}")
+    try:
+        stdout, _, _ = libioc.helpers.exec(command, logger=logger)
+    except libioc.errors.CommandFailure:
+        raise libioc.errors.SnapshotDeletion(
+            reason=f"{ZFS_BINARY} destroy failed",
+            logger=logger
+        )
+
+    reclaimed = 0
+    for line in (stdout or "").splitlines():
+        fields = line.split("\t")
+        if (fields[0] == "reclaim") and (len(fields) > 1):
+            reclaimed = int(fields[1])
+    return reclaimed
+
+
+def list_child_datasets(
+    dataset_name: str,
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> typing.List[typing.Tuple[str, int]]:
+    """Return the names and used bytes of the children of a dataset."""
+    stdout, _, returncode = libioc.helpers.exec(
+        [
+            ZFS_BINARY, "list", "-H", "-p", "-d", "1",
+            "-t", "filesystem,volume", "-o", "name,used", dataset_name
+        ],
+        logger=logger,
+        ignore_error=True
+    )
+    if returncode > 0:
+        return []
+    children = []
+    for line in (stdout or "").splitlines():
+        name, used = line.split("\t")
+        if name != dataset_name:
+            children.append((name, int(used),))
+    return children
+
+
+def get_freeing_sizes(
+    pool_names: typing.Iterable[str],
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> typing.Dict[str, int]:
+    """Return the bytes that pools still release from destroyed datasets."""
+    pool_names = sorted(set(pool_names))
+    if len(pool_names) == 0:
+        return {}
+    stdout, _, _ = libioc.helpers.exec(
+        [
+            ZPOOL_BINARY, "get", "-H", "-p", "-o", "name,value", "freeing",
+            *pool_names
+        ],
+        logger=logger
+    )
+    sizes = {}
+    for line in (stdout or "").splitlines():
+        name, value = line.split("\t")
+        sizes[name] = int(value) if value.isdigit() else 0
+    return sizes
+
+
+def destroy_in_background(
+    dataset_names: typing.List[str],
+    logger: typing.Optional['libioc.Logger.Logger']=None
+) -> None:
+    """
+    Recursively destroy datasets from a detached process.
+
+    The datasets are destroyed one after another by a shell that keeps
+    running when ioc exits. Datasets that could not be destroyed remain
+    in place.
+    """
+    if len(dataset_names) == 0:
+        return
+    command = [
+        "/bin/sh", "-c",
+        f'for dataset; do {ZFS_BINARY} destroy -r "$dataset"; done',
+        "sh"
+    ] + dataset_names
+    if logger is not None:
+        logger.spam(f"Executing in background: {' '.join(command)}")
+    subprocess.Popen(  # nosec: trusted command
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+
+# names of the libzfs DiffRecordType members
+DIFF_CHANGE_NAMES = {
+    "ADD": "added",
+    "ADDED": "added",
+    "REMOVE": "removed",
+    "REMOVED": "removed",
+    "MODIFY": "modified",
+    "MODIFIED": "modified",
+    "RENAME": "renamed",
+    "RENAMED": "renamed"
+}
+
+
+def iter_diff(
+    dataset: libzfs.ZFSDataset,
+    fromsnap: str,
+    tosnap: typing.Optional[str]=None,
+    mountpoint: typing.Optional[str]=None
+) -> typing.Generator[typing.Dict[str, typing.Optional[str]], None, None]:
+    """
+    Stream the changes of a dataset between two snapshots.
+
+    ZFS diff only traverses blocks born after the first snapshot, so that
+    unchanged parts of the tree are never read. When no second snapshot is
+    given the first one is compared to the current state of the dataset.
+    Paths are made relative to the mountpoint.
+    """
+    records = dataset.diff(
+        f"{dataset.name}@{fromsnap}",
+        dataset.name if (tosnap is None) else f"{dataset.name}@{tosnap}"
+    )
+    for record in records:
+        state = record.__getstate__()
+        change = str(state["cmd"])
+        yield dict(
+            change=DIFF_CHANGE_NAMES.get(change.upper(), change.lower()),
+            type=str(state["type"]).lower(),
+            path=_relative_path(state["path"], mountpoint),
+            old_path=_relative_path(state.get("oldpath"), mountpoint)
+        )
+
+
+def _relative_path(
+    path: typing.Optional[str],
+    mountpoint: typing.Optional[str]
+) -> typing.Optional[str]:
+    if (path is None) or (mountpoint is None):
+        return path
+    mountpoint = mountpoint.rstrip("/")
+    if path == mountpoint:
+        return "/"
+    if path.startswith(f"{mountpoint}/"):
+        return path[len(mountpoint):]
+    return path
@@ -23,15 +23,41 @@
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 """Create and manage jail snapshots with the CLI."""
+import datetime
+import json
+import time
 import typing
 import click
+import libzfs
 
+import libioc.errors
 import libioc.Jail
+import libioc.Jails
 import libioc.Logger
 
+from .shared.backup import BACKUP_SNAPSHOT_PREFIX
 from .shared.click import IocClickContext
 from .shared.jail import get_jail
-from .shared.output import print_table
+from .shared.output import print_table, to_humanreadable_size
+from .shared.retention import RetentionPolicy
+from .shared.zfs import (
+    create_snapshots,
+    destroy_snapshots,
+    iter_diff,
+    list_snapshots,
+    snapshot_exists
+)
+
+SNAPSHOT_LIST_COLUMNS = [
+    "jail",
+    "name",
+    "used",
+    "referenced",
+    "creation",
+    "clones"
+]
+SNAPSHOT_LIST_OUTPUT_FORMATS = ["table", "csv", "list", "json"]
+DIFF_SYMBOLS = dict(added="+", removed="-", modified="M", renamed="R")
 
 __rootcmd__ = True
 
@@ -50,32 +76,93 @@ def cli_list_or_create(
     snapshot will be created. Otherwise existing snapshots are listed.
     """
     if "@" in ctx.info_name:
-        return _cli_create(ctx, ctx.info_name)
+        return _cli_create(ctx, (ctx.info_name,))
     else:
-        return _cli_list(ctx, ctx.info_name)
+        return _cli_list(ctx, (ctx.info_name,))
 
 
 @click.command(
     name="create",
-    help="Create a snapshot"
+    help="Create snapshots of one or many jails"
 )
 @click.pass_context
-@click.argument("identifier", nargs=1, required=True)
-def cli_create(ctx: IocClickContext, identifier: str) -> None:
-    """Create a snapshot."""
-    _cli_create(ctx, identifier)
+@click.argument("identifiers", nargs=-1, required=True)
+def cli_create(
+    ctx: IocClickContext,
+    identifiers: typing.Tuple[str, ...]
+) -> None:
+    """
+    Create snapshots of all jails matching the filters.
+
+    Identifiers are a jail filter followed by the snapshot name, for example
+    `web*@deploy`. All snapshots of a ZFS pool are taken atomically in a
+    single operation. Snapshots that already exist are skipped.
+    """
+    _cli_create(ctx, identifiers)
 
 
-def _cli_create(ctx: IocClickContext, identifier: str) -> None:
+def _cli_create(
+    ctx: IocClickContext,
+    identifiers: typing.Tuple[str, ...]
+) -> None:
+    logger = ctx.parent.logger
+    start_time = time.monotonic()
     try:
-        ioc_jail, snapshot_name = _parse_identifier(
-            ctx=ctx.parent,
-            identifier=identifier,
-            require_full_identifier=True
-        )
-        ioc_jail.snapshots.create(snapshot_name)
+        snapshots = _get_snapshot_identifiers(ctx.parent, identifiers)
     except libioc.errors.IocException:
-        pass
+        exit(1)
+
+    missing_snapshots = [
+        snapshot for snapshot in snapshots
+        if snapshot_exists(ctx.parent.zfs, snapshot) is False
+    ]
+    for snapshot in sorted(set(snapshots) - set(missing_snapshots)):
+        logger.verbose(f"Snapshot {snapshot} already exists - skipping")
+
+    try:
+        create_snapshots(missing_snapshots, recursive=True, logger=logger)
+    except libioc.errors.IocException:
+        exit(1)
+
+    for snapshot in missing_snapshots:
+        logger.verbose(f"Snapshot created: {snapshot}")
+    duration = round(time.monotonic() - start_time, 3)
+    logger.log(
+        f"{len(missing_snapshots)} snapshots created, "
+        f"{len(snapshots) - len(missing_snapshots)} already existed "
+        f"[{duration}s]"
+    )
+
+
+def _get_snapshot_identifiers(
+    ctx: IocClickContext,
+    identifiers: typing.Tuple[str, ...]
+) -> typing.List[str]:
+    """Return the full ZFS snapshot names of all matching jails."""
+    snapshots: typing.List[str] = []
+    for identifier in identifiers:
+        if "@" not in identifier:
+            raise libioc.errors.InvalidSnapshotIdentifier(
+                identifier=identifier,
+                logger=ctx.logger
+            )
+        jail_filter, snapshot_name = identifier.rsplit("@", maxsplit=1)
+        jails = list(libioc.Jails.JailsGenerator(
+            filters=(jail_filter,),
+            zfs=ctx.zfs,
+            host=ctx.host,
+            logger=ctx.logger
+        ))
+        if len(jails) == 0:
+            raise libioc.errors.IocException(
+                message=f"No jail matched {jail_filter}",
+                logger=ctx.logger
+            )
+        for jail in jails:
+            snapshot = f"{jail.dataset.name}@{snapshot_name}"
+            if snapshot not in snapshots:
+                snapshots.append(snapshot)
+    return snapshots
 
 
 @click.command(
@@ -107,24 +194,118 @@ def cli_rollback(
     help="List all snapshots"
 )
 @click.pass_context
-@click.argument("jail", nargs=1, required=True)
-def cli_list(ctx: IocClickContext, jail: str) -> None:
-    """List existing snapshots."""
-    _cli_list(ctx, jail)
+@click.option(
+    "--sort", "-s", "_sort",
+    type=click.Choice(SNAPSHOT_LIST_COLUMNS),
+    default="creation",
+    help="Sort the snapshots by the given column"
+)
+@click.option(
+    "--reverse", "-r",
+    is_flag=True,
+    default=False,
+    help="Sort in descending order"
+)
+@click.option(
+    "--output-format", "-f",
+    type=click.Choice(SNAPSHOT_LIST_OUTPUT_FORMATS),
+    default="table"
+)
+@click.option(
+    "--header/--no-header", "-H/-NH",
+    is_flag=True,
+    default=True,
+    help="Show or hide column name heading."
+)
+@click.argument("filters", nargs=-1)
+def cli_list(
+    ctx: IocClickContext,
+    _sort: str,
+    reverse: bool,
+    output_format: str,
+    header: bool,
+    filters: typing.Tuple[str, ...]
+) -> None:
+    """
+    List the snapshots of all jails matching the filters.
 
+    The space used and referenced by snapshots and their number of clones
+    is fetched for all jails at once. Use `--sort used --reverse` to find the
+    snapshots that use the most space.
+    """
+    _cli_list(
+        ctx,
+        filters,
+        sort_key=_sort,
+        reverse=reverse,
+        output_format=output_format,
+        show_header=header
+    )
+
+
+def _cli_list(
+    ctx: IocClickContext,
+    filters: typing.Tuple[str, ...],
+    sort_key: str="creation",
+    reverse: bool=False,
+    output_format: str="table",
+    show_header: bool=True
+) -> None:
+    logger = ctx.parent.logger
+
+    # empty filters will match all jails
+    if len(filters) == 0:
+        filters = ("*",)
 
-def _cli_list(ctx: IocClickContext, jail: str) -> None:
     try:
-        ioc_jail, snapshot_name = _parse_identifier(
-            ctx=ctx.parent,
-            identifier=jail,
-            require_full_identifier=False
-        )
-        columns = ["NAME"]
-        data = [[x.name.split("@", maxsplit=1)[1]] for x in ioc_jail.snapshots]
-        print_table(data, columns)
+        jails = list(libioc.Jails.JailsGenerator(
+            filters=filters,
+            zfs=ctx.parent.zfs,
+            host=ctx.parent.host,
+            logger=logger
+        ))
+        jail_names = {
+            jail.dataset.name: jail.humanreadable_name
+            for jail in jails
+        }
+        snapshots = list_snapshots(jail_names.keys(), logger=logger)
     except libioc.errors.IocException:
-        pass
+        exit(1)
+
+    for snapshot in snapshots:
+        snapshot["jail"] = jail_names[snapshot.pop("dataset")]
+    snapshots.sort(key=lambda x: (x[sort_key], x["jail"], x["creation"],))
+    if reverse is True:
+        snapshots.reverse()
+
+    for snapshot in snapshots:
+        snapshot["creation"] = datetime.datetime.fromtimestamp(
+            snapshot["creation"]
+        ).isoformat()
+
+    if output_format == "json":
+        print(json.dumps(snapshots, indent=2, sort_keys=True))
+        return
+
+    columns = list(SNAPSHOT_LIST_COLUMNS)
+    if len(jails) == 1:
+        columns.remove("jail")
+
+    if output_format == "table":
+        for snapshot in snapshots:
+            for key in ["used", "referenced"]:
+                snapshot[key] = to_humanreadable_size(snapshot[key])
+        print_table(
+            [[str(x[column]) for column in columns] for x in snapshots],
+            columns,
+            show_header=show_header
+        )
+    else:
+        separator = "\t" if (output_format == "list") else ";"
+        if show_header is True:
+            print(separator.join(columns).upper())
+        for snapshot in snapshots:
+            print(separator.join(str(snapshot[x]) for x in columns))
 
 
 @click.command(
@@ -146,6 +327,243 @@ def cli_remove(ctx: IocClickContext, identifier: str) -> None:
         pass
 
 
+@click.command(
+    name="prune",
+    help="Delete snapshots according to retention rules"
+)
+@click.pass_context
+@click.option("--keep-last", default=0, help="Keep the latest snapshots")
+@click.option(
+    "--keep-hourly",
+    default=0,
+    help="Keep the latest snapshot of this many hours"
+)
+@click.option(
+    "--keep-daily",
+    default=0,
+    help="Keep the latest snapshot of this many days"
+)
+@click.option(
+    "--keep-weekly",
+    default=0,
+    help="Keep the latest snapshot of this many weeks"
+)
+@click.option(
+    "--keep-monthly",
+    default=0,
+    help="Keep the latest snapshot of this many months"
+)
+@click.option(
+    "--keep-yearly",
+    default=0,
+    help="Keep the latest snapshot of this many years"
+)
+@click.option(
+    "--prefix", "-p",
+    default=None,
+    help="Only prune snapshots with names starting with this prefix"
+)
+@click.option(
+    "--include-backups",
+    is_flag=True,
+    default=False,
+    help="Also prune the snapshots that exports keep for incremental sends"
+)
+@click.option(
+    "--dry-run", "-n",
+    is_flag=True,
+    default=False,
+    help="Show the snapshots and space that would be pruned"
+)
+@click.argument("filters", nargs=-1, required=True)
+def cli_prune(
+    ctx: IocClickContext,
+    keep_last: int,
+    keep_hourly: int,
+    keep_daily: int,
+    keep_weekly: int,
+    keep_monthly: int,
+    keep_yearly: int,
+    prefix: typing.Optional[str],
+    include_backups: bool,
+    dry_run: bool,
+    filters: typing.Tuple[str, ...]
+) -> None:
+    """
+    Prune the snapshots of all jails matching the filters.
+
+    The rules are evaluated per jail. A snapshot is kept when any rule
+    keeps it, for example `--keep-hourly 24 --keep-daily 14 --keep-weekly 8`.
+    The snapshots of a jail are destroyed in a single deferred ZFS destroy,
+    so that held or cloned snapshots are released later instead of failing.
+
+    Backup snapshots kept by zfs-stream exports are the base of the next
+    incremental export and are only pruned with --include-backups.
+    """
+    logger = ctx.parent.logger
+    policy = RetentionPolicy(
+        keep_last=keep_last,
+        hourly=keep_hourly,
+        daily=keep_daily,
+        weekly=keep_weekly,
+        monthly=keep_monthly,
+        yearly=keep_yearly
+    )
+    if policy.empty is True:
+        logger.error("At least one --keep rule is required")
+        exit(1)
+
+    try:
+        jails = list(libioc.Jails.JailsGenerator(
+            filters=filters,
+            zfs=ctx.parent.zfs,
+            host=ctx.parent.host,
+            logger=logger
+        ))
+        jail_names = {
+            jail.dataset.name: jail.humanreadable_name
+            for jail in jails
+        }
+        snapshots = list_snapshots(jail_names.keys(), logger=logger)
+    except libioc.errors.IocException:
+        exit(1)
+
+    dataset_snapshots: typing.Dict[str, typing.List[dict]] = {
+        dataset_name: [] for dataset_name in jail_names.keys()
+    }
+    for snapshot in snapshots:
+        if (prefix is not None) and not snapshot["name"].startswith(prefix):
+            continue
+        if (include_backups is False) and _is_backup_snapshot(snapshot):
+            continue
+        dataset_snapshots[snapshot["dataset"]].append(snapshot)
+
+    data = []
+    total_reclaimed = 0
+    failed = False
+    for dataset_name, candidates in sorted(dataset_snapshots.items()):
+        jail_name = jail_names[dataset_name]
+        kept, pruned = policy.select(candidates)
+        pruned_names = [x["name"] for x in pruned]
+        for snapshot_name in pruned_names:
+            logger.verbose(f"Pruning {jail_name}@{snapshot_name}")
+        try:
+            reclaimed = destroy_snapshots(
+                dataset_name,
+                pruned_names,
+                dry_run=dry_run,
+                logger=logger
+            )
+        except libioc.errors.IocException:
+            failed = True
+            continue
+        total_reclaimed += reclaimed
+        data.append([
+            jail_name,
+            str(len(kept)),
+            str(len(pruned)),
+            to_humanreadable_size(reclaimed)
+        ])
+
+    print_table(data, ["jail", "kept", "pruned", "reclaimed"])
+    verb = "would be" if (dry_run is True) else "were"
+    logger.log(f"{to_humanreadable_size(total_reclaimed)} {verb} reclaimed")
+    if failed is True:
+        exit(1)
+
+
+def _is_backup_snapshot(snapshot: dict) -> bool:
+    return str(snapshot["name"]).startswith(BACKUP_SNAPSHOT_PREFIX)
+
+
+@click.command(
+    name="diff",
+    help="Show the changes of a jail since a snapshot"
+)
+@click.pass_context
+@click.argument("identifier", nargs=1, required=True)
+@click.argument("snapshot", nargs=1, required=False)
+@click.option(
+    "--path", "-p", "paths",
+    multiple=True,
+    help="Only show changes of this path and below"
+)
+@click.option(
+    "--change", "-c", "changes",
+    multiple=True,
+    type=click.Choice(list(DIFF_SYMBOLS.keys())),
+    help="Only show changes of this kind"
+)
+@click.option(
+    "--output-format", "-f",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    help="Print text lines or one JSON object per change"
+)
+def cli_diff(
+    ctx: IocClickContext,
+    identifier: str,
+    snapshot: typing.Optional[str],
+    paths: typing.Tuple[str, ...],
+    changes: typing.Tuple[str, ...],
+    output_format: str
+) -> None:
+    """
+    Show the files that changed in a jail root since a snapshot.
+
+    Without a second snapshot the snapshot is compared to the current state
+    of the jail. Changes are printed while ZFS reports them. Paths are
+    relative to the jail root.
+    """
+    logger = ctx.parent.logger
+    path_prefixes = ["/" + path.strip("/") for path in paths]
+    try:
+        ioc_jail, snapshot_name = _parse_identifier(
+            ctx=ctx.parent,
+            identifier=identifier,
+            require_full_identifier=True
+        )
+        to_snapshot_name = None
+        if snapshot is not None:
+            to_snapshot_name = snapshot.split("@").pop()
+        root_dataset = ioc_jail.root_dataset
+        records = iter_diff(
+            root_dataset,
+            str(snapshot_name),
+            to_snapshot_name,
+            mountpoint=root_dataset.mountpoint
+        )
+        for record in records:
+            if (len(changes) > 0) and (record["change"] not in changes):
+                continue
+            if (len(path_prefixes) > 0) and not any(
+                _is_below_path(record_path, prefix)
+                for record_path in (record["path"], record["old_path"])
+                for prefix in path_prefixes
+            ):
+                continue
+            symbol = DIFF_SYMBOLS.get(str(record["change"]), "?")
+            if output_format == "json":
+                print(json.dumps(record, sort_keys=True))
+            elif record["old_path"] is not None:
+                print(f"{symbol}\t{record['old_path']} -> {record['path']}")
+            else:
+                print(f"{symbol}\t{record['path']}")
+    except libioc.errors.IocException:
+        exit(1)
+    except libzfs.ZFSException as e:
+        logger.error(f"Snapshot diff failed: {e}")
+        exit(1)
+
+
+def _is_below_path(path: typing.Optional[str], prefix: str) -> bool:
+    if path is None:
+        return False
+    if prefix == "/":
+        return True
+    return (path == prefix) or path.startswith(f"{prefix}/")
+
+
 class SnapshotCli(click.MultiCommand):
     """Python Click snapshot subcommand boilerplate."""
 
@@ -155,7 +573,9 @@ class SnapshotCli(click.MultiCommand):
             "list",
             "create",
             "rollback",
-            "remove"
+            "remove",
+            "prune",
+            "diff"
         ]
 
     def get_command(
@@ -174,6 +594,10 @@ class SnapshotCli(click.MultiCommand):
             command = cli_remove
         elif cmd_name == "rollback":
             command = cli_rollback
+        elif cmd_name == "prune":
+            command = cli_prune
+        elif cmd_name == "diff":
+            command = cli_diff
         else:
             command = cli_list_or_create
 
@@ -194,6 +618,7 @@ def cli(
     """Take and manage resource snapshots."""
     ctx.logger = ctx.parent.logger
     ctx.host = ctx.parent.host
+    ctx.zfs = ctx.parent.zfs
 
 
 def _parse_identifier(
@@ -29,28 +29,88 @@ When a release was fetched, patches are downloaded. Standalone jails that
 were forked from a release that received new updates needs to apply them.
 No network connection is required, as the previously downloaded patches
 are temporarily mounted and applied with securelevel=0.
+
+With --jobs multiple jails are updated concurrently. The downloaded patches
+of each release are frozen in a snapshot once, and every concurrent updater
+mounts a ZFS clone of it, so that the patch set is shared by all jails of a
+release while the updaters working directories stay separated.
 """
 import click
+import threading
 import typing
 
+import libzfs
+
 import libioc.errors
+import libioc.events
 import libioc.Jails
 import libioc.Logger
+import libioc.ResourceUpdater
+import libioc.ZFS
 import libioc.Config.Jail.File.Fstab
 
 from .shared.click import IocClickContext
+from .shared.jail import reload_jail
+from .shared.jobs import JobPool
+from .shared.output import print_job_summary
 
 __rootcmd__ = True
 
 
+class _SharedPatchSet:
+    """Run an updater on a clone of the releases frozen patch set."""
+
+    shared_updates_dataset_name: str
+    release_snapshot_lock: threading.Lock
+
+    @property
+    def host_updates_dataset_name(self) -> str:
+        """Return the name of the patch set clone of this updater."""
+        return self.shared_updates_dataset_name
+
+    def _create_jail_update_dir(self) -> None:
+        # the directory is created in the jail by the temporary update jail
+        # and the release root must not be modified by concurrent updaters
+        pass
+
+    def _snapshot_after_release_update(self) -> None:
+        with self.release_snapshot_lock:
+            super()._snapshot_after_release_update()  # noqa: T484
+
+
+class SharedPatchSetFreeBSD(
+    _SharedPatchSet,
+    libioc.ResourceUpdater.FreeBSD
+):
+    """FreeBSD updater using a shared patch set."""
+
+    pass
+
+
+class SharedPatchSetHardenedBSD(
+    _SharedPatchSet,
+    libioc.ResourceUpdater.HardenedBSD
+):
+    """HardenedBSD updater using a shared patch set."""
+
+    pass
+
+
 @click.command(
     name="update",
     help="Update a jail to a new release or patchlevel."
 )
 @click.pass_context
+@click.option(
+    "--jobs", "-j",
+    type=int,
+    default=1,
+    help="Number of jails that are updated concurrently."
+)
 @click.argument("jails", nargs=-1)
 def cli(
     ctx: IocClickContext,
+    jobs: int,
     jails: typing.Tuple[str, ...]
 ) -> typing.Optional[bool]:
     """Update jails with patches from their releases."""
@@ -69,6 +129,14 @@ def cli(
         filters=filters
     )
 
+    if jobs > 1:
+        return _update_jails_concurrently(
+            list(ioc_jails),
+            jobs=jobs,
+            logger=logger,
+            print_function=print_function
+        )
+
     changed_jails = []
     failed_jails = []
     for jail in ioc_jails:
@@ -90,3 +158,114 @@ def cli(
         return False
 
     return True
+
+
+def _update_jails_concurrently(
+    ioc_jails: typing.List['libioc.Jail.JailGenerator'],
+    jobs: int,
+    logger: libioc.Logger.Logger,
+    print_function: typing.Callable[
+        [typing.Generator['libioc.events.IocEvent', None, None]],
+        typing.Optional[bool]
+    ]
+) -> bool:
+
+    if len(ioc_jails) == 0:
+        logger.error("No non-basejail matched your input")
+        return False
+
+    # one frozen patch set per release
+    patch_snapshots: typing.Dict[str, str] = {}
+    release_snapshot_lock = threading.Lock()
+    pool = JobPool(jobs=jobs)
+
+    try:
+        for jail in ioc_jails:
+            updates_dataset = jail.updater.host_updates_dataset
+            if updates_dataset.name not in patch_snapshots:
+                snapshot_name = libioc.ZFS.append_snapshot_datetime(
+                    f"{updates_dataset.name}@shared-update"
+                )
+                updates_dataset.snapshot(snapshot_name)
+                patch_snapshots[updates_dataset.name] = snapshot_name
+
+            pool.add(jail.full_name, _update_job(
+                jail,
+                patch_snapshot_name=patch_snapshots[updates_dataset.name],
+                release_snapshot_lock=release_snapshot_lock,
+                logger=logger
+            ))
+
+        print_function(pool.run())
+    except libioc.errors.IocException:
+        return False
+    finally:
+        zfs = libioc.ZFS.get_zfs(logger=logger)
+        for snapshot_name in patch_snapshots.values():
+            # do not hide the error that ended the update
+            try:
+                zfs.get_snapshot(snapshot_name).delete()
+            except libzfs.ZFSException:
+                logger.warn(
+                    f"Could not delete the patch snapshot {snapshot_name}"
+                )
+
+    print_job_summary(pool.results)
+
+    for result in pool.failed:
+        if not isinstance(result.error, libioc.errors.IocException):
+            raise result.error
+
+    return len(pool.failed) == 0
+
+
+def _update_job(
+    jail: 'libioc.Jail.JailGenerator',
+    patch_snapshot_name: str,
+    release_snapshot_lock: threading.Lock,
+    logger: libioc.Logger.Logger
+) -> typing.Callable[[], typing.Generator[
+    typing.Union['libioc.events.IocEvent', bool],
+    None,
+    None
+]]:
+
+    def _update() -> typing.Generator[
+        typing.Union['libioc.events.IocEvent', bool],
+        None,
+        None
+    ]:
+        worker_jail = reload_jail(jail, logger=logger)
+        zfs = worker_jail.zfs
+
+        updates_dataset_name = patch_snapshot_name.split("@", maxsplit=1)[0]
+        clone_name = f"{updates_dataset_name}-{worker_jail.identifier}"
+        zfs.get_snapshot(patch_snapshot_name).clone(clone_name)
+        clone = zfs.get_dataset(clone_name)
+        clone.mount()
+
+        updater_class: typing.Type[_SharedPatchSet]
+        if worker_jail.host.distribution.name == "HardenedBSD":
+            updater_class = SharedPatchSetHardenedBSD
+        else:
+            updater_class = SharedPatchSetFreeBSD
+        updater = updater_class(  # noqa: T484
+            host=worker_jail.host,
+            resource=worker_jail
+        )
+        updater.shared_updates_dataset_name = clone_name
+        updater.release_snapshot_lock = release_snapshot_lock
+
+        changed = False
+        try:
+            for event in updater.apply():
+                if isinstance(event, bool):
+                    changed = event
+                else:
+                    yield event
+        finally:
+            zfs.delete_dataset_recursive(clone)
+
+        yield changed
+
+    return _update